@@ -0,0 +1,315 @@
+"""
+vectorized earnings-cycle backtest of the model predictions
+
+Every earnings event with a prediction is a candidate trade: enter at the close
+of the trading day after the release date (releases come after the close, so
+the release-date close is not tradable on them), take profit once the price
+reaches a multiple of the predicted period_max_price_pct, stop out below a loss
+limit, or exit at the last trading day before the next release (or after
+max_holding_days). Open trades are marked to market at every close and sized
+from the current equity: each holds position_size of it, scaled down so that
+the open trades never hold more than max_exposure of it together. All events
+and all (threshold, take-profit, stop) combinations are simulated at once on
+arrays; there is no event loop.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from utilities.util import load_config, load_file, save_file, log, results_path
+from utilities.schema import apply_schema
+from data_preparation.data_cleaning import read_market_data, read_eps_data
+from data_preparation.panel import PricePanel
+from data_preparation.earnings_join import join_earnings_asof
+
+TRADING_DAYS = 252
+
+
+def next_release_dates(df_events, df_eps):
+    """
+    Date of the first EPS release strictly after each event of its ticker, NaT
+    for the last release of a ticker.
+    """
+    events = join_earnings_asof(df_events[['Ticker', 'Date']], df_eps, fields=[])
+    next_release = pd.to_datetime(events['Date']).dt.normalize() \
+        + pd.to_timedelta(events['Days Until Earnings'], unit='D')
+    return next_release.to_numpy(dtype='datetime64[ns]')
+
+
+def event_paths(prices, dates, ticker_idx, entry_idx, end_idx, max_holding_days):
+    """
+    Returns relative to the entry price of every trading day of every event,
+    as an (events, max_holding_days) array. Days after the end of an event's
+    period carry its last price forward; missing prices carry the previous one.
+
+    Returns:
+        returns (numpy.ndarray): (events, days) returns since entry.
+        lengths (numpy.ndarray): Trading days in the period of each event.
+    """
+    days = entry_idx[:, None] + 1 + np.arange(max_holding_days)
+    in_period = days < np.minimum(end_idx, len(dates))[:, None]
+    path = prices[ticker_idx[:, None], np.minimum(days, len(dates) - 1)].astype('float64')
+    path = np.where(in_period, path, np.nan)
+    # forward fill along the days
+    filled = np.where(np.isnan(path), 0, np.arange(max_holding_days))
+    filled = np.maximum.accumulate(filled, axis=1)
+    path = path[np.arange(len(path))[:, None], filled]
+    entry_price = prices[ticker_idx, entry_idx].astype('float64')
+    path = np.where(np.isnan(path), entry_price[:, None], path)
+    return path / entry_price[:, None] - 1, in_period.sum(axis=1)
+
+
+def first_crossing(running, levels):
+    """
+    First day each row of a non-decreasing (events, days) array reaches a
+    level, for many levels at once: the rows are offset to make one sorted
+    array and searched with a single searchsorted.
+
+    Args:
+        running (numpy.ndarray): (events, days) array, non-decreasing per row.
+        levels (numpy.ndarray): (combinations, events) levels.
+
+    Returns:
+        days (numpy.ndarray): (combinations, events) first day index, `days`
+            when the level is never reached.
+    """
+    n_events, n_days = running.shape
+    low, high = running.min(), running.max()
+    span = high - low + 2
+    offsets = np.arange(n_events) * span
+    flat = (running - low + offsets[:, None]).ravel()
+    levels = np.clip(levels, low, high + 1) - low + offsets
+    return np.searchsorted(flat, levels, side='left') - np.arange(n_events) * n_days
+
+
+def simulate_trades(returns, lengths, predictions, take_profits, stops, max_holding_days):
+    """
+    Exit day and return of every event for every (take-profit, stop) pair.
+    Exits are decided on closes. Take-profit levels are take_profit *
+    predicted return and fill at the level; stops fill at the close that
+    breached them; a stop and a take-profit on the same day count as the stop.
+
+    Returns:
+        exit_day (numpy.ndarray): (take_profits * stops, events) exit day index.
+        trade_return (numpy.ndarray): (take_profits * stops, events) return.
+    """
+    running_max = np.maximum.accumulate(returns, axis=1)
+    running_drawdown = np.maximum.accumulate(-returns, axis=1)
+    take_profit_levels = np.asarray(take_profits)[:, None] * predictions[None, :] / 100
+    stop_levels = np.repeat(np.asarray(stops)[:, None] / 100, len(predictions), axis=1)
+    take_profit_day = first_crossing(running_max, take_profit_levels)
+    stop_day = first_crossing(running_drawdown, stop_levels)
+    time_exit_day = np.minimum(lengths, max_holding_days) - 1
+
+    # every (take-profit, stop) pair
+    take_profit_day = np.repeat(take_profit_day, len(stops), axis=0)
+    take_profit_levels = np.repeat(take_profit_levels, len(stops), axis=0)
+    stop_day = np.tile(stop_day, (len(take_profits), 1))
+
+    exit_day = np.minimum(np.minimum(take_profit_day, stop_day), time_exit_day)
+    at_exit = np.take_along_axis(returns, np.maximum(exit_day, 0).T, axis=1).T
+    take_profit_exit = (take_profit_day == exit_day) & (stop_day != exit_day)
+    trade_return = np.where(take_profit_exit, take_profit_levels, at_exit)
+    return exit_day, trade_return
+
+
+def mark_to_market(returns, exit_day, trade_return, entry_idx, buckets, n_buckets, n_dates):
+    """
+    Daily returns of every trade marked to market at the close: its return
+    since the previous close on every day it is open, and on its exit day the
+    move up to the exit fill, so the daily returns of a trade compound to its
+    return. Returns and open trades are summed per (bucket, pair) on the dates.
+
+    Args:
+        returns (numpy.ndarray): (events, days) returns since entry.
+        exit_day (numpy.ndarray): (pairs, events) exit day index.
+        trade_return (numpy.ndarray): (pairs, events) return at exit.
+        entry_idx (numpy.ndarray): Date index of the entry of every event.
+        buckets (numpy.ndarray): Bucket of every event.
+        n_buckets (int): Number of buckets.
+        n_dates (int): Number of dates.
+
+    Returns:
+        daily_returns (numpy.ndarray): (buckets, pairs, dates) summed returns.
+        open_trades (numpy.ndarray): (buckets, pairs, dates) trades open
+            since the previous close.
+    """
+    n_pairs, n_events = exit_day.shape
+    block = buckets[None, :] * n_pairs + np.arange(n_pairs)[:, None]
+    # a trade is open from the close after its entry to its exit day
+    first_day = block * (n_dates + 1) + entry_idx[None, :] + 1
+    open_trades = np.bincount(first_day.ravel(), minlength=n_buckets * n_pairs * (n_dates + 1)) \
+        - np.bincount((first_day + exit_day + 1).ravel(), minlength=n_buckets * n_pairs * (n_dates + 1))
+    open_trades = np.cumsum(open_trades.reshape(n_buckets, n_pairs, n_dates + 1), axis=2)[:, :, :-1]
+
+    daily_returns = np.zeros(n_buckets * n_pairs * n_dates)
+    date_idx = block * n_dates + entry_idx[None, :] + 1
+    # trades by decreasing exit day: the trades open on a day are a prefix
+    order = np.argsort(-exit_day.ravel(), kind='stable')
+    exit_day, trade_return = exit_day.ravel()[order], trade_return.ravel()[order]
+    date_idx, event = date_idx.ravel()[order], order % n_events
+    day_returns = np.ascontiguousarray(returns.T)
+    previous = np.zeros(len(order))
+    open_until = -exit_day
+    for day in range(min(returns.shape[1], exit_day.max(initial=-1) + 1)):
+        n_open = np.searchsorted(open_until, -day, side='right')
+        value = day_returns[day][event[:n_open]]
+        exiting = exit_day[:n_open] == day
+        value[exiting] = trade_return[:n_open][exiting]
+        daily_returns += np.bincount(date_idx[:n_open] + day,
+                                     weights=(value - previous[:n_open]) / (1 + previous[:n_open]),
+                                     minlength=len(daily_returns))
+        previous = value
+    return daily_returns.reshape(n_buckets, n_pairs, n_dates), open_trades
+
+
+def performance_metrics(daily_returns, n_trades, n_wins, trade_pnl_sum):
+    """
+    empyrical-style metrics of many strategies at once.
+
+    Args:
+        daily_returns (numpy.ndarray): (strategies, dates) mark-to-market
+            returns of the equity.
+
+    Returns:
+        metrics (dict): Metric name to a (strategies,) array.
+        equity (numpy.ndarray): (strategies, dates) equity curves.
+    """
+    equity = np.cumprod(1 + daily_returns, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean, std = daily_returns.mean(axis=1), daily_returns.std(axis=1, ddof=1)
+        downside = np.sqrt((np.minimum(daily_returns, 0) ** 2).mean(axis=1))
+        annual_return = equity[:, -1] ** (TRADING_DAYS / equity.shape[1]) - 1
+        max_drawdown = (equity / np.maximum.accumulate(np.maximum(equity, 1), axis=1) - 1).min(axis=1)
+        return {'n_trades': n_trades,
+                'hit_rate': n_wins / n_trades,
+                'avg_trade_return': trade_pnl_sum / n_trades,
+                'total_return': equity[:, -1] - 1,
+                'annual_return': annual_return,
+                'annual_volatility': std * np.sqrt(TRADING_DAYS),
+                'sharpe_ratio': mean / std * np.sqrt(TRADING_DAYS),
+                'sortino_ratio': mean / downside * np.sqrt(TRADING_DAYS),
+                'max_drawdown': max_drawdown,
+                'calmar_ratio': annual_return / np.abs(max_drawdown)}, equity
+
+
+def run_backtest(df_predictions, prices, tickers, dates, next_release, target,
+                 thresholds, take_profits, stops, max_holding_days=63, position_size=0.02,
+                 max_exposure=1.0):
+    """
+    Backtest every (threshold, take-profit, stop) combination.
+
+    Args:
+        df_predictions (pandas.DataFrame): Date, Ticker and
+            Predictions_<target> of the earnings events.
+        prices (numpy.ndarray): (tickers, dates) close prices, e.g. the
+            'Adj Close' field of a PricePanel.
+        tickers (pandas.Index): Tickers of the price rows.
+        dates (numpy.ndarray): Trading dates of the price columns.
+        next_release (numpy.ndarray): Next release date of every event.
+        target (str): Predicted target, a percentage move.
+        thresholds (array-like): Increasing thresholds, enter when the
+            prediction exceeds the threshold.
+        take_profits (array-like): Take profit at this multiple of the prediction.
+        stops (array-like): Stop loss in percent.
+        max_holding_days (int): Time exit in trading days.
+        position_size (float): Fraction of the current equity held by a trade.
+        max_exposure (float): Cap on the fraction of the equity held by all
+            open trades together; when more trades are open, each holds
+            max_exposure / open trades. At most 1, so the equity stays positive.
+
+    Returns:
+        df_metrics (pandas.DataFrame): Metrics of every combination.
+        equity (numpy.ndarray): (combinations, dates) equity curves.
+    """
+    if not 0 < max_exposure <= 1:
+        raise ValueError(f'max_exposure must be in (0, 1], got {max_exposure}')
+    ticker_idx = tickers.get_indexer(df_predictions['Ticker'].astype(str))
+    event_dates = pd.to_datetime(df_predictions['Date']).to_numpy()
+    release_idx = np.searchsorted(dates, event_dates)
+    # the release is public after its close, the trade enters at the next close
+    entry_idx = release_idx + 1
+    valid = ((ticker_idx >= 0) & (entry_idx < len(dates))
+             & (dates[np.minimum(release_idx, len(dates) - 1)] == event_dates))
+    valid[valid] &= ~np.isnan(prices[ticker_idx[valid], entry_idx[valid]])
+    end_idx = np.where(pd.isna(next_release), len(dates),
+                       np.searchsorted(dates, pd.to_datetime(next_release).to_numpy()))
+    ticker_idx, entry_idx, end_idx = ticker_idx[valid], entry_idx[valid], end_idx[valid]
+    predictions = df_predictions[f'Predictions_{target}'].to_numpy(dtype='float64')[valid]
+
+    returns, lengths = event_paths(prices, dates, ticker_idx, entry_idx, end_idx, max_holding_days)
+    tradable = lengths > 0
+    returns, lengths, predictions = returns[tradable], lengths[tradable], predictions[tradable]
+    entry_idx = entry_idx[tradable]
+    log(f'Backtesting {len(predictions)} events, {len(thresholds) * len(take_profits) * len(stops)} combinations')
+
+    exit_day, trade_return = simulate_trades(returns, lengths, predictions, take_profits, stops,
+                                             max_holding_days)
+    n_pairs, n_dates = len(trade_return), len(dates)
+
+    # an event is traded by the thresholds below its prediction: the returns
+    # and open trades of threshold i sum the events of the buckets above i
+    buckets = np.searchsorted(thresholds, predictions, side='left')
+    bucket_returns, bucket_open = mark_to_market(returns, exit_day, trade_return, entry_idx, buckets,
+                                                 len(thresholds) + 1, n_dates)
+    daily_returns = np.cumsum(bucket_returns[::-1], axis=0)[::-1][1:].reshape(-1, n_dates)
+    n_open = np.cumsum(bucket_open[::-1], axis=0)[::-1][1:].reshape(-1, n_dates)
+    weight = np.minimum(position_size, max_exposure / np.maximum(n_open, 1))
+
+    n_trades, n_wins, pnl_sum = [], [], []
+    for threshold in thresholds:
+        selected = (predictions > threshold)[None, :]
+        pnl = np.where(selected, trade_return, 0.0)
+        n_trades.append(np.repeat(selected.sum(), n_pairs))
+        n_wins.append((selected & (trade_return > 0)).sum(axis=1))
+        pnl_sum.append(pnl.sum(axis=1))
+    metrics, equity = performance_metrics(daily_returns * weight,
+                                          np.concatenate(n_trades), np.concatenate(n_wins),
+                                          np.concatenate(pnl_sum))
+
+    grid = pd.MultiIndex.from_product([thresholds, take_profits, stops],
+                                      names=['threshold', 'take_profit', 'stop']).to_frame(index=False)
+    return pd.concat([grid, pd.DataFrame(metrics)], axis=1), equity
+
+
+def main():
+    config = load_config()
+    target = config['backtest_target']
+    predictions_file = results_path(config, f"data_with_predictions.{config['storage_format']}")
+    df_predictions = load_file(predictions_file, columns=['Date', 'Ticker', f'Predictions_{target}'],
+                               filters=[('Date', '>=', config['cutoff_date'])])
+    df_predictions = apply_schema(df_predictions, float_dtype=config['float_dtype'], name='predictions')
+
+    if os.path.exists(config['price_panel_dir']):
+        panel = PricePanel.load(config['price_panel_dir']).window(start_date=config['cutoff_date'])
+    else:
+        df_market = read_market_data(config, columns=['Date', 'Ticker', 'Adj Close'],
+                                     start_date=config['cutoff_date'])
+        panel = PricePanel.from_long(df_market, fields=['Adj Close'])
+    prices, tickers, dates = panel.field('Adj Close'), pd.Index(panel.tickers), panel.dates
+    next_release = next_release_dates(df_predictions, read_eps_data(config))
+
+    df_metrics, equity = run_backtest(df_predictions, prices, tickers, dates, next_release, target,
+                                      thresholds=np.arange(*config['backtest_thresholds']),
+                                      take_profits=np.arange(*config['backtest_take_profits']),
+                                      stops=np.arange(*config['backtest_stops']),
+                                      max_holding_days=config['backtest_max_holding_days'],
+                                      position_size=config['backtest_position_size'],
+                                      max_exposure=config['backtest_max_exposure'])
+    df_metrics = df_metrics.sort_values('sharpe_ratio', ascending=False)
+    best = df_metrics.iloc[0]
+    log(f'Best combination: threshold {best.threshold:g}, take profit {best.take_profit:g}, '
+        f'stop {best.stop:g}: Sharpe ratio {best.sharpe_ratio:.2f}, total return {best.total_return:.2%}, '
+        f'max drawdown {best.max_drawdown:.2%}')
+
+    top = df_metrics.index[:config['backtest_top_n']]
+    df_equity = pd.DataFrame(equity[top].T, index=pd.Index(dates, name='Date'),
+                             columns=[f't{r.threshold:g}_tp{r.take_profit:g}_s{r.stop:g}'
+                                      for r in df_metrics.loc[top].itertuples()])
+    save_file(df_metrics, results_path(config, 'backtest_metrics.csv'), index=False)
+    save_file(df_equity, results_path(config, 'backtest_equity.csv'))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,86 @@
 import warnings
 
-from utilities.util import load_config, save_file, log
+from utilities.util import load_config, load_file, save_file, log, date_ordinals
+from utilities.schema import apply_schema
+from data_preparation.eps_store import compact_eps_data, EPS_COLUMNS
+from data_preparation.market_store import MarketDataStore
+from data_preparation.universe import UniverseIndex
+from data_preparation.earnings_join import join_earnings_asof, snap_events_to_trading_days
+from data_preparation import feature_engineer
+import numpy as np
 import pandas as pd
-import os 
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm 
 
 
 warnings.filterwarnings("ignore")
 
 
-def read_eps_data():
+def read_eps_data(config):
     """
-    Read EPS data from multiple files and return a DataFrame.
+    Read EPS data from the compacted EPS store and return a DataFrame.
+
+    The store is refreshed first, re-reading only the per-ticker files that
+    changed since the last run.
 
     Returns:
         df_eps (pandas.DataFrame): DataFrame containing EPS data.
     """
     log('Reading EPS data')
-    eps_files = os.listdir('data/eps_data')
-    df_eps = pd.DataFrame()
-    for eps_file in eps_files:
-        df_temp = pd.read_csv('data/eps_data/' + eps_file, 
-                              parse_dates=['Event Start Date'],
-                              usecols=['Symbol', 'Event Start Date', 'EPS Estimate', 'Reported EPS', 'Surprise (%)'])
-        df_eps = pd.concat((df_eps, df_temp))
-
-    df_eps['Event Start Date'] = df_eps['Event Start Date'].dt.date
+    store_path = compact_eps_data(eps_dir=config['eps_data_dir'],
+                                  store_dir=config['eps_store_dir'],
+                                  n_workers=config['eps_read_workers'])
+    df_eps = pd.read_parquet(store_path, columns=EPS_COLUMNS)
+
+    df_eps = apply_schema(df_eps, float_dtype=config['float_dtype'], name='EPS data')
     return df_eps
 
 
-def read_market_data(config):
+def read_market_data(config, columns=['Date', 'Ticker', 'Adj Close', 'Volume'],
+                     start_date=None, end_date=None):
     """
     Read market data from a file and return a DataFrame.
 
+    Args:
+        config (dict): Configuration settings.
+        columns (list): Columns to read.
+        start_date (str): Optional first date to read (inclusive).
+        end_date (str): Optional last date to read (inclusive).
+
     Returns:
         df_market (pandas.DataFrame): DataFrame containing market data.
     """
     log('Reading market data')
-    start_date = config['start_date']
-    end_date = config['end_date']
-    market_data_file = f'data/market_data/{start_date} to {end_date}.csv'
-
-    df_market = pd.read_csv(market_data_file, 
-                              parse_dates=['Date'],
-                              usecols=['Date', 'Ticker', 'Adj Close', 'Volume'])
-    df_market['Date'] = df_market['Date'].dt.date
+    if config['market_data_sync'] == 'incremental':
+        store = MarketDataStore(config['market_data_store'])
+        df_market = store.read(start_date=start_date or config['start_date'],
+                               end_date=end_date or pd.Timestamp(config['end_date']) - pd.Timedelta(days=1),
+                               columns=columns)
+    else:
+        market_data_file = 'data/market_data/{} to {}.{}'.format(config['start_date'],
+                                                                 config['end_date'],
+                                                                 config['storage_format'])
+
+        filters = []
+        if start_date is not None:
+            filters.append(('Date', '>=', start_date))
+        if end_date is not None:
+            filters.append(('Date', '<=', end_date))
+
+        df_market = load_file(market_data_file, columns=columns, filters=filters)
+    df_market = apply_schema(df_market, float_dtype=config['float_dtype'], name='market data')
 
     return df_market
 
 
-def filter_by_tickers(df):
+def filter_by_tickers(df, universe):
+    """
+    Keep the full history of the tickers that are ever in the universe, so
+    that targets can use prices from days the ticker was not a member; the
+    point-in-time membership is applied to the modelled rows in training.
+    """
     log('Filtering by tickers')
-    selected_tickers = pd.read_csv('data/market_data/selected_tickers.csv')['Ticker'].tolist()
-    df = df.query('Ticker in @selected_tickers')
-    return df 
+    return df[df['Ticker'].isin(universe.ever_members())]
 
 
 def normalize_price(data):
@@ -118,53 +145,194 @@ def generate_target(market_data_ticker, eps_data_ticker):
     return merged_data
 
 
-def calculate_targets_for_single_ticker(ticker):
-    # Step 1: Query market data for the current ticker
-    market_data_ticker = df_market[df_market['Ticker'] == ticker]
+def calculate_targets_for_single_ticker(market_data_ticker, eps_data_ticker):
+    """
+    Calculate the targets for one ticker partition.
 
-    # Step 2: Read current ticker EPS data
-    eps_data_ticker = df_eps[df_eps['Symbol'] == ticker]
+    Args:
+        market_data_ticker (pandas.DataFrame): Market data of a single ticker.
+        eps_data_ticker (pandas.DataFrame): EPS data of the same ticker.
 
-    # This will require your logic to determine the periods and calculate the max/min prices
+    Returns:
+        merged_data (pandas.DataFrame): Market data with the target variables.
+    """
     merged_data = generate_target(market_data_ticker, eps_data_ticker)
-    return merged_data  # This will include your target calculations
+    return merged_data
+
 
+def _calculate_targets_for_partition(partition):
+    return calculate_targets_for_single_ticker(*partition)
 
-def calculate_targets_for_all_tickers(df_market, df_eps):
+
+def partition_by_ticker(df_market, df_eps):
+    """
+    Group market and EPS data by ticker once.
+
+    Args:
+        df_market (pandas.DataFrame): DataFrame containing market data.
+        df_eps (pandas.DataFrame): DataFrame containing EPS data.
+
+    Returns:
+        partitions (list): (market_data_ticker, eps_data_ticker) tuples in
+            order of first appearance of the ticker in df_market.
+    """
+    eps_groups = dict(tuple(df_eps.groupby('Symbol', sort=False, observed=True)))
+    empty_eps = df_eps.iloc[0:0]
+    return [(market_data_ticker, eps_groups.get(ticker, empty_eps))
+            for ticker, market_data_ticker
+            in df_market.groupby('Ticker', sort=False, observed=True)]
+
+
+def generate_targets_vectorized(df_market, df_eps):
+    """
+    Calculate the earnings-period targets for all tickers at once.
+
+    Every trading day is labelled with the id of the earnings period it falls
+    in (strictly between two consecutive EPS release dates of its ticker) via a
+    single searchsorted over sorted (ticker, date) keys. The period max/min
+    'Adj Close' are then computed with one grouped reduction and written back
+    to the rows of the opening release date. The result matches
+    concatenating generate_target over every ticker, except that the target
+    columns are float with NaN instead of object with pd.NA.
+
+    Args:
+        df_market (pandas.DataFrame): DataFrame containing market data.
+        df_eps (pandas.DataFrame): DataFrame containing EPS data.
+
+    Returns:
+        merged_data (pandas.DataFrame): Market data joined with EPS data and
+            the 'period_max_price'/'period_min_price' targets.
+    """
+    # Keep the row order of the per-ticker loop: tickers by first appearance
+    ticker_codes = pd.factorize(df_market['Ticker'])[0]
+    order = np.argsort(ticker_codes, kind='stable')
+    df_market = df_market.iloc[order]
+
+    merged_data = pd.merge(df_market.reset_index(drop=True),
+                           df_eps,
+                           left_on=['Ticker', 'Date'],
+                           right_on=['Symbol', 'Event Start Date'],
+                           how='left')
+
+    codes = pd.factorize(merged_data['Ticker'])[0].astype('int64')
+    days = date_ordinals(merged_data['Date'])
+    day_offset = days.min()
+    day_span = days.max() - day_offset + 1
+    row_keys = codes * day_span + (days - day_offset)
+
+    # Sorted unique (ticker, release date) keys of the EPS events
+    has_event = merged_data['Surprise (%)'].notna().to_numpy()
+    event_keys = np.unique(row_keys[has_event])
+    event_codes = event_keys // day_span
+    if len(event_keys) == 0:
+        merged_data['period_max_price'] = np.nan
+        merged_data['period_min_price'] = np.nan
+        return merged_data
+
+    # Index of the last release strictly before each trading day
+    pos = np.searchsorted(event_keys, row_keys, side='left')
+    prev_event = pos - 1
+    next_event = np.minimum(pos, len(event_keys) - 1)
+    in_period = ((prev_event >= 0)
+                 & (pos < len(event_keys))
+                 & (event_codes[np.maximum(prev_event, 0)] == codes)
+                 & (event_codes[next_event] == codes)
+                 & (event_keys[next_event] != row_keys))
+
+    prices = merged_data['Adj Close'].to_numpy()
+    period_prices = pd.Series(prices[in_period]).groupby(prev_event[in_period])
+    period_max = period_prices.max().reindex(range(len(event_keys))).to_numpy()
+    period_min = period_prices.min().reindex(range(len(event_keys))).to_numpy()
+
+    # Write back to the rows of the opening release date (the last release of
+    # each ticker has no closing date and therefore no target)
+    release_days = date_ordinals(merged_data['Event Start Date'])
+    release_keys = codes * day_span + (release_days - day_offset)
+    event_idx = np.minimum(np.searchsorted(event_keys, release_keys), len(event_keys) - 1)
+    is_next_same_ticker = np.append(event_codes[1:] == event_codes[:-1], False)
+    is_release = (merged_data['Event Start Date'].notna().to_numpy()
+                  & (event_keys[event_idx] == release_keys)
+                  & is_next_same_ticker[event_idx])
+
+    merged_data['period_max_price'] = np.where(is_release, period_max[event_idx], np.nan)
+    merged_data['period_min_price'] = np.where(is_release, period_min[event_idx], np.nan)
+    return merged_data
+
+
+def calculate_targets_for_all_tickers(df_market, df_eps, engine='vectorized',
+                                      n_workers=None, chunksize=16):
     """
     Calculate the target variables for each ticker in the dataset.
 
     Args:
         df_market (pandas.DataFrame): DataFrame containing market data.
         df_eps (pandas.DataFrame): DataFrame containing EPS data.
+        engine (str): 'vectorized' to compute all tickers at once with
+            generate_targets_vectorized, 'partitioned' to run the per-ticker
+            partitions on a process pool, 'loop' to run them serially.
+        n_workers (int): Number of worker processes for the 'partitioned'
+            engine, defaults to the number of CPUs.
+        chunksize (int): Number of ticker partitions sent to a worker at once.
 
     Returns:
         df (pandas.DataFrame): DataFrame containing the target variables.
     """
 
-    log('Calculating targets')
-    tickers = df_market['Ticker'].unique()
-    target_data = pd.DataFrame()
-    for ticker in tqdm(tickers):
-        target_data = pd.concat([target_data, calculate_targets_for_single_ticker(ticker)])
+    log(f'Calculating targets ({engine} engine)')
+    if engine == 'vectorized':
+        target_data = generate_targets_vectorized(df_market, df_eps)
+    elif engine in ('partitioned', 'loop'):
+        partitions = partition_by_ticker(df_market, df_eps)
+        if engine == 'partitioned':
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(tqdm(executor.map(_calculate_targets_for_partition,
+                                                 partitions,
+                                                 chunksize=chunksize),
+                                    total=len(partitions)))
+        else:
+            results = [_calculate_targets_for_partition(partition)
+                       for partition in tqdm(partitions)]
+        target_data = pd.concat(results, ignore_index=True)
+    else:
+        raise ValueError(f'target engine {engine} not recognized.')
     target_data.drop(columns=['Symbol', 'Event Start Date'], inplace=True)
+    # merging with EPS symbols of other categories falls back to object dtype
+    target_data['Ticker'] = target_data['Ticker'].astype(df_market['Ticker'].dtype)
 
     print(target_data.shape)
     print('# of unique Ticker:', target_data['Ticker'].nunique())
     return target_data
 
-# Example usage
-if __name__ == '__main__':
+
+def main():
     config = load_config()
-    df_eps = read_eps_data()
+    if config['earnings_asof_direction'] != 'backward':
+        # 'forward' and 'nearest' attach releases after the row date to the features
+        raise ValueError(f"earnings_asof_direction {config['earnings_asof_direction']} leaks future "
+                         f"releases into the training data, use 'backward'.")
+    df_eps = read_eps_data(config)
     df_market = read_market_data(config)
 
-    df_market = filter_by_tickers(df_market)
-    merged_data = calculate_targets_for_all_tickers(df_market, df_eps)
+    df_market = filter_by_tickers(df_market, UniverseIndex.load(config['universe_path']))
+    df_release = df_eps
+    if config['earnings_snap_days'] is not None:
+        df_release = snap_events_to_trading_days(df_eps, df_market, max_days=config['earnings_snap_days'])
+    merged_data = calculate_targets_for_all_tickers(df_market, df_release,
+                                                    engine=config['target_engine'],
+                                                    n_workers=config['target_workers'],
+                                                    chunksize=config['target_chunksize'])
 
     merged_data = normalize_price(merged_data)
+    merged_data = join_earnings_asof(merged_data, df_eps,
+                                     fields=config['earnings_asof_fields'],
+                                     direction=config['earnings_asof_direction'],
+                                     tolerance_days=config['earnings_asof_tolerance_days'])
+    if config['indicators']:
+        merged_data = feature_engineer.add_indicators(merged_data, config['indicators'])
 
     merged_data = drop_outliers(merged_data, config)
-    save_file(merged_data, 'data/processed_data/data_clean.csv', index=False)
+    save_file(merged_data, f"data/processed_data/data_clean.{config['storage_format']}", index=False)
 
 
+if __name__ == '__main__':
+    main()
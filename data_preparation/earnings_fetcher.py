@@ -0,0 +1,185 @@
+"""
+concurrent, rate-limited and resumable fetching of per-ticker earnings data
+"""
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from utilities.util import load_file, save_file, log
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` requests per second on average
+    with bursts of up to `capacity` requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class EarningsFetcher:
+    """
+    Fetch earnings data for many tickers with a bounded pool of worker threads.
+
+    Each thread reuses its own pooled requests.Session, all threads share one
+    token-bucket rate limit, and 429/5xx responses and connection errors are
+    retried with exponential backoff and jitter. Completed and failed tickers
+    are written to a manifest together with a run key, so an interrupted run
+    with the same key resumes where it stopped and retries the failed tickers.
+    Per-ticker csv files are written in batches.
+    """
+
+    def __init__(self, url, headers, out_dir='data/eps_data', run_key=None,
+                 max_workers=8, rate=5, max_retries=5, backoff=1.0,
+                 batch_size=50, timeout=30):
+        self.url = url
+        self.headers = headers
+        self.out_dir = out_dir
+        self.manifest_path = os.path.join(out_dir, '_manifest.json')
+        self.run_key = run_key
+        self.max_workers = max_workers
+        self.rate_limiter = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self._local.session = session
+        return self._local.session
+
+    def _sleep_before_retry(self, attempt, response=None):
+        delay = self.backoff * 2 ** attempt
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, int(response.headers['Retry-After']))
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def post(self, payload):
+        """
+        POST a json payload, retrying 429/5xx responses and connection errors.
+
+        Returns:
+            response (requests.Response): The last response received.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self._session().post(self.url,
+                                                 data=json.dumps(payload),
+                                                 timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+            self._sleep_before_retry(attempt, response)
+
+    def load_completed(self):
+        if not os.path.exists(self.manifest_path):
+            return set()
+        manifest = load_file(self.manifest_path)
+        if manifest.get('run_key') != self.run_key:
+            return set()
+        return set(manifest['completed'])
+
+    def load_failed(self):
+        """
+        Ticker to error message of the tickers that failed in the current run.
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        manifest = load_file(self.manifest_path)
+        if manifest.get('run_key') != self.run_key:
+            return {}
+        return manifest.get('failed', {})
+
+    def _save_manifest(self, completed, failed):
+        os.makedirs(self.out_dir, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp.json'
+        save_file({'run_key': self.run_key, 'completed': sorted(completed), 'failed': failed}, tmp_path)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _flush(self, results, completed, failed):
+        for ticker, df in results:
+            save_file(data=df,
+                      file_path=os.path.join(self.out_dir, f'{ticker}.csv'),
+                      index=False)
+            completed.add(ticker)
+        self._save_manifest(completed, failed)
+        results.clear()
+
+    def fetch_all(self, tickers, build_payload, parse_response):
+        """
+        Fetch every ticker that has not been completed in the current run.
+
+        Args:
+            tickers (list): Tickers to fetch.
+            build_payload (callable): build_payload(ticker) returning the json payload.
+            parse_response (callable): parse_response(response) returning a DataFrame.
+
+        Returns:
+            failed (dict): Ticker to error message for the tickers that failed,
+                also recorded in the manifest.
+        """
+        completed = self.load_completed()
+        pending = [ticker for ticker in tickers if ticker not in completed]
+        log(f'Fetching earnings data for {len(pending)} tickers '
+            f'({len(tickers) - len(pending)} already completed)')
+
+        def fetch(ticker):
+            response = self.post(build_payload(ticker))
+            if response.status_code != 200:
+                raise RuntimeError(f'status code {response.status_code}')
+            return parse_response(response)
+
+        results, failed = [], {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(fetch, ticker): ticker for ticker in pending}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                ticker = futures[future]
+                try:
+                    results.append((ticker, future.result()))
+                except Exception as e:
+                    failed[ticker] = str(e)
+                    log(f'Failed to retrieve data for {ticker}: {e}', level='warning')
+                if len(results) >= self.batch_size:
+                    self._flush(results, completed, failed)
+        self._flush(results, completed, failed)
+
+        log(f'Earnings data fetched for {len(completed)} tickers, {len(failed)} failed')
+        return failed
@@ -0,0 +1,152 @@
+"""
+universe-wide as-of joins of EPS release events onto daily market data
+"""
+import numpy as np
+import pandas as pd
+
+from utilities.util import date_ordinals
+from data_preparation.eps_store import EPS_NUMERIC_COLUMNS
+
+DIRECTIONS = ('backward', 'forward', 'nearest')
+
+
+def _ticker_day_keys(tickers, days, other_tickers, other_days):
+    """
+    Encode two sets of (ticker, day) pairs as comparable int64 keys that sort
+    by ticker, then day. Also returns the ticker code of every key.
+    """
+    codes = pd.factorize(np.concatenate([np.asarray(tickers, dtype=str),
+                                         np.asarray(other_tickers, dtype=str)]))[0].astype('int64')
+    all_days = np.concatenate([days, other_days])
+    day_offset = all_days.min()
+    day_span = all_days.max() - day_offset + 1
+    keys = codes * day_span + (all_days - day_offset)
+    n = len(days)
+    return keys[:n], codes[:n], keys[n:], codes[n:]
+
+
+def _release_events(df_eps, fields):
+    """
+    EPS events with a release date, one per (Symbol, day): the last one wins.
+    """
+    events = df_eps[['Symbol', 'Event Start Date'] + list(fields)]
+    events = events[events['Event Start Date'].notna()]
+    events = events.assign(day=date_ordinals(events['Event Start Date']))
+    return events.drop_duplicates(['Symbol', 'day'], keep='last')
+
+
+def join_earnings_asof(df, df_eps, fields=EPS_NUMERIC_COLUMNS, direction='backward',
+                       tolerance_days=None, date_column='Date'):
+    """
+    Attach the EPS fields of the nearest release of the same ticker, and the
+    calendar days since the last and until the next release, to every row.
+
+    All rows and all events are encoded as sorted (ticker, day) keys and
+    matched with one searchsorted, like pd.merge_asof(by='Ticker') over the
+    whole universe, so releases dated on non-trading days are matched too.
+
+    Args:
+        df (pandas.DataFrame): Rows with a 'Ticker' column and a date column
+            (or index level).
+        df_eps (pandas.DataFrame): EPS data with 'Symbol', 'Event Start Date'
+            and the fields.
+        fields (list): EPS columns to attach, as 'Last <field>'.
+        direction (str): Release whose fields are attached: 'backward' (last
+            release on or before the date), 'forward' (first release on or
+            after it) or 'nearest'. Only 'backward' is free of look-ahead;
+            the others attach future releases and are for analysis only.
+        tolerance_days (int): Maximum distance in days to the matched
+            release, None for no limit.
+        date_column (str): Date column or index level of df.
+
+    Returns:
+        df (pandas.DataFrame): Copy of df with the 'Last <field>', 'Days Since
+            Earnings' (0 on release days) and 'Days Until Earnings' (to the
+            next release strictly after the date) columns.
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(f'direction {direction} not recognized, use one of {DIRECTIONS}.')
+    events = _release_events(df_eps, fields)
+    df = df.copy()
+    if events.empty:
+        for field in fields:
+            df[f'Last {field}'] = np.nan
+        df['Days Since Earnings'] = np.nan
+        df['Days Until Earnings'] = np.nan
+        return df
+
+    dates = df[date_column] if date_column in df.columns else df.index.get_level_values(date_column)
+    row_days = date_ordinals(dates)
+    row_keys, row_codes, event_keys, event_codes = _ticker_day_keys(
+        df['Ticker'], row_days, events['Symbol'], events['day'].to_numpy())
+    order = np.argsort(event_keys, kind='stable')
+    event_keys, event_codes = event_keys[order], event_codes[order]
+    event_days = events['day'].to_numpy()[order]
+
+    # last release on or before each row, and first release strictly after it
+    after = np.searchsorted(event_keys, row_keys, side='right')
+    prev = np.maximum(after - 1, 0)
+    nxt = np.minimum(after, len(event_keys) - 1)
+    has_prev = (after > 0) & (event_codes[prev] == row_codes)
+    has_next = (after < len(event_keys)) & (event_codes[nxt] == row_codes)
+    days_since = np.where(has_prev, row_days - event_days[prev], np.nan)
+    days_until = np.where(has_next, event_days[nxt] - row_days, np.nan)
+
+    # the release of the fields: on-or-before, on-or-after, or the closer one
+    on_release = days_since == 0
+    forward = np.where(on_release, prev, nxt)
+    forward_days = np.where(on_release, 0, days_until)
+    if direction == 'backward':
+        match, distance = prev, days_since
+    elif direction == 'forward':
+        match, distance = forward, forward_days
+    else:
+        use_forward = np.isnan(days_since) | (forward_days < days_since)
+        match = np.where(use_forward, forward, prev)
+        distance = np.where(use_forward, forward_days, days_since)
+    matched = ~np.isnan(distance)
+    if tolerance_days is not None:
+        matched &= distance <= tolerance_days
+
+    for field in fields:
+        values = events[field].to_numpy(dtype='float64')[order]
+        df[f'Last {field}'] = np.where(matched, values[match], np.nan)
+    df['Days Since Earnings'] = days_since
+    df['Days Until Earnings'] = days_until
+    return df
+
+
+def snap_events_to_trading_days(df_eps, df_market, max_days=4):
+    """
+    Move every EPS release to the first trading day of its ticker on or after
+    the release date, within max_days calendar days, so that releases dated on
+    weekends, holidays or the evening before still meet a market row in an
+    exact (Ticker, Date) join. Events that cannot be snapped keep their date;
+    when several events snap onto one day the last one is kept.
+
+    Args:
+        df_eps (pandas.DataFrame): EPS data with 'Symbol' and 'Event Start Date'.
+        df_market (pandas.DataFrame): Market data with 'Ticker' and 'Date'.
+        max_days (int): Maximum calendar days an event is moved forward.
+
+    Returns:
+        df_eps (pandas.DataFrame): EPS data with snapped 'Event Start Date'.
+    """
+    df_eps = df_eps[df_eps['Event Start Date'].notna()]
+    if df_eps.empty or df_market.empty:
+        return df_eps
+    trade_days = date_ordinals(df_market['Date'])
+    event_days = date_ordinals(df_eps['Event Start Date'])
+    event_keys, event_codes, trade_keys, trade_codes = _ticker_day_keys(
+        df_eps['Symbol'], event_days, df_market['Ticker'], trade_days)
+    order = np.argsort(trade_keys, kind='stable')
+    trade_keys, trade_codes, trade_days = trade_keys[order], trade_codes[order], trade_days[order]
+
+    pos = np.minimum(np.searchsorted(trade_keys, event_keys, side='left'), len(trade_keys) - 1)
+    snapped = ((trade_codes[pos] == event_codes)
+               & (trade_keys[pos] >= event_keys)
+               & (trade_days[pos] - event_days <= max_days))
+    dates = np.where(snapped, trade_days[pos].astype('datetime64[D]').astype('datetime64[ns]'),
+                     df_eps['Event Start Date'].to_numpy(dtype='datetime64[ns]'))
+    df_eps = df_eps.assign(**{'Event Start Date': dates})
+    return df_eps.drop_duplicates(['Symbol', 'Event Start Date'], keep='last')
@@ -0,0 +1,103 @@
+"""
+compact the per-ticker EPS csv files into a single columnar store
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from utilities.util import load_file, save_file, log
+
+EPS_COLUMNS = ['Symbol', 'Event Start Date', 'EPS Estimate', 'Reported EPS', 'Surprise (%)']
+EPS_NUMERIC_COLUMNS = ['EPS Estimate', 'Reported EPS', 'Surprise (%)']
+# bumped when read_eps_file changes, so that existing stores are rebuilt
+EPS_STORE_VERSION = 1
+
+
+def _empty_eps_frame():
+    df = pd.DataFrame({col: pd.Series(dtype='float64') for col in EPS_COLUMNS})
+    df['Symbol'] = df['Symbol'].astype(str).astype('category')
+    df['Event Start Date'] = pd.to_datetime(df['Event Start Date'])
+    return df
+
+
+def read_eps_file(file_path):
+    """
+    Read one per-ticker EPS csv written by MarketDataDownloader.fetch_earnings_data.
+
+    Args:
+        file_path (str): Path to the csv file.
+
+    Returns:
+        df (pandas.DataFrame): Typed EPS data of the ticker.
+    """
+    df = pd.read_csv(file_path, usecols=EPS_COLUMNS)
+    df['Symbol'] = df['Symbol'].astype(str)
+    # Yahoo release times are UTC timestamps (e.g. 21:00 after the close);
+    # market data is daily, so keep the release day only
+    df['Event Start Date'] = pd.to_datetime(df['Event Start Date'], utc=True)\
+                               .dt.tz_localize(None).dt.normalize()
+    for col in EPS_NUMERIC_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+def compact_eps_data(eps_dir='data/eps_data', store_dir='data/eps_store', n_workers=8):
+    """
+    Merge the per-ticker EPS csv files into one Parquet file sorted by Symbol.
+
+    The modification time of every source file is recorded in a manifest next
+    to the store, so a rerun only re-reads the files that were added or changed
+    since the last compaction and drops the tickers whose file was removed.
+    A store written by another EPS_STORE_VERSION is rebuilt from scratch.
+
+    Args:
+        eps_dir (str): Directory with one '<ticker>.csv' per ticker.
+        store_dir (str): Directory of the store and its manifest.
+        n_workers (int): Number of threads reading csv files in parallel.
+
+    Returns:
+        store_path (str): Path to the Parquet store.
+    """
+    store_path = os.path.join(store_dir, 'eps.parquet')
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+
+    mtimes = {file_name: os.path.getmtime(os.path.join(eps_dir, file_name))
+              for file_name in sorted(os.listdir(eps_dir))
+              if file_name.endswith('.csv')}
+
+    manifest = {}
+    if os.path.exists(store_path) and os.path.exists(manifest_path):
+        saved = load_file(manifest_path)
+        if saved.get('version') == EPS_STORE_VERSION:
+            manifest = saved['files']
+
+    changed = [file_name for file_name, mtime in mtimes.items()
+               if manifest.get(file_name) != mtime]
+    removed = [file_name for file_name in manifest if file_name not in mtimes]
+    if not changed and not removed:
+        log('EPS store is up to date')
+        return store_path
+
+    log(f'Compacting EPS data: {len(changed)} changed, {len(removed)} removed files')
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        frames = list(executor.map(read_eps_file,
+                                   [os.path.join(eps_dir, file_name) for file_name in changed]))
+
+    if manifest:
+        stale = [os.path.splitext(file_name)[0] for file_name in changed + removed]
+        df_store = pd.read_parquet(store_path)
+        df_store['Symbol'] = df_store['Symbol'].astype(str)
+        frames.append(df_store[~df_store['Symbol'].isin(stale)])
+
+    frames = [df for df in frames if len(df)]
+    df_eps = pd.concat(frames, ignore_index=True) if frames else _empty_eps_frame()
+    df_eps = df_eps.sort_values(['Symbol', 'Event Start Date'], kind='stable', ignore_index=True)
+    df_eps['Symbol'] = df_eps['Symbol'].astype('category')
+
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = store_path + '.tmp'
+    df_eps.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, store_path)
+    save_file({'version': EPS_STORE_VERSION, 'files': mtimes}, manifest_path)
+    return store_path
@@ -0,0 +1,231 @@
+"""
+content-addressed on-disk cache of feature matrices
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from utilities.util import load_file, save_file, log, project_modules, PROJECT_DIR
+
+
+def code_version(*module_names):
+    """
+    Fingerprint of the source files of project modules and of every project
+    module they import, so cached features are rebuilt when any code that
+    computes them changes.
+    """
+    files = sorted({path for name in module_names for path in project_modules(name)})
+    digest = hashlib.sha256()
+    for path in files:
+        with open(path, 'rb') as f:
+            digest.update(os.path.relpath(path, PROJECT_DIR).encode() + b'\0' + f.read() + b'\0')
+    return digest.hexdigest()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FeatureCache:
+    """
+    Cache DataFrames as Parquet files named by a fingerprint of everything
+    they were computed from, evicting the least recently used entries once the
+    cache grows beyond max_bytes.
+
+    Several processes can share a cache: the index is only read and written
+    under an exclusive file lock, temporary files are named per process, and
+    entries pinned by a running process (e.g. pools read by tuning workers)
+    are never evicted.
+    """
+
+    def __init__(self, cache_dir='data/feature_cache', max_bytes=5 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, 'index.lock')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {'entries': {}, 'files': {}}
+        return load_file(self.index_path)
+
+    def _save_index(self, index):
+        tmp_path = self._tmp(self.index_path) + '.json'
+        save_file(index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _tmp(path):
+        return f'{path}.{os.getpid()}.tmp'
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    def _dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _remove(self, key):
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+        if os.path.isdir(self._dir(key)):
+            shutil.rmtree(self._dir(key))
+
+    def _add_entry(self, key, size, pin=False):
+        """
+        Record a new entry and evict the least recently used entries beyond
+        the size budget, skipping the entries pinned by running processes.
+        """
+        with self._locked():
+            cache_index = self._load_index()
+            cache_index['entries'][key] = {'size': size, 'last_access': time.time(),
+                                           'pins': [os.getpid()] if pin else []}
+            entries = cache_index['entries']
+            total = sum(entry['size'] for entry in entries.values())
+            for old_key in sorted(entries, key=lambda k: entries[k]['last_access']):
+                if total <= self.max_bytes:
+                    break
+                if old_key == key or any(_alive(pid) for pid in entries[old_key].get('pins', [])):
+                    continue
+                total -= entries.pop(old_key)['size']
+                self._remove(old_key)
+                log(f'Evicted feature cache entry {old_key[:12]}')
+            self._save_index(cache_index)
+
+    def _touch(self, key, exists, pin=False):
+        """
+        Mark an entry as used now (and pinned by this process) on a hit.
+        """
+        with self._locked():
+            index = self._load_index()
+            if key not in index['entries'] or not exists():
+                return False
+            entry = index['entries'][key]
+            entry['last_access'] = time.time()
+            if pin:
+                entry['pins'] = [pid for pid in entry.get('pins', []) if _alive(pid)] + [os.getpid()]
+            self._save_index(index)
+            return True
+
+    def unpin(self, key):
+        """
+        Release the pin of this process on an entry.
+        """
+        with self._locked():
+            index = self._load_index()
+            if key in index['entries']:
+                entry = index['entries'][key]
+                entry['pins'] = [pid for pid in entry.get('pins', []) if pid != os.getpid()]
+                self._save_index(index)
+
+    @staticmethod
+    def fingerprint(*parts):
+        """
+        Hash any json-serialisable description of the inputs of an entry.
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def file_fingerprint(self, file_path):
+        """
+        Content hash of a file. The hash is remembered for the file's size and
+        mtime so unchanged files are not read again.
+        """
+        stat = os.stat(file_path)
+        stamp = f'{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+        with self._locked():
+            known = self._load_index()['files'].get(stamp)
+        if known is not None:
+            return known
+
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                digest.update(chunk)
+        with self._locked():
+            index = self._load_index()
+            index['files'][stamp] = digest.hexdigest()
+            self._save_index(index)
+        return digest.hexdigest()
+
+    def get(self, key, columns=None):
+        """
+        Return the cached DataFrame for key, or None on a miss. The entry is
+        pinned while it is read.
+        """
+        if not self._touch(key, lambda: os.path.exists(self._path(key)), pin=True):
+            return None
+        try:
+            return load_file(self._path(key), columns=columns)
+        finally:
+            self.unpin(key)
+
+    def put(self, key, data, index=True):
+        """
+        Store a DataFrame under key and evict the least recently used entries
+        beyond the size budget.
+        """
+        path = self._path(key)
+        tmp_path = self._tmp(path) + '.parquet'
+        save_file(data, tmp_path, index=index)
+        os.replace(tmp_path, path)
+        self._add_entry(key, os.path.getsize(path))
+
+    def get_or_build(self, key, build, index=True):
+        """
+        Return the cached DataFrame for key, building and caching it on a miss.
+        """
+        data = self.get(key)
+        if data is None:
+            data = build()
+            self.put(key, data, index=index)
+        return data
+
+    def get_dir(self, key):
+        """
+        Return the directory cached under key, or None on a miss. The entry
+        stays pinned by this process until it exits or calls unpin, since
+        its files are read (possibly by worker processes) after this returns.
+        """
+        if not self._touch(key, lambda: os.path.isdir(self._dir(key)), pin=True):
+            return None
+        return self._dir(key)
+
+    def put_dir(self, key, build):
+        """
+        Cache the files written by build(dir_path) as one entry under key, for
+        artifacts that are not DataFrames (e.g. CatBoost pools). The entry is
+        pinned by this process like in get_dir.
+
+        Returns:
+            dir_path (str): Directory of the entry.
+        """
+        path = self._dir(key)
+        tmp_path = self._tmp(path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        build(tmp_path)
+        with self._locked():
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+        self._add_entry(key, size, pin=True)
+        return path
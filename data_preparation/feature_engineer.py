@@ -1,6 +1,143 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
 from utilities.util import log
 
 
+def _segments(sorted_codes):
+    """
+    Position within its ticker segment and segment length of every row of an
+    array of ticker codes sorted so that each ticker is contiguous.
+    """
+    is_start = np.ones(len(sorted_codes), dtype=bool)
+    is_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, len(sorted_codes)))
+    segment_start = np.repeat(starts, lengths)
+    return np.arange(len(sorted_codes)) - segment_start, np.repeat(lengths, lengths)
+
+
+def _sort_by_ticker_and_date(df, date_column='Date'):
+    """
+    Sort positions once by (Ticker, Date) and find the ticker segments.
+
+    Returns:
+    - order: Positions of df in (Ticker, Date) order.
+    - pos_in_segment: Position of every sorted row within its ticker segment.
+    - segment_length: Length of the ticker segment of every sorted row.
+    """
+    codes = pd.factorize(df['Ticker'])[0]
+    dates = df[date_column] if date_column in df.columns else df.index.get_level_values(date_column)
+    dates = pd.to_datetime(dates).to_numpy(dtype='datetime64[ns]').view('int64')
+    order = np.lexsort((dates, codes))
+    return (order,) + _segments(codes[order])
+
+
+def _rolling_sum(x, window, pos_in_segment):
+    """
+    Trailing rolling sum over contiguous ticker segments; NaN where the window
+    is incomplete, crosses a ticker boundary or contains a NaN.
+    """
+    out = np.full(len(x), np.nan)
+    if len(x) >= window:
+        out[window - 1:] = sliding_window_view(x, window).sum(axis=1)
+    out[pos_in_segment < window - 1] = np.nan
+    return out
+
+
+def _rsi(prices, window, pos_in_segment):
+    delta = np.full(len(prices), np.nan)
+    delta[1:] = prices[1:] - prices[:-1]
+    delta[pos_in_segment == 0] = np.nan
+    # like Series.where, NaN deltas count as no gain and no loss
+    gain = np.where(delta > 0, delta, 0)
+    loss = np.where(delta < 0, -delta, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = _rolling_sum(gain, window, pos_in_segment) / _rolling_sum(loss, window, pos_in_segment)
+        return 100 - (100 / (1 + rs))
+
+
+def _forward_return(prices, n, pos_in_segment, segment_length):
+    out = np.full(len(prices), np.nan)
+    if len(prices) > n:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[:-n] = prices[n:] / prices[:-n] - 1
+    out[pos_in_segment + n >= segment_length] = np.nan
+    return out
+
+
+def _volatility(prices, window, pos_in_segment):
+    returns = np.full(len(prices), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = prices[1:] / prices[:-1] - 1
+    returns[pos_in_segment == 0] = np.nan
+    total = _rolling_sum(returns, window, pos_in_segment)
+    total_sq = _rolling_sum(returns ** 2, window, pos_in_segment)
+    variance = (total_sq - total ** 2 / window) / (window - 1)
+    return np.sqrt(np.maximum(variance, 0))
+
+
+def indicator_name(spec):
+    """
+    Default column name of an indicator spec.
+    """
+    if 'name' in spec:
+        return spec['name']
+    kind, window = spec['type'], spec['window']
+    return {'ma': f'ma_{window}',
+            'rsi': f'rsi_{window}',
+            'return': f'{window}_day_return',
+            'volatility': f'volatility_{window}'}[kind]
+
+
+def compute_indicators(df, specs, price_column='Adj Close', date_column='Date'):
+    """
+    Compute a batch of indicators in one pass over the per-ticker price series.
+
+    The rows are sorted once by (Ticker, Date) and every indicator is computed
+    on the contiguous per-ticker segments of the sorted price array with
+    sliding windows that never cross a ticker boundary.
+
+    :param df: Pandas DataFrame with 'Ticker', date and price columns
+    :param specs: List of dicts with a 'type' ('ma', 'rsi', 'return' for the
+                  forward n-day return, 'volatility' for the rolling standard
+                  deviation of daily returns), a 'window' and an optional 'name'
+    :param price_column: The name of the column containing the price data
+    :param date_column: The name of the date column (or index level)
+    :return: DataFrame with one column per spec, aligned to df.index
+    """
+    order, pos_in_segment, segment_length = _sort_by_ticker_and_date(df, date_column)
+    prices = df[price_column].to_numpy(dtype='float64')[order]
+
+    block = np.empty((len(df), len(specs)))
+    for i, spec in enumerate(specs):
+        kind, window = spec['type'], spec['window']
+        if kind == 'ma':
+            values = _rolling_sum(prices, window, pos_in_segment) / window
+        elif kind == 'rsi':
+            values = _rsi(prices, window, pos_in_segment)
+        elif kind == 'return':
+            values = _forward_return(prices, window, pos_in_segment, segment_length)
+        elif kind == 'volatility':
+            values = _volatility(prices, window, pos_in_segment)
+        else:
+            raise ValueError(f'indicator type {kind} not recognized.')
+        block[order, i] = values
+
+    return pd.DataFrame(block, index=df.index, columns=[indicator_name(spec) for spec in specs])
+
+
+def add_indicators(df, specs, price_column='Adj Close'):
+    """
+    Compute a batch of indicators and attach them to df as new columns.
+    """
+    log(f'calculating indicators {[indicator_name(spec) for spec in specs]}')
+    block = compute_indicators(df, specs, price_column=price_column)
+    df = df.drop(columns=[col for col in block.columns if col in df.columns])
+    return pd.concat([df, block], axis=1)
+
+
 def calculate_moving_averages(df, window_sizes=[5, 10, 20]):
     """
     Calculate moving averages for given window sizes.
@@ -9,14 +146,7 @@ def calculate_moving_averages(df, window_sizes=[5, 10, 20]):
     :param window_sizes: List of integers for window sizes
     :return: DataFrame with moving averages added as new columns
     """
-    log(f'calculating moving averages for window_sizes {window_sizes}')
-
-    for window in window_sizes:
-        ma_col = 'ma_{}'.format(window)
-        df[ma_col] = df.groupby('Ticker')['Adj Close']\
-                       .rolling(window=window)\
-                       .mean()
-    return df
+    return add_indicators(df, [{'type': 'ma', 'window': window} for window in window_sizes])
 
 
 def calculate_rsi(df, period=14):
@@ -27,14 +157,7 @@ def calculate_rsi(df, period=14):
     :param period: Period for calculating RSI
     :return: DataFrame with RSI added as a new column
     """
-    log(f'calculating rsi for period {period}')
-
-    delta = df.groupby('Ticker')['Adj Close'].diff(1)
-    gain = (delta.where(delta > 0, 0)).rolling(window=period).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
-    rs = gain / loss
-    df['RSI'] = 100 - (100 / (1 + rs))
-    return df
+    return add_indicators(df, [{'type': 'rsi', 'window': period, 'name': 'RSI'}])
 
 
 def calculate_n_day_return(data, n=7, price_column='Adj Close'):
@@ -48,19 +171,86 @@ def calculate_n_day_return(data, n=7, price_column='Adj Close'):
     Returns:
     - data: DataFrame with an additional column for the 7-day return.
     """
-    data[f'{n}_day_return'] = data.groupby('Ticker')[price_column]\
-                                  .pct_change(periods=n)\
-                                  .shift(-n)
-    return data
+    return add_indicators(data, [{'type': 'return', 'window': n}], price_column=price_column)
 
 
-def get_lag(data, columns, n_lag=7):
-    log(f'getting {n_lag} days lag for columns {columns}')
-    for col in columns:
-        for i in range(1, n_lag+1):
-            data[f'{col}_lag_{i}'] = data.groupby('Ticker')[col].shift(i)
+def _shift_spec(spec, default_n):
+    """
+    Normalise a shift spec to {column: [shifts]}: a list of columns gets
+    shifts 1..default_n, a mapping may give an int n (1..n) or a list per column.
+    """
+    if not spec:
+        return {}
+    if isinstance(spec, (list, tuple)):
+        return {col: list(range(1, default_n + 1)) for col in spec}
+    return {col: list(range(1, n + 1)) if isinstance(n, int) else list(n)
+            for col, n in spec.items()}
 
-    return data
+
+def build_lags(data, lags, leads=None, diffs=None, n_lag=7):
+    """
+    Build lag, lead and lag-difference features for every ticker in one block.
+
+    Ticker groups are found once (rows keep their order within a ticker, as
+    with groupby('Ticker').shift); every requested shift of every column is
+    gathered into one contiguous 2-D array that is attached with a single concat.
+
+    Parameters:
+    - data: DataFrame with a 'Ticker' column.
+    - lags: Columns to lag, as a list (lags 1..n_lag) or {column: n or [lags]};
+      creates '{col}_lag_{i}' = value i rows earlier.
+    - leads: Same format; creates '{col}_lead_{i}' = value i rows later.
+    - diffs: Same format; creates '{col}_diff_{i}' = value - '{col}_lag_{i}'.
+    - n_lag: Number of shifts for columns given as a list.
+
+    Returns:
+    - data: DataFrame with the new columns appended.
+    """
+    lags, leads, diffs = (_shift_spec(spec, n_lag) for spec in (lags, leads, diffs))
+    features = ([(col, i, 'lag') for col, shifts in lags.items() for i in shifts]
+                + [(col, i, 'lead') for col, shifts in leads.items() for i in shifts]
+                + [(col, i, 'diff') for col, shifts in diffs.items() for i in shifts])
+    if not features:
+        return data
+
+    columns = list(dict.fromkeys(col for col, _, _ in features))
+    log(f'building {len(features)} lag features for columns {columns}')
+
+    codes = pd.factorize(data['Ticker'])[0]
+    order = np.argsort(codes, kind='stable')
+    pos_in_segment, segment_length = _segments(codes[order])
+    is_missing_ticker = codes[order] == -1
+
+    dtype = np.result_type(np.float32, *[data[col].dtype for col in columns])
+    values = {col: data[col].to_numpy(dtype=dtype)[order] for col in columns}
+
+    # fill the block in sorted order with contiguous slices, then unsort once
+    sorted_block = np.full((len(data), len(features)), np.nan, dtype=dtype, order='F')
+    for j, (col, i, kind) in enumerate(features):
+        shifted = sorted_block[:, j]
+        if i == 0:
+            shifted[:] = values[col]
+        elif kind == 'lead':
+            shifted[:-i] = values[col][i:]
+            shifted[pos_in_segment + i >= segment_length] = np.nan
+        else:
+            shifted[i:] = values[col][:-i]
+            shifted[pos_in_segment < i] = np.nan
+        shifted[is_missing_ticker] = np.nan
+        if kind == 'diff':
+            np.subtract(values[col], shifted, out=shifted)
+
+    block = np.empty_like(sorted_block, order='C')
+    block[order] = sorted_block
+
+    names = [f'{col}_{kind}_{i}' for col, i, kind in features]
+    block = pd.DataFrame(block, index=data.index, columns=names)
+    data = data.drop(columns=[name for name in names if name in data.columns])
+    return pd.concat([data, block], axis=1)
+
+
+def get_lag(data, columns, n_lag=7):
+    return build_lags(data, lags=columns, n_lag=n_lag)
 
 
 def binarlizer(data, categorecal_features):
@@ -0,0 +1,199 @@
+"""
+incremental per-ticker feature state for per-bar updates when a new bar arrives
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+from utilities.util import load_file, save_file, log
+from data_preparation.feature_engineer import indicator_name, _shift_spec
+
+NAN = float('nan')
+
+
+class _Ring:
+    """
+    Fixed-size ring buffer of the most recent values of one series.
+    """
+
+    def __init__(self, size):
+        self.values = np.full(max(size, 1), np.nan)
+        self.count = 0
+
+    def push(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def back(self, k):
+        """
+        Value pushed k steps before the latest one (k=0 is the latest), NaN if
+        the series is not that long yet.
+        """
+        if k >= self.count or k >= len(self.values):
+            return NAN
+        return float(self.values[(self.count - 1 - k) % len(self.values)])
+
+    def last(self, k):
+        """
+        The k latest values, oldest first: a view of the ring when they are
+        contiguous, else the concatenation of its two halves.
+        """
+        end = self.count % len(self.values)
+        if k <= end:
+            return self.values[end - k:end]
+        return np.concatenate([self.values[len(self.values) - (k - end):], self.values[:end]])
+
+
+def _window_sum(ring, window, square=False):
+    """
+    Sum (or sum of squares) of the last `window` values of a ring, NaN while
+    the series is shorter than the window or when the window holds a NaN.
+
+    The window is summed from the ring on every update in the order numpy
+    sums the sliding windows of feature_engineer._rolling_sum, so the result
+    is bit-identical to the batch features; running sums would drift from
+    them by rounding. The cost is O(window) per bar.
+    """
+    if ring.count < window:
+        return NAN
+    values = ring.last(window)
+    return float(np.sum(values * values if square else values))
+
+
+class _TickerState:
+    def __init__(self, max_window, lag_sizes):
+        self.count = 0
+        self.prices = _Ring(max_window)
+        self.gains = _Ring(max_window)
+        self.losses = _Ring(max_window)
+        self.returns = _Ring(max_window)
+        self.columns = {col: _Ring(size) for col, size in lag_sizes.items()}
+
+
+class StreamingFeatureEngine:
+    """
+    Keep per-ticker ring buffers of the last values so that every configured
+    feature is updated in O(window) when a new daily bar arrives, instead of
+    recomputing the full history with pandas.
+
+    The features are bit-identical to the batch feature_engineer functions
+    replayed on the same history: the trailing indicators of
+    compute_indicators ('ma', 'rsi', 'volatility'), 'pct_change' as in
+    data_cleaning.normalize_price, and the
+    lags and lag differences of build_lags. Forward-looking features (the
+    'return' indicator and leads) are not known when a bar arrives and are
+    rejected.
+    """
+
+    def __init__(self, indicators=(), lags=None, diffs=None, n_lag=7, price_column='Adj Close'):
+        for spec in indicators:
+            if spec['type'] not in ('ma', 'rsi', 'volatility'):
+                raise ValueError(f"indicator type {spec['type']} can not be computed incrementally.")
+        self.indicators = list(indicators)
+        self.lags = _shift_spec(lags, n_lag)
+        self.diffs = _shift_spec(diffs, n_lag)
+        self.price_column = price_column
+
+        self.max_window = max([spec['window'] for spec in self.indicators] + [1])
+        self.lag_sizes = {}
+        for spec in (self.lags, self.diffs):
+            for col, shifts in spec.items():
+                self.lag_sizes[col] = max([self.lag_sizes.get(col, 1)] + list(shifts))
+        self.states = {}
+
+    def update(self, ticker, bar):
+        """
+        Update the state of a ticker with a new bar and return its features.
+
+        Args:
+            ticker (str): Ticker of the bar.
+            bar (dict): Field values of the bar, at least the price column and
+                the columns to lag ('pct_change' is derived from the price if
+                missing).
+
+        Returns:
+            features (dict): Feature name to value for this bar.
+        """
+        state = self.states.get(ticker)
+        if state is None:
+            state = self.states[ticker] = _TickerState(self.max_window, self.lag_sizes)
+
+        price = float(bar[self.price_column])
+        prev_price = state.prices.back(0)
+        if state.count == 0 or math.isnan(prev_price) or math.isnan(price):
+            ret = NAN
+        elif prev_price == 0:
+            ret = math.copysign(math.inf, price) if price else NAN
+        else:
+            ret = price / prev_price - 1
+        delta = price - prev_price
+        # like Series.where, NaN deltas count as no gain and no loss
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+
+        state.prices.push(price)
+        state.gains.push(gain)
+        state.losses.push(loss)
+        state.returns.push(ret)
+        state.count += 1
+
+        features = {'pct_change': ret * 100}
+        for spec in self.indicators:
+            window = spec['window']
+            if spec['type'] == 'ma':
+                value = _window_sum(state.prices, window) / window
+            elif spec['type'] == 'rsi':
+                gains = _window_sum(state.gains, window)
+                losses = _window_sum(state.losses, window)
+                if math.isnan(gains) or math.isnan(losses) or gains == losses == 0:
+                    value = NAN
+                elif losses == 0:
+                    value = 100.0
+                else:
+                    value = 100 - (100 / (1 + gains / losses))
+            else:
+                total = _window_sum(state.returns, window)
+                total_sq = _window_sum(state.returns, window, square=True)
+                variance = (total_sq - total ** 2 / window) / (window - 1)
+                value = NAN if math.isnan(total) else math.sqrt(max(variance, 0))
+            features[indicator_name(spec)] = value
+
+        for col, ring in state.columns.items():
+            value = float(bar[col]) if col in bar else features.get(col, NAN)
+            for i in self.lags.get(col, []):
+                features[f'{col}_lag_{i}'] = ring.back(i - 1)
+            for i in self.diffs.get(col, []):
+                features[f'{col}_diff_{i}'] = value - ring.back(i - 1)
+            ring.push(value)
+        return features
+
+    def update_many(self, data, date_column='Date'):
+        """
+        Replay a long-format frame bar by bar, in (Date, row) order.
+
+        Returns:
+            features (pandas.DataFrame): Features aligned to data.index.
+        """
+        dates = data[date_column] if date_column in data.columns else data.index
+        order = pd.Series(pd.to_datetime(dates).to_numpy()).sort_values(kind='stable').index
+        tickers = data['Ticker'].to_numpy()
+        records = data.to_dict('records')
+        features = [None] * len(data)
+        for i in order:
+            features[i] = self.update(tickers[i], records[i])
+        return pd.DataFrame(features, index=data.index)
+
+    def snapshot(self, file_path):
+        """
+        Save the state of every ticker to disk.
+        """
+        log(f'Saving feature state of {len(self.states)} tickers to {file_path}')
+        save_file(self, file_path)
+
+    @staticmethod
+    def restore(file_path):
+        """
+        Load a StreamingFeatureEngine saved with snapshot.
+        """
+        return load_file(file_path)
@@ -1,26 +1,94 @@
 """
 download market data from yahoo finance to local
 """
-import json
 import yfinance as yf
 import os
 import pandas as pd
-from tqdm import tqdm
-from utilities.util import log, load_config, save_file
+from utilities.util import log, load_config, save_file, iter_file_chunks
+from data_preparation.market_store import MarketDataStore, fetch_in_batches
+from data_preparation.earnings_fetcher import EarningsFetcher
+from data_preparation.panel import PricePanel
+from data_preparation.universe import UniverseIndex
 from urllib.request import urlretrieve
-import requests
+
+EARNINGS_URL = "https://query1.finance.yahoo.com/v1/finance/visualization?crumb=3ytadF1OTRB&lang=en-US&region=US&corsDomain=finance.yahoo.com"
+
+
+def download_yfinance(tickers, start_date, end_date):
+    """
+    Download daily market data from yahoo finance in long format.
+
+    Returns:
+        data (pandas.DataFrame): One row per (Ticker, Date) with the price fields
+            as columns, rows without any price dropped.
+    """
+    data = yf.download(' '.join(tickers), 
+                       start=start_date, 
+                       end=end_date,
+                       group_by='column',
+                       threads=False,
+                       progress=False)
+
+    # (Date) x (Price, Ticker) -> (Ticker, Date) x (Price)
+    data = data.stack(level='Ticker', future_stack=True)\
+               .dropna(how='all')\
+               .swaplevel()\
+               .sort_index()
+    data.columns.name = None
+    data = data.reset_index()
+    data['Date'] = data['Date'].dt.tz_localize(None).dt.normalize()
+    return data
+
+
+def write_batches(batches, file_path):
+    """
+    Stream DataFrames with the same columns into a single csv, Parquet or
+    Feather file without holding more than one batch in memory.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    file_type = os.path.splitext(file_path)[-1]
+    tmp_path = file_path + '.tmp'
+    columns, schema, writer = None, None, None
+    try:
+        for data in batches:
+            if columns is None:
+                columns = list(data.columns)
+            data = data.reindex(columns=columns)
+            if file_type == '.csv':
+                data.to_csv(tmp_path, mode='w' if writer is None else 'a',
+                            header=writer is None, index=False)
+                writer = True
+                continue
+
+            table = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                if file_type == '.parquet':
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                elif file_type in ('.feather', '.arrow'):
+                    writer = pa.ipc.new_file(tmp_path, schema)
+                else:
+                    raise TypeError(f'file type {file_type} not recognized.')
+            writer.write_table(table)
+    finally:
+        if writer not in (None, True):
+            writer.close()
+    os.replace(tmp_path, file_path)
 
 
 class MarketDataDownloader:
-    def __init__(self, config_path='config.yaml'):
+    def __init__(self, config_path='config.yaml', provider=download_yfinance):
         self.config = load_config(config_path)
+        self.provider = provider
         self.data_dir = self.config['data_dir']
         self.start_date = self.config['start_date']
         self.cutoff_date = self.config['cutoff_date']
         self.end_date = self.config['end_date']
 
         self.tickers = None
-        self.data = None
 
     def fetch_and_save_nasdaq_ticker_list(self):
         if not os.path.exists(self.data_dir):
@@ -45,52 +113,90 @@ class MarketDataDownloader:
         self.tickers = tickers
         log(f'{len(tickers)} tickers loaded')
 
+    def market_data_batches(self, columns):
+        """
+        The downloaded [start_date, end_date) market data as a fresh iterator
+        of DataFrames of at most market_data_chunk_rows rows, read from the
+        market data file or store without loading it whole.
+        """
+        chunk_rows = self.config['market_data_chunk_rows']
+        if self.config['market_data_sync'] == 'incremental':
+            store = MarketDataStore(self.config['market_data_store'])
+            return store.iter_batches(start_date=self.start_date,
+                                      end_date=pd.Timestamp(self.end_date) - pd.Timedelta(days=1),
+                                      columns=columns, chunk_rows=chunk_rows)
+        filename = os.path.join(self.data_dir,
+                                f"{self.start_date} to {self.end_date}.{self.config['storage_format']}")
+        return iter_file_chunks(filename, columns=columns, chunk_rows=chunk_rows)
+
+    def build_price_panel(self):
+        """
+        Build the PricePanel of the downloaded market data batch by batch,
+        memory-mapped in price_panel_dir when it is set.
+        """
+        fields = self.config['price_panel_fields']
+        if not self.config['price_panel_dir']:
+            fields = ['Adj Close', 'Volume']
+        return PricePanel.from_batches(lambda: self.market_data_batches(['Date', 'Ticker'] + list(fields)),
+                                       fields=fields, panel_dir=self.config['price_panel_dir'] or None)
+
+    def select_tickers(self):
+        """
+        Build the point-in-time liquidity universe of the downloaded data and
+        save the tickers that are ever in it, for the earnings download.
+        """
+        panel = self.build_price_panel()
+        universe = UniverseIndex.build(panel, rules=self.config['universe_rules'])
+        universe.save(self.config['universe_path'])
+
+        df_selected_tickers = pd.DataFrame({'Ticker': universe.ever_members()})
+        save_file(data=df_selected_tickers,
+                  file_path='data/market_data/selected_tickers.csv',
+                  index=False)
+        self.selected_tickers = df_selected_tickers.Ticker.tolist()
+
     def download_market_data(self):
+        if self.config['market_data_sync'] == 'incremental':
+            return self.sync_market_data()
+
         tickers = self.tickers
 
-        filename_short = self.start_date + ' to ' + self.end_date + '.csv'
+        filename_short = f"{self.start_date} to {self.end_date}.{self.config['storage_format']}"
         filename = os.path.join(self.data_dir, filename_short)
         if os.path.exists(filename):
-            log(f'File {filename} already exists, loading data from file...')
-            self.data = pd.read_csv(filename)
-            df_selected_tickers = df_trade.query('Date == "2024-01-04"')\
-                                          .dropna(subset='Volume')\
-                                          .query('Volume > 10000')\
-                                          .query('Volume * `Adj Close` > 500000')\
-                                          .Ticker.to_frame()
-
-            save_file(data=df_selected_tickers,
-                      file_path='data/market_data/selected_tickers.csv',
-                      index=False)
-            self.selected_tickers = df_selected_tickers.Ticker.tolist()
-            return self.data
+            log(f'File {filename} already exists')
+            self.select_tickers()
+            return
 
         log(f'Downloading market data from {self.start_date} to {self.end_date}...')
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
 
-        data = yf.download(' '.join(tickers), 
-                           start=self.start_date, 
-                           end=self.end_date)
+        batches = fetch_in_batches(self.provider, tickers, self.start_date, self.end_date,
+                                   batch_size=self.config['download_batch_size'],
+                                   max_workers=self.config['download_workers'])
+        write_batches(batches, filename)
 
-        log(f'Downloading completed, saving file to {filename}...')
+        log(f'Downloading completed, data saved to {filename}')
+        self.select_tickers()
 
-        data.index = data.index.map(lambda x: str(x.date()))
+    def sync_market_data(self):
+        """
+        Incrementally sync the per-ticker market data store; the configured
+        [start_date, end_date) window is then read from it batch by batch.
 
-        # put in better format
-        data = data.reset_index().melt(id_vars='Date')
-        data = data.pivot(index=['Ticker', 'Date'],
-                          columns=['Price']).reset_index()
-        data.columns = data.columns.map(lambda x: x[-1] if x[-1] else x[0])
-        save_file(data=data, file_path=filename, index=False)
-        self.data = data
+        Only the missing tail of stored tickers and the full history of new
+        tickers are fetched from the provider.
+        """
+        store = MarketDataStore(self.config['market_data_store'])
+        store.sync(self.tickers, self.start_date, self.end_date, provider=self.provider,
+                   batch_size=self.config['download_batch_size'],
+                   max_workers=self.config['download_workers'])
+        self.select_tickers()
 
-        return self.data
-
-    def fetch_earnings_data(self):
+    def fetch_earnings_data(self, url=EARNINGS_URL):
         log('Fetching earnings data...')
         tickers = self.selected_tickers
-        url = "https://query1.finance.yahoo.com/v1/finance/visualization?crumb=3ytadF1OTRB&lang=en-US&region=US&corsDomain=finance.yahoo.com"
 
         headers = {
             "Content-Type": "application/json",
@@ -108,8 +214,8 @@ class MarketDataDownloader:
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
         }
 
-        for ticker in tqdm(tickers):
-            payload = {
+        def build_payload(ticker):
+            return {
                 "sortType": "DESC",
                 "entityIdType": "earnings",
                 "sortField": "startdatetime",
@@ -128,25 +234,25 @@ class MarketDataDownloader:
                 "size": 100
             }
 
-            response = requests.post(url,
-                                     headers=headers,
-                                     data=json.dumps(payload))
-
-            if response.status_code == 200:
-                data = response.json()
-                columns = data['finance']['result'][0]['documents'][0]['columns']
-                columns = [x['label'] for x in columns]
+        def parse_response(response):
+            data = response.json()
+            columns = data['finance']['result'][0]['documents'][0]['columns']
+            columns = [x['label'] for x in columns]
 
-                df_temp = pd.DataFrame(data['finance']['result'][0]['documents'][0]['rows'], columns=columns)
+            return pd.DataFrame(data['finance']['result'][0]['documents'][0]['rows'], columns=columns)
 
-                save_file(data=df_temp,
-                          file_path=f"data/eps_data/{ticker}.csv",
-                          index=False)
+        fetcher = EarningsFetcher(url=url,
+                                  headers=headers,
+                                  out_dir=self.config['eps_data_dir'],
+                                  run_key=self.end_date,
+                                  max_workers=self.config['earnings_workers'],
+                                  rate=self.config['earnings_rate_limit'],
+                                  max_retries=self.config['earnings_max_retries'],
+                                  batch_size=self.config['earnings_batch_size'])
+        return fetcher.fetch_all(tickers, build_payload, parse_response)
 
-            else:
-                log(f"Failed to retrieve data for {ticker}, status code:", response.status_code)
 
-if __name__ == "__main__":
+def download_main():
     # Initialize downloader with default config path
     downloader = MarketDataDownloader()
 
@@ -156,9 +262,23 @@ if __name__ == "__main__":
     # Read the NASDAQ tickers from the local file
     downloader.read_nasdaq_ticker_list()
 
-    # Download market data for the first 10 tickers as a sample
+    # Download market data and select the in-scope tickers
+    downloader.download_market_data()
+    return downloader
 
-    df_trade = downloader.download_market_data()
 
-    # Fetch earnings data for the first 10 tickers as a sample
+def earnings_main():
+    downloader = MarketDataDownloader()
+    downloader.selected_tickers = pd.read_csv('data/market_data/selected_tickers.csv')['Ticker'].tolist()
     downloader.fetch_earnings_data()
+
+
+def main():
+    downloader = download_main()
+
+    # Fetch earnings data for the selected tickers
+    downloader.fetch_earnings_data()
+
+
+if __name__ == "__main__":
+    main()
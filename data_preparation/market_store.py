@@ -0,0 +1,355 @@
+"""
+per-ticker partitioned local store of daily market data with incremental sync
+"""
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+from utilities.util import log
+
+PART_PATTERN = re.compile(r'^part-(\d{8})-(\d{8})\.parquet$')
+SINCE_PATTERN = re.compile(r'^_since-(\d{8})$')
+
+
+def fetch_in_batches(provider, tickers, start_date, end_date, batch_size=200, max_workers=1):
+    """
+    Call the provider on batches of tickers and yield the results as they complete.
+
+    At most max_workers batches are in flight at any time (each in its own
+    process, since yfinance keeps module-level download state), so peak memory
+    is bounded by the batch size rather than the universe size.
+
+    Args:
+        provider (callable): provider(tickers, start_date, end_date) returning
+            long-format market data.
+        tickers (list): Tickers to fetch.
+        start_date (str): Start date of the fetch.
+        end_date (str): End date of the fetch (exclusive).
+        batch_size (int): Number of tickers per provider call.
+        max_workers (int): Number of batches fetched concurrently.
+
+    Yields:
+        data (pandas.DataFrame): Long-format market data of one batch.
+    """
+    batches = [tickers[i:i + batch_size] for i in range(0, len(tickers), batch_size)]
+    if max_workers <= 1:
+        for batch in batches:
+            yield provider(batch, start_date, end_date)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        batches = iter(batches)
+        running = set()
+        while True:
+            for batch in batches:
+                running.add(executor.submit(provider, batch, start_date, end_date))
+                if len(running) >= max_workers:
+                    break
+            if not running:
+                return
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+class MarketDataStore:
+    """
+    Long-format (Ticker, Date, fields...) market data stored as
+    '<store_dir>/Ticker=<ticker>/part-<first date>-<last date>.parquet'.
+
+    Every append writes a new part file under a temporary name and renames it
+    into place, so a crash never leaves a half-written part behind. The first
+    and last stored dates of every ticker are recorded in its part file
+    names, and the earliest date its history was fetched from in an empty
+    '_since-<date>' marker file (which pyarrow skips like other '_' files).
+    """
+
+    def __init__(self, store_dir='data/market_data/store'):
+        self.store_dir = store_dir
+
+    def _ticker_dir(self, ticker):
+        return os.path.join(self.store_dir, 'Ticker=' + quote(str(ticker), safe=''))
+
+    def date_ranges(self):
+        """
+        Return a dict mapping every stored ticker to its (first, last) stored date.
+        """
+        date_ranges = {}
+        if not os.path.exists(self.store_dir):
+            return date_ranges
+
+        for dir_name in os.listdir(self.store_dir):
+            if not dir_name.startswith('Ticker='):
+                continue
+            parts = [PART_PATTERN.match(file_name)
+                     for file_name in os.listdir(os.path.join(self.store_dir, dir_name))]
+            parts = [match for match in parts if match]
+            if parts:
+                date_ranges[unquote(dir_name[len('Ticker='):])] = (
+                    pd.Timestamp(min(match.group(1) for match in parts)),
+                    pd.Timestamp(max(match.group(2) for match in parts)))
+        return date_ranges
+
+    def fetched_since(self):
+        """
+        Return a dict mapping every stored ticker to the earliest start date
+        its history was fetched from, which is before its first stored date
+        when the ticker was listed later.
+        """
+        since = {}
+        for ticker in self.date_ranges():
+            markers = [SINCE_PATTERN.match(file_name) for file_name in os.listdir(self._ticker_dir(ticker))]
+            markers = [match for match in markers if match]
+            if markers:
+                since[ticker] = pd.Timestamp(min(match.group(1) for match in markers))
+        return since
+
+    def mark_fetched_since(self, tickers, start_date):
+        """
+        Record that the stored history of these tickers was fetched from start_date.
+        """
+        marker = '_since-{:%Y%m%d}'.format(pd.Timestamp(start_date))
+        for ticker in tickers:
+            ticker_dir = self._ticker_dir(ticker)
+            if not os.path.isdir(ticker_dir):
+                continue
+            open(os.path.join(ticker_dir, marker), 'w').close()
+            for file_name in os.listdir(ticker_dir):
+                if SINCE_PATTERN.match(file_name) and file_name != marker:
+                    os.remove(os.path.join(ticker_dir, file_name))
+
+    def last_dates(self):
+        """
+        Return a dict mapping every stored ticker to its last stored date.
+        """
+        return {ticker: last for ticker, (_, last) in self.date_ranges().items()}
+
+    def remove(self, ticker):
+        """
+        Delete all stored data of a ticker.
+        """
+        shutil.rmtree(self._ticker_dir(ticker), ignore_errors=True)
+
+    def stored_bar(self, ticker, date):
+        """
+        Stored row of a ticker on a stored date, as a Series.
+        """
+        ticker_dir = self._ticker_dir(ticker)
+        day = pd.Timestamp(date).strftime('%Y%m%d')
+        part = next(file_name for file_name in os.listdir(ticker_dir)
+                    if (match := PART_PATTERN.match(file_name)) and match.group(1) <= day <= match.group(2))
+        df_part = pd.read_parquet(os.path.join(ticker_dir, part))
+        return df_part[pd.to_datetime(df_part['Date']) == pd.Timestamp(date)].iloc[-1]
+
+    def changed_history(self, data, dates, columns=('Adj Close',), rtol=1e-6):
+        """
+        Tickers whose fetched bar on a stored date differs from the stored
+        one. Adjusted prices are restated over the whole history after a
+        dividend or split, so for these tickers the stored history is on a
+        different adjustment basis than newly fetched data.
+
+        Args:
+            data (pandas.DataFrame): Fetched data that overlaps the stored
+                history of its tickers on one date.
+            dates (dict): Stored date of every ticker compared.
+            columns (tuple): Columns compared.
+            rtol (float): Relative tolerance of the comparison.
+
+        Returns:
+            changed (list): Tickers whose history has to be refetched.
+        """
+        changed = []
+        data = data.assign(Date=pd.to_datetime(data['Date']))
+        for ticker, df_ticker in data.groupby('Ticker', sort=False, observed=True):
+            if ticker not in dates:
+                continue
+            overlap = df_ticker[df_ticker['Date'] == dates[ticker]]
+            if overlap.empty:
+                continue
+            stored = self.stored_bar(ticker, dates[ticker])
+            fetched = overlap.iloc[-1]
+            compared = [col for col in columns if col in fetched.index and col in stored.index]
+            if not np.allclose(fetched[compared].to_numpy(dtype='float64'),
+                               stored[compared].to_numpy(dtype='float64'),
+                               rtol=rtol, equal_nan=True):
+                changed.append(ticker)
+        return changed
+
+    def append(self, data):
+        """
+        Append long-format market data, keeping only the rows of every ticker
+        that are newer than its last stored date.
+
+        Args:
+            data (pandas.DataFrame): Market data with 'Ticker' and 'Date' columns.
+        """
+        self._write(data, prepend=False)
+
+    def prepend(self, data):
+        """
+        Add long-format market data before the stored history, keeping only
+        the rows of every ticker that are older than its first stored date.
+
+        Args:
+            data (pandas.DataFrame): Market data with 'Ticker' and 'Date' columns.
+        """
+        self._write(data, prepend=True)
+
+    def _write(self, data, prepend):
+        if data.empty:
+            return
+
+        data = data.assign(Date=pd.to_datetime(data['Date']))
+        date_ranges = self.date_ranges()
+        for ticker, df_ticker in data.groupby('Ticker', sort=False, observed=True):
+            if ticker in date_ranges:
+                first_date, last_date = date_ranges[ticker]
+                df_ticker = df_ticker[(df_ticker['Date'] < first_date) if prepend
+                                      else (df_ticker['Date'] > last_date)]
+            df_ticker = df_ticker.dropna(subset=['Date']).sort_values('Date')
+            if df_ticker.empty:
+                continue
+
+            ticker_dir = self._ticker_dir(ticker)
+            os.makedirs(ticker_dir, exist_ok=True)
+            part_name = 'part-{:%Y%m%d}-{:%Y%m%d}.parquet'.format(df_ticker['Date'].iloc[0],
+                                                                  df_ticker['Date'].iloc[-1])
+            tmp_path = os.path.join(ticker_dir, '.' + part_name + '.tmp')
+            df_ticker.drop(columns='Ticker').to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, os.path.join(ticker_dir, part_name))
+
+    def _dataset(self, start_date=None, end_date=None, tickers=None):
+        """
+        Pyarrow dataset of the store and the filter expression of a window.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        partitioning = ds.partitioning(pa.schema([('Ticker', pa.string())]), flavor='hive')
+        dataset = ds.dataset(self.store_dir, format='parquet', partitioning=partitioning)
+        expression = None
+        for condition in [None if start_date is None else ds.field('Date') >= pd.Timestamp(start_date),
+                          None if end_date is None else ds.field('Date') <= pd.Timestamp(end_date),
+                          None if tickers is None else ds.field('Ticker').isin(list(tickers))]:
+            if condition is not None:
+                expression = condition if expression is None else expression & condition
+        return dataset, expression
+
+    def read(self, start_date=None, end_date=None, tickers=None, columns=None):
+        """
+        Read an arbitrary [start_date, end_date] window from the store.
+
+        Args:
+            start_date (str): Optional first date (inclusive).
+            end_date (str): Optional last date (inclusive).
+            tickers (list): Optional tickers to read, defaults to all.
+            columns (list): Optional columns to read, defaults to all.
+
+        Returns:
+            data (pandas.DataFrame): Long-format market data sorted by
+                (Ticker, Date).
+        """
+        dataset, expression = self._dataset(start_date, end_date, tickers)
+        data = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        if 'Ticker' in data.columns:
+            data['Ticker'] = data['Ticker'].astype(str)
+        sort_columns = [c for c in ['Ticker', 'Date'] if c in data.columns]
+        return data.sort_values(sort_columns, ignore_index=True)
+
+    def iter_batches(self, start_date=None, end_date=None, tickers=None, columns=None,
+                     chunk_rows=1_000_000):
+        """
+        Stream a [start_date, end_date] window of the store as DataFrames of at
+        most chunk_rows rows, in no particular order, without loading it whole.
+        """
+        dataset, expression = self._dataset(start_date, end_date, tickers)
+        for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunk_rows):
+            if batch.num_rows == 0:
+                continue
+            data = batch.to_pandas()
+            if 'Ticker' in data.columns:
+                data['Ticker'] = data['Ticker'].astype(str)
+            yield data
+
+    def sync(self, tickers, start_date, end_date, provider, batch_size=200, max_workers=1,
+             compare_columns=('Adj Close',)):
+        """
+        Bring the store up to date for the given tickers.
+
+        Tickers already in the store have their missing tail fetched starting
+        at their last stored date, and when start_date is before their first
+        stored date, the missing head fetched up to that date. When such an
+        overlapping bar no longer matches the stored one (the adjusted history
+        was restated after a dividend or split), the ticker's history is
+        deleted and fetched again in full. Newly listed tickers are fetched
+        from start_date. Tickers that share a fetch window are fetched
+        together, in batches that are written to the store as soon as they
+        arrive.
+
+        Args:
+            tickers (list): Tickers to sync.
+            start_date (str): First date of the stored history.
+            end_date (str): End date of the fetch (exclusive, as in yfinance).
+            provider (callable): provider(tickers, start_date, end_date) returning
+                long-format market data with 'Ticker' and 'Date' columns.
+            batch_size (int): Number of tickers per provider call.
+            max_workers (int): Number of batches fetched concurrently.
+            compare_columns (tuple): Columns of the overlapping bar compared.
+        """
+        date_ranges = self.date_ranges()
+        last_dates = {ticker: last for ticker, (_, last) in date_ranges.items()}
+        first_dates = {ticker: first for ticker, (first, _) in date_ranges.items()}
+        fetched_since = self.fetched_since()
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        fetch_starts, head_ends = {}, {}
+        for ticker in tickers:
+            if ticker in last_dates:
+                if start < min(first_dates[ticker], fetched_since.get(ticker, first_dates[ticker])):
+                    head_ends.setdefault(first_dates[ticker], []).append(ticker)
+                fetch_start = last_dates[ticker]
+                if fetch_start + pd.Timedelta(days=1) >= end:
+                    continue
+            else:
+                fetch_start = start
+            if fetch_start < end:
+                fetch_starts.setdefault(fetch_start, []).append(ticker)
+
+        log(f'Syncing market data: {sum(map(len, fetch_starts.values()))} of '
+            f'{len(tickers)} tickers need data up to {end_date}, '
+            f'{sum(map(len, head_ends.values()))} need data from {start_date}')
+        restated = []
+        # heads are fetched up to and including the first stored date, the overlapping bar
+        for first_date, group in sorted(head_ends.items()):
+            head_end = (first_date + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+            for data in fetch_in_batches(provider, group, start_date, head_end,
+                                         batch_size=batch_size, max_workers=max_workers):
+                changed = self.changed_history(data, first_dates, columns=compare_columns)
+                restated += changed
+                self.prepend(data[~data['Ticker'].isin(changed)])
+                self.mark_fetched_since([ticker for ticker in group if ticker not in changed], start)
+        for fetch_start, group in sorted(fetch_starts.items()):
+            for data in fetch_in_batches(provider, group, fetch_start.strftime('%Y-%m-%d'), end_date,
+                                         batch_size=batch_size, max_workers=max_workers):
+                changed = self.changed_history(data, last_dates, columns=compare_columns)
+                restated += changed
+                self.append(data[~data['Ticker'].isin(changed)])
+            if fetch_start == start:
+                self.mark_fetched_since([ticker for ticker in group if ticker not in last_dates], start)
+
+        if restated:
+            log(f'Refetching the full history of {len(restated)} tickers with restated prices')
+            refetch_starts = {}
+            for ticker in dict.fromkeys(restated):
+                fetch_start = min(date_ranges[ticker][0], start)
+                refetch_starts.setdefault(fetch_start, []).append(ticker)
+                self.remove(ticker)
+            for fetch_start, group in sorted(refetch_starts.items()):
+                for data in fetch_in_batches(provider, group, fetch_start.strftime('%Y-%m-%d'), end_date,
+                                             batch_size=batch_size, max_workers=max_workers):
+                    self.append(data)
+                self.mark_fetched_since(group, fetch_start)
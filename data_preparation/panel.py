@@ -0,0 +1,167 @@
+"""
+dense, memory-mapped (ticker x date x field) panel of market data
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from utilities.util import log
+
+PANEL_FIELDS = ['Adj Close', 'Volume']
+
+
+class PricePanel:
+    """
+    Market data as one float32 array of shape (tickers, dates, fields) with
+    index maps for the tickers, the trading calendar and the fields.
+
+    The array is ticker-major, so the history of one ticker, and any date range
+    of it, is a contiguous zero-copy view. Saved panels are plain .npy files
+    opened with np.load(mmap_mode='r'): worker processes that load the same
+    panel directory share the pages of the file instead of receiving pickled
+    copies.
+    """
+
+    def __init__(self, values, tickers, dates, fields):
+        self.values = values
+        self.tickers = list(tickers)
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.fields = list(fields)
+        self.ticker_index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+
+    @classmethod
+    def from_long(cls, data, fields=PANEL_FIELDS, dtype='float32', panel_dir=None):
+        """
+        Build a panel from long-format (Date, Ticker, fields...) data. Missing
+        (ticker, date) pairs are NaN. With panel_dir the array is filled
+        directly in a memory-mapped file, saved there and reopened read-only.
+        """
+        return cls.from_batches(lambda: iter([data]), fields=fields, dtype=dtype, panel_dir=panel_dir)
+
+    @classmethod
+    def from_batches(cls, batches, fields=PANEL_FIELDS, dtype='float32', panel_dir=None):
+        """
+        Build a panel from long-format data streamed in batches, holding one
+        batch at a time: a first pass collects the tickers and the calendar,
+        a second scatters every batch into the (memory-mapped) array.
+
+        Args:
+            batches (callable): batches() returning a fresh iterator of
+                (Date, Ticker, fields...) DataFrames; called twice.
+            fields (list): Fields of the panel.
+            dtype (str): dtype of the values.
+            panel_dir (str): Optional directory to fill, save and reopen the
+                panel in, memory-mapped.
+        """
+        tickers, calendar = set(), np.array([], dtype='datetime64[ns]')
+        for data in batches():
+            tickers.update(data['Ticker'].astype(str).unique())
+            calendar = np.union1d(calendar, pd.to_datetime(data['Date']).to_numpy(dtype='datetime64[ns]'))
+        tickers = pd.Index(sorted(tickers))
+        shape = (len(tickers), len(calendar), len(fields))
+        log(f'Building price panel of {shape[0]} tickers, {shape[1]} dates, {shape[2]} fields')
+
+        if panel_dir is None:
+            values = np.full(shape, np.nan, dtype=dtype)
+        else:
+            tmp_dir = panel_dir.rstrip('/') + '.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            values = np.lib.format.open_memmap(os.path.join(tmp_dir, 'values.npy'), mode='w+',
+                                               dtype=dtype, shape=shape)
+            values[:] = np.nan
+        for data in batches():
+            ticker_codes = tickers.get_indexer(data['Ticker'].astype(str))
+            date_codes = np.searchsorted(calendar, pd.to_datetime(data['Date']).to_numpy(dtype='datetime64[ns]'))
+            values[ticker_codes, date_codes] = data[list(fields)].to_numpy(dtype=dtype)
+        panel = cls(values, tickers, calendar, fields)
+        if panel_dir is None:
+            return panel
+
+        values.flush()
+        panel._save_index(tmp_dir)
+        del values, panel
+        shutil.rmtree(panel_dir, ignore_errors=True)
+        os.replace(tmp_dir, panel_dir)
+        return cls.load(panel_dir)
+
+    def _save_index(self, panel_dir):
+        index = {'tickers': self.tickers,
+                 'dates': [str(date) for date in self.dates.astype('datetime64[D]')],
+                 'fields': self.fields}
+        with open(os.path.join(panel_dir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+    def save(self, panel_dir):
+        """
+        Save the panel as '<panel_dir>/values.npy' and '<panel_dir>/index.json'.
+        """
+        tmp_dir = panel_dir.rstrip('/') + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'values.npy'), self.values)
+        self._save_index(tmp_dir)
+        shutil.rmtree(panel_dir, ignore_errors=True)
+        os.replace(tmp_dir, panel_dir)
+
+    @classmethod
+    def load(cls, panel_dir, mmap_mode='r'):
+        """
+        Open a saved panel, memory-mapped by default.
+        """
+        with open(os.path.join(panel_dir, 'index.json')) as f:
+            index = json.load(f)
+        values = np.load(os.path.join(panel_dir, 'values.npy'), mmap_mode=mmap_mode)
+        return cls(values, index['tickers'], index['dates'], index['fields'])
+
+    def date_range(self, start_date=None, end_date=None):
+        """
+        Slice of the calendar covering [start_date, end_date], both inclusive.
+        """
+        start = 0 if start_date is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start_date)))
+        end = len(self.dates) if end_date is None else \
+            np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end_date)), side='right')
+        return slice(int(start), int(end))
+
+    def ticker(self, ticker, start_date=None, end_date=None):
+        """
+        (dates, fields) view of one ticker over [start_date, end_date].
+        """
+        return self.values[self.ticker_index[ticker], self.date_range(start_date, end_date)]
+
+    def field(self, field):
+        """
+        (tickers, dates) view of one field.
+        """
+        return self.values[:, :, self.field_index[field]]
+
+    def window(self, start_date=None, end_date=None):
+        """
+        Panel of the dates in [start_date, end_date], sharing memory with this one.
+        """
+        dates = self.date_range(start_date, end_date)
+        return PricePanel(self.values[:, dates], self.tickers, self.dates[dates], self.fields)
+
+    def to_long(self, tickers=None, start_date=None, end_date=None, fields=None, dropna=True):
+        """
+        Long-format (Date, Ticker, fields...) data sorted by (Ticker, Date), as
+        read from MarketDataStore. Rows whose fields are all missing are dropped.
+        """
+        fields = self.fields if fields is None else list(fields)
+        tickers = self.tickers if tickers is None else list(tickers)
+        dates = self.date_range(start_date, end_date)
+        ticker_idx = np.array([self.ticker_index[ticker] for ticker in tickers], dtype='int64')
+        field_idx = [self.field_index[field] for field in fields]
+        block = self.values[ticker_idx][:, dates][:, :, field_idx]
+        n_dates = block.shape[1]
+
+        data = pd.DataFrame(block.reshape(-1, len(fields)), columns=fields)
+        data.insert(0, 'Ticker', np.repeat(np.asarray(tickers, dtype=object), n_dates))
+        data.insert(0, 'Date', np.tile(self.dates[dates], len(tickers)))
+        if dropna:
+            data = data[~np.isnan(block).all(axis=2).ravel()].reset_index(drop=True)
+        return data
@@ -0,0 +1,130 @@
+"""
+point-in-time liquidity universe stored as one membership bitset per date
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utilities.util import log
+
+DEFAULT_RULES = {'window': 20,
+                 'min_periods': 15,
+                 'min_volume': 10000,
+                 'min_dollar_volume': 500000,
+                 'min_price': 0}
+
+
+def _rolling_mean(values, window, min_periods):
+    """
+    Trailing NaN-aware mean over the last `window` dates of a (tickers, dates)
+    array, NaN where fewer than min_periods values are present.
+    """
+    present = ~np.isnan(values)
+    sums = np.cumsum(np.where(present, values, 0), axis=1, dtype='float64')
+    counts = np.cumsum(present, axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    counts[:, window:] = counts[:, window:] - counts[:, :-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts >= min_periods, sums / counts, np.nan)
+
+
+class UniverseIndex:
+    """
+    Which tickers pass the liquidity screens on each trading date, using only
+    data up to that date. Membership is a (dates, ceil(tickers / 8)) uint8
+    bitset, and rows of long-format data are filtered with one vectorized
+    lookup instead of a list-membership query.
+    """
+
+    def __init__(self, bits, tickers, dates, rules=None):
+        self.bits = bits
+        self.tickers = pd.Index(tickers)
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.rules = rules or {}
+
+    @classmethod
+    def build(cls, panel, rules=None, chunk_tickers=1024):
+        """
+        Evaluate the rules for every (ticker, date) of a PricePanel with
+        'Adj Close' and 'Volume' fields. A ticker is a member on a date when
+        its trailing average volume, average dollar volume and last price all
+        pass the thresholds. Tickers are processed in chunks to bound memory.
+        """
+        rules = {**DEFAULT_RULES, **(rules or {})}
+        chunk_tickers = max(8, chunk_tickers // 8 * 8)
+        n_tickers, n_dates = len(panel.tickers), len(panel.dates)
+        bits = np.zeros((n_dates, -(-n_tickers // 8)), dtype='uint8')
+        for start in range(0, n_tickers, chunk_tickers):
+            rows = slice(start, min(start + chunk_tickers, n_tickers))
+            price = panel.field('Adj Close')[rows].astype('float64')
+            volume = panel.field('Volume')[rows].astype('float64')
+            avg_volume = _rolling_mean(volume, rules['window'], rules['min_periods'])
+            avg_dollar_volume = _rolling_mean(volume * price, rules['window'], rules['min_periods'])
+            with np.errstate(invalid='ignore'):
+                member = ((avg_volume > rules['min_volume'])
+                          & (avg_dollar_volume > rules['min_dollar_volume'])
+                          & (price >= rules['min_price']))
+            # chunks are a multiple of 8 tickers, so they fill whole bytes
+            bits[:, start // 8:start // 8 + -(-member.shape[0] // 8)] = np.packbits(member.T, axis=1)
+        universe = cls(bits, panel.tickers, panel.dates, rules)
+        log(f'Universe of {len(universe.ever_members())} tickers, '
+            f'{universe.sizes().mean():.0f} members per date on average')
+        return universe
+
+    def save(self, file_path):
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        tmp_path = file_path + '.tmp.npz'
+        np.savez(tmp_path, bits=self.bits, tickers=np.asarray(self.tickers, dtype=str),
+                 dates=self.dates, rules=json.dumps(self.rules))
+        os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data['bits'], data['tickers'].tolist(), data['dates'],
+                       json.loads(str(data['rules'])))
+
+    def mask(self, tickers, dates):
+        """
+        Membership of (ticker, date) pairs as of each date, i.e. on the latest
+        universe date not after it; False for unknown tickers and for dates
+        before the universe starts.
+        """
+        ticker_idx = self.tickers.get_indexer(pd.Index(tickers).astype(str))
+        date_idx = np.searchsorted(self.dates, pd.to_datetime(dates).to_numpy(), side='right') - 1
+        known = (ticker_idx >= 0) & (date_idx >= 0)
+        ticker_idx, date_idx = np.maximum(ticker_idx, 0), np.maximum(date_idx, 0)
+        member = (self.bits[date_idx, ticker_idx >> 3] >> (7 - (ticker_idx & 7))) & 1
+        return known & member.astype(bool)
+
+    def filter(self, data, date_column='Date'):
+        """
+        Rows of long-format data whose ticker is in the universe on their date.
+        """
+        dates = data[date_column] if date_column in data.columns else data.index
+        return data[self.mask(data['Ticker'], dates)]
+
+    def members(self, date):
+        """
+        Tickers in the universe as of a date.
+        """
+        date_idx = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)), side='right') - 1
+        if date_idx < 0:
+            return []
+        member = np.unpackbits(self.bits[date_idx])[:len(self.tickers)].astype(bool)
+        return self.tickers[member].tolist()
+
+    def ever_members(self):
+        """
+        Tickers that are in the universe on at least one date.
+        """
+        ever = np.unpackbits(np.bitwise_or.reduce(self.bits, axis=0))[:len(self.tickers)].astype(bool)
+        return self.tickers[ever].tolist()
+
+    def sizes(self):
+        """
+        Number of members on each date.
+        """
+        return np.unpackbits(self.bits, axis=1)[:, :len(self.tickers)].sum(axis=1)
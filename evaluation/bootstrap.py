@@ -0,0 +1,121 @@
+"""
+date-level and block bootstrap confidence intervals of the evaluation metrics
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+METRICS = ['RMSE', 'MAE', 'MAPE', 'R2', 'Correct sign pct']
+
+
+def date_statistics(data, target, date_column='Date'):
+    """
+    Per-date sufficient statistics of the metrics: row count, sums of squared,
+    absolute and absolute percentage errors, sums of the target and of its
+    square, and the number of rows with the correct sign. The metrics of any
+    resample of dates follow from count-weighted sums of these rows.
+
+    Returns:
+        stats (numpy.ndarray): (dates, 7) array in date order.
+    """
+    dates = data[date_column] if date_column in data.columns else data.index.to_series()
+    y_true = data[target].to_numpy(dtype='float64')
+    y_pred = data[f'Predictions_{target}'].to_numpy(dtype='float64')
+    valid = ~(np.isnan(y_true) | np.isnan(y_pred))
+    y_true, y_pred = y_true[valid], y_pred[valid]
+    _, date_codes = np.unique(dates.to_numpy()[valid], return_inverse=True)
+
+    error = y_true - y_pred
+    # as sklearn's mean_absolute_percentage_error
+    ape = np.abs(error) / np.maximum(np.abs(y_true), np.finfo(np.float64).eps)
+    columns = [np.ones_like(y_true), error ** 2, np.abs(error), ape,
+               y_true, y_true ** 2, (y_true * y_pred > 0).astype('float64')]
+    return np.column_stack([np.bincount(date_codes, weights=column) for column in columns])
+
+
+def metrics_from_statistics(stats):
+    """
+    Metrics from summed statistics, one row of metrics per row of stats.
+    """
+    n, sse, sae, sape, sy, syy, n_correct = np.atleast_2d(stats).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.column_stack([np.sqrt(sse / n),
+                                sae / n,
+                                sape / n,
+                                1 - sse / (syy - sy ** 2 / n),
+                                n_correct / n * 100])
+
+
+def resample_dates(rng, n_replicates, n_dates, mode='date', block_size=20):
+    """
+    Resampled date indices as an (n_replicates, n_dates) integer array.
+    'date' draws dates with replacement, 'block' draws moving blocks of
+    block_size consecutive dates so that serial correlation is kept.
+    """
+    if mode == 'date':
+        return rng.integers(0, n_dates, size=(n_replicates, n_dates))
+    if mode == 'block':
+        block_size = min(block_size, n_dates)
+        n_blocks = -(-n_dates // block_size)
+        starts = rng.integers(0, n_dates - block_size + 1, size=(n_replicates, n_blocks))
+        indices = starts[:, :, None] + np.arange(block_size)
+        return indices.reshape(n_replicates, -1)[:, :n_dates]
+    raise ValueError(f'bootstrap mode {mode} not recognized.')
+
+
+def _bootstrap_chunk(stats, n_replicates, mode, block_size, seed):
+    """
+    Metrics of a chunk of replicates: the resample indices become a
+    (replicates, dates) count matrix, and one matrix product gives the summed
+    statistics of every replicate.
+    """
+    rng = np.random.default_rng(seed)
+    n_dates = len(stats)
+    indices = resample_dates(rng, n_replicates, n_dates, mode, block_size)
+    offsets = np.arange(n_replicates)[:, None] * n_dates
+    counts = np.bincount((indices + offsets).ravel(), minlength=n_replicates * n_dates)
+    return metrics_from_statistics(counts.reshape(n_replicates, n_dates) @ stats)
+
+
+def bootstrap_metrics(data, target, n_replicates=1000, mode='block', block_size=20, alpha=0.05,
+                      chunk_size=250, n_workers=None, seed=0, date_column='Date'):
+    """
+    Bootstrap confidence intervals of RMSE, MAE, MAPE, R2 and the correct-sign
+    percentage, resampling whole dates so that rows of the same day stay
+    together. Replicates are processed in chunks of chunk_size to bound
+    memory, and the chunks run in a process pool when there are several.
+
+    Args:
+        data (pandas.DataFrame): Data with Date, the target and its predictions.
+        target (str): Target column.
+        n_replicates (int): Number of bootstrap replicates.
+        mode (str): 'date' or 'block' (moving blocks of consecutive dates).
+        block_size (int): Dates per block of the 'block' mode.
+        alpha (float): The intervals cover 1 - alpha.
+        chunk_size (int): Replicates computed at once.
+        n_workers (int): Worker processes, None for all CPUs, 1 to run inline.
+        seed (int): Seed of the resampling.
+
+    Returns:
+        df_ci (pandas.DataFrame): Point estimate, bootstrap standard error and
+            interval bounds of every metric.
+    """
+    stats = date_statistics(data, target, date_column)
+    chunks = [min(chunk_size, n_replicates - start) for start in range(0, n_replicates, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(stats, n, mode, block_size, chunk_seed) for n, chunk_seed in zip(chunks, seeds)]
+    if n_workers == 1 or len(chunks) == 1:
+        replicates = [_bootstrap_chunk(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            replicates = list(executor.map(_bootstrap_chunk, *zip(*args)))
+    replicates = np.concatenate(replicates)
+
+    lower, upper = np.nanquantile(replicates, [alpha / 2, 1 - alpha / 2], axis=0)
+    return pd.DataFrame({'Target': target,
+                         'Metric': METRICS,
+                         'Estimate': metrics_from_statistics(stats.sum(axis=0))[0],
+                         'Std': np.nanstd(replicates, axis=0, ddof=1),
+                         'Lower': lower,
+                         'Upper': upper})
@@ -1,47 +1,73 @@
+import numpy as np
 import pandas as pd
 from sklearn.metrics import (mean_squared_error, mean_absolute_error, r2_score,
                              mean_absolute_percentage_error)
-from utilities.util import load_file, log, today, load_config
+from utilities.util import load_file, save_file, log, load_config, results_path
+from utilities.schema import apply_schema
+from evaluation.bootstrap import bootstrap_metrics
 from math import sqrt
 
+try:
+    from IPython.display import display
+except ImportError:
+    display = print
 
-def sellable_and_profitable_analysis(data, target):
-    df = data.copy()
-    df['target_minue_pred'] = df[target] - df['Predictions_' + target]
-    df['same_sign'] = (df[target] * df['Predictions_' + target] > 0).astype(int)
 
-    df['same_sign_and_pred_positive'] = (df['same_sign']) & (df['Predictions_' + target] > 0)
-    df['same_sign_and_pred_positive_sellable'] = (df['same_sign_and_pred_positive']) & (df['target_minue_pred'] > 0)
-
-    same_sign_and_pred_positive_sellable_pct = df['same_sign_and_pred_positive_sellable'].mean() * 100
-    return same_sign_and_pred_positive_sellable_pct
-
-def threshold_analysis(data, target, thresholds):
-    res = []
-    for threshold in thresholds:
-        data_filtered = data.query(f'Predictions_{target} > {threshold}')
-        correct_sign_pct = get_correct_sign(data_filtered, target)
+def threshold_counts(y_true, y_pred, thresholds):
+    """
+    Counts of the rule 'prediction > threshold' for many thresholds in one
+    pass: the predictions are sorted once and every count is a suffix sum
+    read off at the searchsorted position of each threshold.
+
+    Returns:
+        counts (tuple): Arrays of the number of selected rows, of those with
+            the correct sign and of those that are sellable and profitable
+            (correct positive sign and target above the prediction).
+    """
+    valid = ~np.isnan(y_pred)
+    y_pred, y_true = y_pred[valid], y_true[valid]
+    order = np.argsort(y_pred, kind='stable')
+    y_pred, y_true = y_pred[order], y_true[order]
+    correct_sign = y_true * y_pred > 0
+    sellable = correct_sign & (y_pred > 0) & (y_true - y_pred > 0)
 
-        df_correct_sign = get_correct_sign(data_filtered, target, return_df=True)
+    def suffix_sums(flags):
+        return np.concatenate([[0], np.cumsum(flags[::-1])])
 
-        same_sign_and_pred_positive_sellable_pct = sellable_and_profitable_analysis(data_filtered, target)
+    n_selected = len(y_pred) - np.searchsorted(y_pred, thresholds, side='right')
+    return n_selected, suffix_sums(correct_sign)[n_selected], suffix_sums(sellable)[n_selected]
 
-        res.append([threshold,
-                    len(df_correct_sign),
-                    correct_sign_pct,
-                    same_sign_and_pred_positive_sellable_pct,
-                    ])
 
-    df_threshold_analysis = pd.DataFrame(res, columns=['Threshold', 'n_correct_sign', 'Correct sign pct', 'same_sign_and_pred_positive_sellable_pct'])    
-    display(df_threshold_analysis)
-    return df_threshold_analysis
+def threshold_frame(target, thresholds, n_selected, n_correct_sign, n_sellable):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({'Target': target,
+                             'Threshold': thresholds,
+                             'n_selected': n_selected,
+                             'n_correct_sign': n_correct_sign,
+                             'Correct sign pct': n_correct_sign / n_selected * 100,
+                             'same_sign_and_pred_positive_sellable_pct': n_sellable / n_selected * 100})
 
 
-def get_correct_sign(data, target, return_df=False):
-    if return_df:
-        return data[data[target] * data[f'Predictions_{target}'] > 0]
-    else:
-        return (data[target] * data[f'Predictions_{target}'] > 0).mean() * 100
+def threshold_sweep(data, target, thresholds):
+    """
+    Selection statistics of the rule 'prediction > threshold' for many
+    thresholds, without filtering the frame once per threshold.
+
+    Args:
+        data (pandas.DataFrame): Data with the target and its predictions.
+        target (str): Target column.
+        thresholds (array-like): Thresholds on the prediction.
+
+    Returns:
+        df_sweep (pandas.DataFrame): One row per threshold with the number of
+            selected rows, the number and percentage with the correct sign, and
+            the percentage of selected rows that are sellable and profitable.
+    """
+    thresholds = np.asarray(thresholds, dtype='float64')
+    counts = threshold_counts(data[target].to_numpy(dtype='float64'),
+                              data[f'Predictions_{target}'].to_numpy(dtype='float64'),
+                              thresholds)
+    return threshold_frame(target, thresholds, *counts)
 
 
 def eval_dataset(data, targets, res, data_name):
@@ -58,15 +84,10 @@ def eval_dataset(data, targets, res, data_name):
     # safe_max_price_pct = (data['Predictions_period_max_price_pct'] < data['period_max_price_pct']).mean() * 100
     # safe_min_price_pct = (data['Predictions_period_min_price_pct'] < data['period_min_price_pct'] * 0.9).mean() * 100
 
-    # correct_sign_max = get_correct_sign(data, 'period_max_price_pct')
-
     # print('on data:', data_name)
-    # print(f"\tCorrect max price sign pct: {correct_sign_max:.04}%")
     # print(f"\tSafe max price pct: {safe_max_price_pct:.04}%")
     # print(f"\tSafe min price pct: {safe_min_price_pct:.04}%")
 
-    threshold_analysis(data, 'period_max_price_pct', range(5, 30, 5))
-
     if data_name == 'Test':
         print('\n\ncomments:')
         print('  - Safe max price pct is the percentage of samples whose predicted max price are lower than the actual max price.')
@@ -83,19 +104,68 @@ def evaluate_predictions(data, config):
     targets = config['targets']
     cutoff_date = config['cutoff_date']
 
+    datasets = {'Train': data.query('Date < @cutoff_date'),
+                'Test': data.query('Date >= @cutoff_date')}
     res = []
-    res = eval_dataset(data.query('Date < @cutoff_date'), targets, res, data_name='Train')
-    res = eval_dataset(data.query('Date >= @cutoff_date'), targets, res, data_name='Test')
+    for data_name, dataset in datasets.items():
+        res = eval_dataset(dataset, targets, res, data_name=data_name)
 
     df_res = pd.DataFrame(res, columns=['Target', 'Dataset', 'RMSE', 'MAE', 'MAPE', 'R2'])
     display(df_res)
 
+    thresholds = np.arange(*config['threshold_sweep'])
+    df_sweep = pd.concat([threshold_sweep(dataset, target, thresholds).assign(Dataset=data_name)
+                          for data_name, dataset in datasets.items() for target in targets],
+                         ignore_index=True)
+    display(df_sweep)
+    save_file(df_sweep, results_path(config, 'threshold_sweep.csv'), index=False)
+
+    if config['bootstrap_replicates']:
+        log(f"Bootstrapping {config['bootstrap_replicates']} replicates ({config['bootstrap_mode']})")
+        df_ci = pd.concat([bootstrap_metrics(dataset, target,
+                                             n_replicates=config['bootstrap_replicates'],
+                                             mode=config['bootstrap_mode'],
+                                             block_size=config['bootstrap_block_days'],
+                                             alpha=config['bootstrap_alpha'],
+                                             chunk_size=config['bootstrap_chunk_size'],
+                                             n_workers=config['bootstrap_workers']).assign(Dataset=data_name)
+                           for data_name, dataset in datasets.items() for target in targets],
+                          ignore_index=True)
+        display(df_ci)
+        save_file(df_ci, results_path(config, 'bootstrap_ci.csv'), index=False)
+    return df_res, df_sweep
+
+
+def evaluate_predictions_streaming(predictions_file, config):
+    """
+    Evaluate the predictions file in one pass over chunks, for files that do
+    not fit in memory, grouped by config['evaluation_group_by'].
+    """
+    from evaluation.streaming import evaluate_file
+
+    df_metrics, df_thresholds = evaluate_file(predictions_file, config['targets'], config['cutoff_date'],
+                                              group_by=config['evaluation_group_by'],
+                                              period=config['evaluation_period'],
+                                              thresholds=np.arange(*config['threshold_sweep']),
+                                              chunk_rows=config['evaluation_chunk_rows'],
+                                              n_workers=config['evaluation_workers'])
+    display(df_metrics)
+    save_file(df_metrics, results_path(config, 'metrics.csv'), index=False)
+    save_file(df_thresholds, results_path(config, 'threshold_sweep.csv'), index=False)
+    return df_metrics, df_thresholds
+
 
 def main():
     config = load_config()
-    predictions_file = f"data/experiment/{today()}/data_with_predictions.pkl"
+    predictions_file = results_path(config, f"data_with_predictions.{config['storage_format']}")
+    if config['evaluation_mode'] == 'streaming':
+        evaluate_predictions_streaming(predictions_file, config)
+        return
 
-    data = load_file(predictions_file)
+    targets = config['targets']
+    columns = ['Date', 'Ticker'] + targets + [f'Predictions_{target}' for target in targets]
+    data = load_file(predictions_file, columns=columns)
+    data = apply_schema(data, float_dtype=config['float_dtype'], name='predictions')
     evaluate_predictions(data, config)
 
 
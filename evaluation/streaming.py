@@ -0,0 +1,191 @@
+"""
+one-pass, out-of-core evaluation of prediction files with mergeable accumulators
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from utilities.util import iter_file_chunks, log
+from evaluation.evaluation import threshold_counts, threshold_frame
+
+
+class MetricAccumulator:
+    """
+    Running statistics of one target in one group: error sums for RMSE, MAE
+    and MAPE, Welford mean and sum of squared deviations of the target for
+    R2, the correct-sign count and the threshold selection counts.
+    Accumulators of disjoint rows merge exactly (Chan et al.), so chunks and
+    worker processes can be combined in any order.
+    """
+
+    def __init__(self, thresholds=()):
+        self.thresholds = np.asarray(thresholds, dtype='float64')
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sse = 0.0
+        self.sae = 0.0
+        self.sape = 0.0
+        self.n_correct = 0
+        self.n_selected = np.zeros(len(self.thresholds), dtype='int64')
+        self.n_correct_selected = np.zeros(len(self.thresholds), dtype='int64')
+        self.n_sellable = np.zeros(len(self.thresholds), dtype='int64')
+
+    def update(self, y_true, y_pred):
+        batch = MetricAccumulator(self.thresholds)
+        batch.n = len(y_true)
+        if batch.n == 0:
+            return
+        error = y_true - y_pred
+        batch.mean = y_true.mean()
+        batch.m2 = ((y_true - batch.mean) ** 2).sum()
+        batch.sse = (error ** 2).sum()
+        batch.sae = np.abs(error).sum()
+        # as sklearn's mean_absolute_percentage_error
+        batch.sape = (np.abs(error) / np.maximum(np.abs(y_true), np.finfo(np.float64).eps)).sum()
+        batch.n_correct = int((y_true * y_pred > 0).sum())
+        if len(self.thresholds):
+            counts = threshold_counts(y_true, y_pred, self.thresholds)
+            batch.n_selected, batch.n_correct_selected, batch.n_sellable = counts
+        self.merge(batch)
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.n = n
+        self.sse += other.sse
+        self.sae += other.sae
+        self.sape += other.sape
+        self.n_correct += other.n_correct
+        self.n_selected = self.n_selected + other.n_selected
+        self.n_correct_selected = self.n_correct_selected + other.n_correct_selected
+        self.n_sellable = self.n_sellable + other.n_sellable
+        return self
+
+    def metrics(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {'n': self.n,
+                    'RMSE': np.sqrt(self.sse / self.n),
+                    'MAE': self.sae / self.n,
+                    'MAPE': self.sape / self.n,
+                    'R2': 1 - self.sse / self.m2,
+                    'Correct sign pct': self.n_correct / self.n * 100}
+
+
+def _group_keys(chunk, group_by, cutoff_date, period):
+    dates = pd.to_datetime(chunk['Date'])
+    keys = {}
+    for key in group_by:
+        if key == 'split':
+            keys[key] = np.where(dates < pd.Timestamp(cutoff_date), 'Train', 'Test')
+        elif key == 'ticker':
+            keys[key] = chunk['Ticker'].astype(str).to_numpy()
+        elif key == 'period':
+            keys[key] = dates.dt.to_period(period).astype(str).to_numpy()
+        else:
+            raise ValueError(f'group {key} not recognized, use split, ticker or period.')
+    return pd.DataFrame(keys)
+
+
+def accumulate(chunks, targets, cutoff_date, group_by=('split',), period='Y', thresholds=()):
+    """
+    Update one accumulator per (group, target) from a sequence of chunks.
+
+    Returns:
+        accumulators (dict): (group key tuple, target) to MetricAccumulator.
+    """
+    accumulators = {}
+    for chunk in chunks:
+        if group_by:
+            groups = _group_keys(chunk, group_by, cutoff_date, period).groupby(
+                list(group_by), sort=False).indices
+        else:
+            groups = {(): np.arange(len(chunk))}
+        for target in targets:
+            y_true = chunk[target].to_numpy(dtype='float64')
+            y_pred = chunk[f'Predictions_{target}'].to_numpy(dtype='float64')
+            for key, rows in groups.items():
+                key = key if isinstance(key, tuple) else (key,)
+                accumulator = accumulators.get((key, target))
+                if accumulator is None:
+                    accumulator = accumulators[(key, target)] = MetricAccumulator(thresholds)
+                accumulator.update(y_true[rows], y_pred[rows])
+    return accumulators
+
+
+def merge_accumulators(parts):
+    merged = {}
+    for part in parts:
+        for key, accumulator in part.items():
+            if key in merged:
+                merged[key].merge(accumulator)
+            else:
+                merged[key] = accumulator
+    return merged
+
+
+def _accumulate_file(file_path, columns, chunk_rows, row_groups, targets, cutoff_date,
+                     group_by, period, thresholds):
+    chunks = iter_file_chunks(file_path, columns=columns, chunk_rows=chunk_rows, row_groups=row_groups)
+    return accumulate(chunks, targets, cutoff_date, group_by, period, thresholds)
+
+
+def evaluate_file(file_path, targets, cutoff_date, group_by=('split',), period='Y', thresholds=(),
+                  chunk_rows=1_000_000, n_workers=None):
+    """
+    Evaluate a predictions file in one pass without loading it into memory.
+    Parquet row groups are split between worker processes whose partial
+    accumulators are merged; other formats are read in chunks in-process.
+
+    Args:
+        file_path (str): Predictions file with Date, Ticker, the targets and
+            their predictions.
+        targets (list): Target columns.
+        cutoff_date (str): Train/test cutoff for the 'split' group.
+        group_by (list): Any of 'split', 'ticker' and 'period'.
+        period (str): Pandas period of the 'period' group, e.g. 'Y', 'Q', 'M'.
+        thresholds (array-like): Prediction thresholds to count.
+        chunk_rows (int): Rows read at once.
+        n_workers (int): Worker processes, None for all CPUs, 1 to run inline.
+
+    Returns:
+        df_metrics (pandas.DataFrame): Metrics per group and target.
+        df_thresholds (pandas.DataFrame): Threshold counts per group and target.
+    """
+    group_by = list(group_by)
+    thresholds = np.asarray(thresholds, dtype='float64')
+    columns = ['Date'] + (['Ticker'] if 'ticker' in group_by else []) \
+        + list(targets) + [f'Predictions_{target}' for target in targets]
+    args = (targets, cutoff_date, group_by, period, thresholds)
+
+    parts = [None]
+    if file_path.endswith('.parquet') and n_workers != 1:
+        import pyarrow.parquet as pq
+        n_row_groups = pq.ParquetFile(file_path).num_row_groups
+        n_parts = max(1, min(n_row_groups, n_workers or os.cpu_count()))
+        parts = [list(part) for part in np.array_split(np.arange(n_row_groups), n_parts)]
+    log(f'Evaluating {file_path} in {len(parts)} part(s)')
+    if len(parts) == 1:
+        accumulators = _accumulate_file(file_path, columns, chunk_rows, parts[0], *args)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_accumulate_file, file_path, columns, chunk_rows, part, *args)
+                       for part in parts]
+            accumulators = merge_accumulators(future.result() for future in futures)
+
+    metric_rows, threshold_frames = [], []
+    for (key, target), accumulator in sorted(accumulators.items()):
+        groups = dict(zip(group_by, key))
+        metric_rows.append({**groups, 'Target': target, **accumulator.metrics()})
+        if len(thresholds):
+            threshold_frames.append(threshold_frame(target, thresholds, accumulator.n_selected,
+                                                    accumulator.n_correct_selected,
+                                                    accumulator.n_sellable).assign(**groups))
+    df_thresholds = pd.concat(threshold_frames, ignore_index=True) if threshold_frames else None
+    return pd.DataFrame(metric_rows), df_thresholds
@@ -0,0 +1,334 @@
+"""
+long-running local scoring server with micro-batched predictions
+
+usage:
+    python -m models.serve
+
+    POST /predict  {"rows": [{"Ticker": "AAPL", "pct_change": 0.4, ...}, ...]}
+                   -> {"predictions": [{"Ticker": "AAPL", "Predictions_<target>": ...}, ...]}
+    GET  /stats    latency percentiles, throughput and the loaded model
+"""
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from catboost import CatBoostRegressor
+
+from utilities.util import load_config, log
+
+
+def latest_model_path(experiment_dir='data/experiment'):
+    """
+    Most recently written model.cbm of the experiment runs, None if there is none.
+    """
+    paths = glob.glob(os.path.join(experiment_dir, '*', 'model.cbm'))
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+ID_FIELDS = ('Ticker', 'Date')
+
+
+class _Request:
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.predictions = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collect concurrent scoring requests into one model.predict call. A batch
+    is sent once it holds max_batch_rows rows or the first request in it has
+    waited max_wait_ms, whichever comes first. predict receives the rows of
+    every request in the batch and returns the predictions or the exception
+    of each request, so one invalid request does not fail the others.
+    """
+
+    def __init__(self, predict, max_batch_rows=1024, max_wait_ms=5):
+        self.predict = predict
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = deque(maxlen=10000)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, rows):
+        """
+        Score a list of rows, blocking until its batch ran.
+        """
+        request = _Request(rows)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def _loop(self):
+        while True:
+            batch = [self.requests.get()]
+            n_rows = len(batch[0].rows)
+            deadline = time.monotonic() + self.max_wait
+            while n_rows < self.max_batch_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_rows += len(request.rows)
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            results = self.predict([request.rows for request in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        with self.lock:
+            self.batch_sizes.append(sum(len(request.rows) for request in batch))
+        for request, result in zip(batch, results):
+            if isinstance(result, Exception):
+                request.error = result
+            else:
+                request.predictions = result
+            request.done.set()
+
+
+class ScoringService:
+    """
+    Hold the loaded model, turn feature rows into arrays in the model's
+    feature order, and keep latency and throughput counters. The model is
+    swapped without downtime when a newer experiment artifact appears; a batch
+    reads the model once and builds its features from that same model.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.targets = config['targets']
+        self.lock = threading.Lock()
+        self.model = None
+        self.model_path = None
+        self.model_mtime = None
+        self.reload()
+        if self.model is None:
+            raise FileNotFoundError('no model.cbm found in data/experiment, run models/train.py first.')
+
+        self.batcher = MicroBatcher(self._predict,
+                                    max_batch_rows=config['serve_max_batch_rows'],
+                                    max_wait_ms=config['serve_max_wait_ms'])
+        self.latencies = deque(maxlen=10000)
+        self.n_requests = 0
+        self.n_rows = 0
+        self.started = time.monotonic()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def reload(self):
+        """
+        Load the latest model if it is not the one being served.
+        """
+        model_path = latest_model_path()
+        if model_path is None:
+            return
+        mtime = os.path.getmtime(model_path)
+        if (model_path, mtime) == (self.model_path, self.model_mtime):
+            return
+        model = CatBoostRegressor()
+        model.load_model(model_path)
+        with self.lock:
+            self.model, self.model_path, self.model_mtime = model, model_path, mtime
+        log(f'Serving model {model_path}')
+
+    def _watch(self):
+        while True:
+            time.sleep(self.config['serve_reload_interval'])
+            try:
+                self.reload()
+            except Exception as e:
+                log(f'Model reload failed, keeping {self.model_path}: {e}')
+
+    def _predict(self, batch_rows):
+        with self.lock:
+            model = self.model
+        results, features = [], []
+        for rows in batch_rows:
+            try:
+                features.append(self.features(rows, model))
+                results.append(None)
+            except ValueError as e:
+                results.append(e)
+        if not features:
+            return results
+
+        features = np.concatenate(features)
+        predictions = model.predict(np.ascontiguousarray(features)).reshape(len(features), -1)
+        start = 0
+        for i, rows in enumerate(batch_rows):
+            if results[i] is None:
+                results[i] = predictions[start:start + len(rows)]
+                start += len(rows)
+        return results
+
+    def validate(self, rows):
+        """
+        Check the request rows against the feature configuration before they
+        are queued: categorical_features and the id fields hold strings (or
+        integer codes), every other field a number; null means missing.
+
+        Raises:
+            ValueError: If rows is not a non-empty list of objects or a field
+                has the wrong type.
+        """
+        if not isinstance(rows, list) or not rows:
+            raise ValueError('rows must be a non-empty list')
+        categorical = set(self.config['categorical_features'])
+        for i, row in enumerate(rows):
+            if not isinstance(row, dict):
+                raise ValueError(f'row {i} is not an object')
+            for name, value in row.items():
+                if value is None:
+                    continue
+                if name in categorical or name in ID_FIELDS:
+                    if isinstance(value, bool) or not isinstance(value, (str, int)):
+                        raise ValueError(f'row {i}: {name} must be a string, got {value!r}')
+                elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError(f'row {i}: {name} must be a number, got {value!r}')
+
+    def features(self, rows, model):
+        """
+        (rows, features) array of validated request rows in the feature order
+        of model: float32, or object when the model has categorical features.
+        Missing or null numeric fields are NaN.
+
+        Raises:
+            ValueError: If a row has a field that is neither a model feature
+                nor an id, target or dropped column of the configuration, or
+                misses a categorical feature.
+        """
+        feature_names = model.feature_names_
+        known = (set(feature_names) | set(ID_FIELDS) | set(self.targets)
+                 | set(self.config['drop_features']))
+        categorical = set(model.get_cat_feature_indices())
+        features = np.full((len(rows), len(feature_names)), np.nan,
+                           dtype=object if categorical else 'float32')
+        for i, row in enumerate(rows):
+            unknown = sorted(set(row) - known)
+            if unknown:
+                raise ValueError(f'row {i}: unknown fields {unknown}')
+            for j, name in enumerate(feature_names):
+                value = row.get(name)
+                if j in categorical:
+                    if value is None:
+                        raise ValueError(f'row {i}: categorical feature {name} is missing')
+                    features[i, j] = str(value)
+                elif value is not None:
+                    features[i, j] = value
+        return features
+
+    def score(self, rows):
+        start = time.perf_counter()
+        self.validate(rows)
+        predictions = self.batcher.submit(rows)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.n_requests += 1
+            self.n_rows += len(rows)
+
+        results = []
+        for row, prediction in zip(rows, predictions):
+            result = {'Ticker': row.get('Ticker')}
+            for target, value in zip(self.targets, prediction):
+                result[f'Predictions_{target}'] = float(value)
+            results.append(result)
+        return results
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            model_path, n_requests, n_rows = self.model_path, self.n_requests, self.n_rows
+        with self.batcher.lock:
+            batch_sizes = np.array(self.batcher.batch_sizes)
+        elapsed = time.monotonic() - self.started
+        return {'model': model_path,
+                'requests': n_requests,
+                'rows': n_rows,
+                'requests_per_s': n_requests / elapsed,
+                'rows_per_s': n_rows / elapsed,
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'mean_batch_rows': float(batch_sizes.mean()) if len(batch_sizes) else None}
+
+
+class ScoringServer(ThreadingHTTPServer):
+    """
+    Threading HTTP server with a listen backlog sized for bursts of
+    concurrent clients (the socketserver default of 5 refuses connections).
+    """
+    request_queue_size = 128
+
+
+def make_handler(service):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, service.stats())
+            else:
+                self._send(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send(404, {'error': f'unknown path {self.path}'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                rows = body['rows']
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {'error': f'invalid request: {e}'})
+                return
+            try:
+                predictions = service.score(rows)
+            except ValueError as e:
+                self._send(400, {'error': f'invalid request: {e}'})
+                return
+            except Exception as e:
+                log(f'Scoring failed: {e!r}', level='error')
+                self._send(500, {'error': f'scoring failed: {e}'})
+                return
+            self._send(200, {'predictions': predictions})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+def main():
+    config = load_config()
+    service = ScoringService(config)
+    server = ScoringServer((config['serve_host'], config['serve_port']), make_handler(service))
+    log(f"Scoring server listening on {config['serve_host']}:{config['serve_port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log(f'Stopping scoring server: {service.stats()}')
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,63 @@
+import os
+import numpy as np
 import pandas as pd
-from catboost import CatBoostRegressor
+import catboost
+from catboost import CatBoostRegressor, Pool
 from sklearn.metrics import mean_squared_error, mean_absolute_error
-from utilities.util import load_config, today, save_file, log, drop_columns
+from utilities.util import (load_config, today, load_file, save_file, log, drop_columns, file_columns,
+                            results_path)
+from utilities.schema import apply_schema
 from data_preparation import feature_engineer
+from data_preparation.feature_cache import FeatureCache, code_version
+from data_preparation.universe import UniverseIndex
 from math import sqrt
-import time
 import warnings
 
 warnings.filterwarnings("ignore")
 
 
+def validation_start_date(cutoff_date, validation_months):
+    """
+    First date of the validation window of the validation_months before a
+    cutoff date, used for early stopping and tuning instead of the test data.
+    """
+    return pd.Timestamp(cutoff_date) - pd.DateOffset(months=validation_months)
+
+
 class ModelTrainer:
     def __init__(self):
         self.config = load_config()
         self.model = None
-
-    def load_data(self, filepath):
+        self.feature_cache = None
+        if self.config['feature_cache']:
+            self.feature_cache = FeatureCache(self.config['feature_cache_dir'],
+                                              max_bytes=self.config['feature_cache_max_gb'] * 1024 ** 3)
+        self.input_fingerprint = None
+        self.features_fingerprint = None
+
+    def load_data(self, filepath, columns=None, start_date=None, end_date=None):
         log(f"Loading data from {filepath}")
-        return pd.read_csv(filepath, parse_dates=["Date"], index_col=["Date"])
+        filters = []
+        if start_date is not None:
+            filters.append(('Date', '>=', start_date))
+        if end_date is not None:
+            filters.append(('Date', '<', end_date))
+
+        data = load_file(filepath, columns=columns, filters=filters)
+        data = apply_schema(data.set_index('Date'), float_dtype=self.config['float_dtype'])
+        return data
 
     def processed_data(self, data):
         log("Processing data")
-        log('selecting in-scope tickers')
-        selected_tickers = pd.read_csv('data/market_data/selected_tickers.csv')['Ticker'].tolist()
-        data = data.query('Ticker in @selected_tickers')
-
         # data = feature_engineer.calculate_moving_averages(data)
         # data = feature_engineer.calculate_rsi(data)
         # data = feature_engineer.calculate_n_day_return(data)
 
-        data = feature_engineer.get_lag(data,
-                                        columns=self.config['features_to_lag'])
+        data = self.build_lag_features(data)
+        # lags use the full history, rows are kept where the ticker is in the
+        # universe as of their date
+        log('selecting in-scope tickers')
+        data = UniverseIndex.load(self.config['universe_path']).filter(data)
         data = feature_engineer.binarlizer(data,
                                            categorecal_features=self.config['categorical_features'])
 
@@ -38,12 +65,90 @@ class ModelTrainer:
         self.data = data
         return data
 
+    def build_lag_features(self, data):
+        """
+        Add the configured lag, lead and lag-difference features. With the
+        feature cache enabled every source column is cached as its own block,
+        so changing the lags of one column only rebuilds that column.
+        """
+        lag_config = {'lags': self.config['features_to_lag'],
+                      'leads': self.config['features_to_lead'],
+                      'diffs': self.config['features_to_diff']}
+        n_lag = self.config['n_lag']
+        if self.feature_cache is None or self.input_fingerprint is None:
+            return feature_engineer.build_lags(data, n_lag=n_lag, **lag_config)
+
+        specs = {kind: feature_engineer._shift_spec(spec, n_lag) for kind, spec in lag_config.items()}
+        columns = list(dict.fromkeys(col for spec in specs.values() for col in spec))
+        blocks = []
+        for col in columns:
+            column_specs = {kind: {col: spec[col]} for kind, spec in specs.items() if col in spec}
+            key = FeatureCache.fingerprint('lag_block', self.input_fingerprint, col, column_specs,
+                                           code_version(feature_engineer.__name__))
+
+            def build():
+                block = feature_engineer.build_lags(data[['Ticker', col]], **column_specs)
+                return block.drop(columns=['Ticker', col]).reset_index(drop=True)
+
+            block = self.feature_cache.get_or_build(key, build, index=False)
+            blocks.append(block.set_axis(data.index))
+        return pd.concat([data] + blocks, axis=1)
+
+    def input_columns(self, filepath):
+        """
+        Columns of the cleaned data that training uses: everything but the
+        dropped features, plus the keys, targets and the sources of the lag,
+        lead and diff features even when they are dropped.
+        """
+        needed = ['Date', 'Ticker'] + list(self.config['targets']) + list(self.config['categorical_features'])
+        for key in ['features_to_lag', 'features_to_lead', 'features_to_diff']:
+            needed += list(self.config[key])
+        dropped = set(self.config['drop_features']) - set(needed)
+        return [col for col in file_columns(filepath) if col not in dropped]
+
+    def load_features(self, filepath, start_date=None, end_date=None):
+        """
+        Load and process the columns and dates [start_date, end_date) that
+        training needs, or load the finished feature matrix from the feature
+        cache when neither the input files, the feature configuration nor the
+        feature_engineer code changed.
+        """
+        columns = self.input_columns(filepath)
+        if self.feature_cache is None:
+            data = self.load_data(filepath, columns=columns, start_date=start_date, end_date=end_date)
+            return self.processed_data(data)
+
+        self.input_fingerprint = FeatureCache.fingerprint(
+            self.feature_cache.file_fingerprint(filepath),
+            self.feature_cache.file_fingerprint(self.config['universe_path']),
+            columns, start_date, end_date,
+            self.config['float_dtype'])
+        self.features_fingerprint = FeatureCache.fingerprint(
+            'features', self.input_fingerprint,
+            {key: self.config[key] for key in ['features_to_lag', 'features_to_lead',
+                                               'features_to_diff', 'n_lag',
+                                               'categorical_features']},
+            # processed_data (universe filter, binarlizer) lives here, feature_engineer is imported
+            code_version('models.train'))
+
+        data = self.feature_cache.get(self.features_fingerprint)
+        if data is not None:
+            log(f'Loaded features from cache {self.features_fingerprint[:12]}')
+            self.data = data
+            return data
+
+        data = self.load_data(filepath, columns=columns, start_date=start_date, end_date=end_date)
+        data = self.processed_data(data)
+        self.feature_cache.put(self.features_fingerprint, data)
+        return data
+
     def temporal_data_split(self, data, cutoff_date, targets):
         log("Splitting data into train and test sets")
         print(f"\tUsing {cutoff_date} as the cutoff date")
 
-        train = data.loc[data.index < cutoff_date]
-        test = data.loc[data.index >= cutoff_date]
+        self.train_mask = data.index < cutoff_date
+        train = data.loc[self.train_mask]
+        test = data.loc[~self.train_mask]
 
         X_train = drop_columns(train, self.config['drop_features'])
         y_train = train[targets]
@@ -53,23 +158,65 @@ class ModelTrainer:
         print('\tcolumns using:', ', '.join(X_train.columns))
         print('\ttargets:', targets)
 
-        save_file(X_train, f'data/experiment/{today()}/X_train.pkl')
-        save_file(X_test, f'data/experiment/{today()}/X_test.pkl')
-        save_file(y_train, f'data/experiment/{today()}/y_train.pkl')
-        save_file(y_test, f'data/experiment/{today()}/y_test.pkl')
-
+        self.cutoff_date = cutoff_date
         self.X_train = X_train
         self.y_train = y_train
         self.X_test = X_test
         self.y_test = y_test
 
-    def train(self):
-        log("Training model")
-        X_train = self.X_train
-        y_train = self.y_train
-        X_test = self.X_test
-        y_test = self.y_test
-
+    def build_pools(self):
+        """
+        Quantized CatBoost pools of the train and test sets. The train set is
+        quantized once and the test set with the train borders; both are saved
+        in CatBoost's binary format, in the feature cache keyed by the feature
+        fingerprint and the split, so later runs, retrains and tuning trials
+        load them instead of re-quantizing the frames.
+
+        Returns:
+            pool_paths (tuple): 'quantized://' paths of the train and test pools.
+        """
+        if self.feature_cache is None or self.features_fingerprint is None:
+            pool_dir = f'data/experiment/{today()}/pools'
+            os.makedirs(pool_dir, exist_ok=True)
+            self.write_pools(pool_dir)
+        else:
+            key = FeatureCache.fingerprint('pools', self.features_fingerprint, self.cutoff_date,
+                                           list(self.X_train.columns), list(self.y_train.columns),
+                                           catboost.__version__)
+            pool_dir = self.feature_cache.get_dir(key)
+            if pool_dir is not None:
+                log(f'Loaded quantized pools from cache {key[:12]}')
+            else:
+                pool_dir = self.feature_cache.put_dir(key, self.write_pools)
+        return (f"quantized://{os.path.join(pool_dir, 'train.quantized')}",
+                f"quantized://{os.path.join(pool_dir, 'test.quantized')}")
+
+    def write_pools(self, pool_dir):
+        log("Quantizing train and test pools")
+        cat_features = [col for col in self.X_train.columns
+                        if isinstance(self.X_train[col].dtype, pd.CategoricalDtype)]
+        borders_path = os.path.join(pool_dir, 'borders.tsv')
+        thread_count = self.config['catboost_thread_count']
+        used_ram_limit = self.config['catboost_used_ram_limit']
+
+        train_pool = Pool(self.X_train, self.y_train, cat_features=cat_features,
+                          thread_count=thread_count)
+        train_pool.quantize(used_ram_limit=used_ram_limit)
+        train_pool.save_quantization_borders(borders_path)
+        train_pool.save(os.path.join(pool_dir, 'train.quantized'))
+        test_pool = Pool(self.X_test, self.y_test, cat_features=cat_features,
+                         thread_count=thread_count)
+        test_pool.quantize(input_borders=borders_path, used_ram_limit=used_ram_limit)
+        test_pool.save(os.path.join(pool_dir, 'test.quantized'))
+
+    def hyperparameters(self, tuned=True, as_of=None):
+        """
+        CatBoost hyperparameters, updated with the tuned ones of
+        hyperparameters_file when it exists. Tuned hyperparameters are only
+        used for models whose training data ends no earlier than the data
+        they were tuned on (as_of, the cutoff date of the model, defaults to
+        cutoff_date).
+        """
         hps = {
                 'iterations': 2000,
                 'learning_rate': 0.03,
@@ -82,81 +229,110 @@ class ModelTrainer:
 
         if len(self.config['targets']) > 1:
             hps['loss_function'] = 'MultiRMSE'
+        hyperparameters_file = self.config['hyperparameters_file']
+        if tuned and hyperparameters_file and os.path.exists(hyperparameters_file):
+            tuned_hps = load_file(hyperparameters_file)
+            as_of = pd.Timestamp(as_of or self.config['cutoff_date'])
+            if 'tuned_until' not in tuned_hps:
+                log(f'Ignoring {hyperparameters_file}: it does not record the data it was tuned on, '
+                    f'rerun the tuning', level='warning')
+            elif pd.Timestamp(tuned_hps['tuned_until']) > as_of:
+                log(f"Ignoring {hyperparameters_file}: tuned on data until {tuned_hps['tuned_until']}, "
+                    f"after the cutoff {as_of:%Y-%m-%d}", level='warning')
+            else:
+                log(f"Using hyperparameters from {hyperparameters_file} tuned on data until "
+                    f"{tuned_hps['tuned_until']}")
+                hps.update(tuned_hps['hyperparameters'])
+        return hps
 
-        self.model = CatBoostRegressor(**hps)
-            
-        self.model.fit(X_train,
-                       y_train,
-                       eval_set=(X_test, y_test),
-                       verbose=100)
+    def train(self):
+        log("Training model")
+        X_train = self.X_train
+        y_train = self.y_train
+        X_test = self.X_test
+        y_test = self.y_test
+        train_path, test_path = self.build_pools()
 
-        self.evaluate_predictions(X_train, y_train, 'Train')
-        self.evaluate_predictions(X_test, y_test, 'Test')
+        self.model = CatBoostRegressor(**self.hyperparameters(),
+                                       thread_count=self.config['catboost_thread_count'],
+                                       used_ram_limit=self.config['catboost_used_ram_limit'])
 
-    def evaluate_predictions(self, X, y_true, data_name):
-        y_pred = self.model.predict(X)
+        self.model.fit(Pool(train_path),
+                       eval_set=Pool(test_path),
+                       verbose=100)
 
+        log("Making predictions for both train and test sets")
+        self.y_train_pred = self.predict(X_train)
+        self.y_test_pred = self.predict(X_test)
+        self.evaluate_predictions(y_train, self.y_train_pred, 'Train')
+        self.evaluate_predictions(y_test, self.y_test_pred, 'Test')
+
+    def evaluate_predictions(self, y_true, y_pred, data_name):
         rmse = sqrt(mean_squared_error(y_true, y_pred))
         mae = mean_absolute_error(y_true, y_pred)
         print(f'{data_name}:')
         print(f"\tRMSE: {rmse}")
         print(f"\tMAE: {mae}")
 
-    def predict_and_save_all(self):
-        time.sleep(1)  # sleep for 1s ensure output format is correct
-
-        log("Making predictions for both train and test sets")
-        y_train_pred = self.model.predict(self.X_train)
-        y_test_pred = self.model.predict(self.X_test)
-
-        # Initialize prediction columns with None for all rows
-        pred_columns = [f'Predictions_{x}' for x in self.config['targets']]
-        for col in pred_columns:
-            self.data[col] = None
-
-        # Assign predictions to the appropriate segments
-        # based on the cutoff date
-        # Ensure your y_train_pred and y_test_pred are aligned with
-        # the data's indexing and have the correct shape
-
-        self.data.reset_index(inplace=True)
-
-        # Filter and assign training predictions
-        train_indices = self.data[self.data['Date'] < self.config['cutoff_date']].index
-        for i, pred_col in enumerate(pred_columns):
-            if len(self.config['targets']) > 1:
-                self.data.loc[train_indices, pred_col] = y_train_pred[:, i]
-            else:
-                self.data.loc[train_indices, pred_col] = y_train_pred
-
-
-        # Filter and assign testing predictions
-        test_indices = self.data[self.data['Date'] >= self.config['cutoff_date']].index
-        for i, pred_col in enumerate(pred_columns):
-            if len(self.config['targets']) > 1:
-                self.data.loc[test_indices, pred_col] = y_test_pred[:, i]
-            else:
-                self.data.loc[test_indices, pred_col] = y_test_pred
+    def predict(self, X):
+        """
+        Predict in chunks of predict_chunk_rows rows into one preallocated
+        (rows, targets) float array, bounding the memory CatBoost needs for
+        large frames.
+        """
+        y_pred = np.empty((len(X), len(self.config['targets'])), dtype=self.config['float_dtype'])
+        chunk_rows = self.config['predict_chunk_rows'] or max(len(X), 1)
+        for start in range(0, len(X), chunk_rows):
+            chunk = self.model.predict(X.iloc[start:start + chunk_rows])
+            y_pred[start:start + len(chunk)] = chunk.reshape(len(chunk), -1)
+        return y_pred
 
-        # Save to CSV
+    def predict_and_save_all(self):
+        """
+        Save the keys, targets and predictions of every row. The train and test
+        predictions are written by position through the split mask, in the row
+        order of the data.
+        """
         log("Saving data with predictions")
-        save_file(self.data,
-                  f'data/experiment/{today()}/data_with_predictions.pkl')
+        targets = self.config['targets']
+        y_pred = np.empty((len(self.data), len(targets)), dtype=self.config['float_dtype'])
+        y_pred[self.train_mask] = self.y_train_pred
+        y_pred[~self.train_mask] = self.y_test_pred
+
+        output = pd.DataFrame({'Date': self.data.index, 'Ticker': self.data['Ticker'].array})
+        for i, target in enumerate(targets):
+            output[target] = self.data[target].to_numpy()
+            output[f'Predictions_{target}'] = y_pred[:, i]
+        save_file(output,
+                  results_path(self.config, f"data_with_predictions.{self.config['storage_format']}"),
+                  index=False)
+
+    def save_model(self):
+        """
+        Save the model in CatBoost's binary format for scoring outside of
+        training; the feature order is stored in the model.
+        """
+        model_path = f'data/experiment/{today()}/model.cbm'
+        log(f"Saving model to {model_path}")
+        self.model.save_model(model_path)
 
     def run(self):
-        filepath = "data/processed_data/data_clean.csv"
+        filepath = f"data/processed_data/data_clean.{self.config['storage_format']}"
         cutoff_date = self.config["cutoff_date"]
 
-        data = self.load_data(filepath)
-        data = self.processed_data(data)
+        data = self.load_features(filepath, start_date=self.config['start_date'],
+                                  end_date=self.config['end_date'])
         self.temporal_data_split(data, cutoff_date,
                                  targets=self.config['targets'])
         self.train()
         self.predict_and_save_all()
+        self.save_model()
 
 
-if __name__ == "__main__":
+def main():
     trainer = ModelTrainer()
     trainer.run()
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+parallel hyperparameter search for the CatBoost model with Optuna
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import optuna
+from catboost import CatBoostRegressor, Pool
+
+from utilities.util import save_file, log, today
+from models.train import ModelTrainer, validation_start_date
+
+
+def suggest_hyperparameters(trial):
+    """
+    Search space of the tuned CatBoost hyperparameters.
+    """
+    return {
+        'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.3, log=True),
+        'depth': trial.suggest_int('depth', 4, 10),
+        'l2_leaf_reg': trial.suggest_float('l2_leaf_reg', 1, 30, log=True),
+        'min_data_in_leaf': trial.suggest_int('min_data_in_leaf', 1, 100, log=True),
+        'random_strength': trial.suggest_float('random_strength', 1e-3, 10, log=True),
+    }
+
+
+class PruningCallback:
+    """
+    CatBoost callback reporting the eval-set metric to an Optuna trial every
+    report_every iterations and stopping the fit once the pruner gives up on
+    the trial.
+    """
+
+    def __init__(self, trial, metric, report_every=50):
+        self.trial = trial
+        self.metric = metric
+        self.report_every = report_every
+        self.pruned = False
+
+    def after_iteration(self, info):
+        if info.iteration % self.report_every:
+            return True
+        self.trial.report(info.metrics['validation'][self.metric][-1], step=info.iteration)
+        self.pruned = self.trial.should_prune()
+        return not self.pruned
+
+
+def _storage(url):
+    # wait for the lock instead of failing when workers write to SQLite concurrently
+    return optuna.storages.RDBStorage(url, engine_kwargs={'connect_args': {'timeout': 60}})
+
+
+def _run_trials(study_name, storage_url, pool_paths, base_hps, n_trials, thread_count,
+                report_every, timeout):
+    """
+    Run trials of a shared study in a worker process until the study holds
+    n_trials finished trials. The quantized fit and validation pools are
+    loaded once per worker.
+    """
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    study = optuna.load_study(study_name=study_name, storage=_storage(storage_url))
+    fit_pool, validation_pool = Pool(pool_paths[0]), Pool(pool_paths[1])
+    metric = base_hps['loss_function']
+
+    def objective(trial):
+        hps = {**base_hps, **suggest_hyperparameters(trial)}
+        callback = PruningCallback(trial, metric, report_every)
+        model = CatBoostRegressor(**hps, thread_count=thread_count, allow_writing_files=False)
+        model.fit(fit_pool, eval_set=validation_pool, callbacks=[callback], verbose=False)
+        if callback.pruned:
+            raise optuna.TrialPruned()
+        trial.set_user_attr('best_iteration', model.get_best_iteration())
+        return model.best_score_['validation'][metric]
+
+    finished = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    study.optimize(objective, timeout=timeout,
+                   callbacks=[optuna.study.MaxTrialsCallback(n_trials, states=finished)])
+
+
+class HyperparameterTuner(ModelTrainer):
+    """
+    Tune the CatBoost hyperparameters on data before cutoff_date only: trials
+    fit on the data before the last validation_months and are scored (and
+    early-stopped) on those months, so the test period never informs the
+    hyperparameters. Trials run in tune_workers processes sharing one Optuna
+    study in a SQLite file, so an interrupted search resumes where it stopped.
+    """
+
+    def run(self):
+        filepath = f"data/processed_data/data_clean.{self.config['storage_format']}"
+        storage_url = self.config['tune_storage']
+        study_name = self.config['tune_study_name']
+        n_trials = self.config['tune_n_trials']
+        n_workers = self.config['tune_workers']
+
+        cutoff_date = self.config['cutoff_date']
+        validation_start = validation_start_date(cutoff_date, self.config['validation_months'])
+        data = self.load_features(filepath, start_date=self.config['start_date'], end_date=cutoff_date)
+        log(f'Tuning on data before {cutoff_date}, validating on {validation_start:%Y-%m-%d} to {cutoff_date}')
+        self.temporal_data_split(data, validation_start, targets=self.config['targets'])
+        pool_paths = self.build_pools()
+
+        if storage_url.startswith('sqlite:///'):
+            os.makedirs(os.path.dirname(storage_url[len('sqlite:///'):]) or '.', exist_ok=True)
+        pruner = optuna.pruners.MedianPruner(n_startup_trials=5,
+                                             n_warmup_steps=self.config['tune_warmup_iterations'])
+        study = optuna.create_study(study_name=study_name, storage=_storage(storage_url),
+                                    direction='minimize', pruner=pruner, load_if_exists=True)
+        validation = f'{validation_start:%Y-%m-%d} to {cutoff_date}'
+        if study.trials and study.user_attrs.get('validation') != validation:
+            raise ValueError(f'study {study_name} was scored on {study.user_attrs.get("validation")} '
+                             f'instead of {validation}, use a new tune_study_name')
+        study.set_user_attr('validation', validation)
+        log(f'Tuning {n_trials} trials on {n_workers} workers, '
+            f'{len(study.trials)} trials already in study {study_name}')
+
+        thread_count = max(1, (os.cpu_count() or 1) // n_workers)
+        base_hps = self.hyperparameters(tuned=False)
+        args = (study_name, storage_url, pool_paths, base_hps, n_trials, thread_count,
+                self.config['tune_report_every'], self.config['tune_timeout'])
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for future in [executor.submit(_run_trials, *args) for _ in range(n_workers)]:
+                future.result()
+
+        study = optuna.load_study(study_name=study_name, storage=_storage(storage_url))
+        best = study.best_trial
+        best_hps = dict(best.params)
+        if 'best_iteration' in best.user_attrs:
+            best_hps['iterations'] = best.user_attrs['best_iteration'] + 1
+        log(f'Best trial {best.number}: {base_hps["loss_function"]} {best.value:.4f}, {best_hps}')
+        save_file({'hyperparameters': best_hps, 'tuned_until': str(cutoff_date)},
+                  self.config['hyperparameters_file'])
+        save_file(study.trials_dataframe(), f'data/experiment/{today()}/tuning_trials.csv', index=False)
+        return best_hps
+
+
+def main():
+    tuner = HyperparameterTuner()
+    tuner.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+walk-forward (rolling-origin) training and evaluation over many cutoff dates
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from catboost import CatBoostRegressor, Pool
+
+from utilities.util import save_file, log, today, drop_columns
+from models.train import ModelTrainer, validation_start_date
+from evaluation.evaluation import eval_dataset
+
+
+def make_folds(dates, first_cutoff, freq='QS', window='expanding', train_months=36):
+    """
+    Build the (train_start, cutoff, test_end) windows of a walk-forward run.
+
+    Args:
+        dates (pandas.Series): Dates of the data.
+        first_cutoff (str): First cutoff date.
+        freq (str): Frequency of the cutoffs, e.g. 'MS' (monthly) or 'QS' (quarterly).
+        window (str): 'expanding' trains on everything before the cutoff,
+            'sliding' on the train_months before it.
+        train_months (int): Length of the sliding training window.
+
+    Returns:
+        folds (list): (train_start, cutoff, test_end) tuples; the test window
+            of every fold runs until the next cutoff.
+    """
+    last_date = dates.max() + pd.Timedelta(days=1)
+    cutoffs = list(pd.date_range(first_cutoff, last_date, freq=freq)) + [last_date]
+    folds = []
+    for cutoff, test_end in zip(cutoffs[:-1], cutoffs[1:]):
+        if window == 'expanding':
+            train_start = dates.min()
+        elif window == 'sliding':
+            train_start = cutoff - pd.DateOffset(months=train_months)
+        else:
+            raise ValueError(f'window {window} not recognized.')
+        folds.append((train_start, cutoff, test_end))
+    return folds
+
+
+def _fit_fold(fold):
+    """
+    Fit one fold in a worker process on memory-mapped arrays and return the
+    predictions of its test window. The model is early-stopped on the
+    validation slice at the end of the fold's training window; without one
+    it trains for a fixed number of iterations. The test window is only
+    predicted.
+    """
+    (fold_id, shared_dir, fit_slice, validation_slice, test_slice, hps, cat_features,
+     thread_count) = fold
+    X = np.load(os.path.join(shared_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(shared_dir, 'y.npy'), mmap_mode='r')
+
+    def pool(rows):
+        if not cat_features:
+            return Pool(X[rows], y[rows])
+        data = pd.DataFrame(X[rows])
+        data[cat_features] = data[cat_features].astype('int64')
+        return Pool(data, y[rows], cat_features=cat_features)
+
+    fit_pool, test_pool = pool(slice(*fit_slice)), pool(slice(*test_slice))
+    if validation_slice is None:
+        hps = {key: value for key, value in hps.items() if key != 'early_stopping_rounds'}
+        eval_set = None
+    else:
+        eval_set = pool(slice(*validation_slice))
+    model = CatBoostRegressor(**hps, thread_count=thread_count, allow_writing_files=False)
+    model.fit(fit_pool, eval_set=eval_set, verbose=False)
+    return fold_id, model.predict(test_pool)
+
+
+class WalkForwardTrainer(ModelTrainer):
+    """
+    Fit one CatBoostRegressor per walk-forward fold, concurrently in a process
+    pool. The feature matrix is sorted by date and written once as .npy files
+    that every worker memory-maps, so each fold is a pair of contiguous row
+    slices instead of a pickled copy of the data.
+
+    Every fold holds out the last validation_months of its training window
+    for early stopping, and uses the tuned hyperparameters only when they
+    were tuned on data before its cutoff.
+    """
+
+    def share_arrays(self, data, shared_dir):
+        data = data.sort_index(kind='stable')
+        X = drop_columns(data, self.config['drop_features'])
+        cat_features = [i for i, col in enumerate(X.columns)
+                        if isinstance(X[col].dtype, pd.CategoricalDtype)]
+        for i in cat_features:
+            X[X.columns[i]] = X[X.columns[i]].cat.codes
+        save_file(X.to_numpy(dtype='float32'), os.path.join(shared_dir, 'X.npy'))
+        save_file(data[self.config['targets']].to_numpy(dtype='float32'),
+                  os.path.join(shared_dir, 'y.npy'))
+        return data, cat_features
+
+    def run(self):
+        filepath = f"data/processed_data/data_clean.{self.config['storage_format']}"
+        targets = self.config['targets']
+        shared_dir = f'data/experiment/{today()}/walk_forward'
+
+        data = self.load_features(filepath, start_date=self.config['start_date'],
+                                  end_date=self.config['end_date'])
+        data, cat_features = self.share_arrays(data, shared_dir)
+        dates = data.index.to_series()
+
+        folds = make_folds(dates,
+                           self.config['walk_forward_first_cutoff'],
+                           freq=self.config['walk_forward_freq'],
+                           window=self.config['walk_forward_window'],
+                           train_months=self.config['walk_forward_train_months'])
+        tasks, test_slices = [], {}
+        for fold_id, (train_start, cutoff, test_end) in enumerate(folds):
+            validation_start = max(validation_start_date(cutoff, self.config['validation_months']),
+                                   train_start)
+            fit_slice = tuple(dates.searchsorted([train_start, validation_start]))
+            validation_slice = tuple(dates.searchsorted([validation_start, cutoff]))
+            test_slice = tuple(dates.searchsorted([cutoff, test_end]))
+            if fit_slice[0] == fit_slice[1]:
+                # training window too short to hold out a validation tail
+                fit_slice, validation_slice = (fit_slice[0], validation_slice[1]), None
+            elif validation_slice[0] == validation_slice[1]:
+                validation_slice = None
+            if fit_slice[0] == fit_slice[1] or test_slice[0] == test_slice[1]:
+                continue
+            if validation_slice is None:
+                log(f'Fold {cutoff:%Y-%m-%d} has no validation window, training fixed iterations',
+                    level='warning')
+            test_slices[fold_id] = test_slice
+            tasks.append((fold_id, shared_dir, fit_slice, validation_slice, test_slice,
+                          self.hyperparameters(as_of=cutoff), cat_features,
+                          self.config['walk_forward_threads_per_fold']))
+        log(f'Walk-forward: {len(tasks)} folds on {self.config["walk_forward_workers"]} workers')
+
+        res = []
+        with ProcessPoolExecutor(max_workers=self.config['walk_forward_workers']) as executor:
+            for fold_id, y_pred in executor.map(_fit_fold, tasks):
+                _, cutoff, test_end = folds[fold_id]
+                df_fold = data.iloc[slice(*test_slices[fold_id])][targets].copy()
+                y_pred = y_pred.reshape(len(df_fold), -1)
+                for i, target in enumerate(targets):
+                    df_fold[f'Predictions_{target}'] = y_pred[:, i]
+                fold_name = f'{cutoff:%Y-%m-%d} to {test_end:%Y-%m-%d}'
+                res = eval_dataset(df_fold, targets, res, data_name=fold_name)
+
+        df_report = pd.DataFrame(res, columns=['Target', 'Dataset', 'RMSE', 'MAE', 'MAPE', 'R2'])
+        df_summary = df_report.groupby('Target')[['RMSE', 'MAE', 'MAPE', 'R2']].agg(['mean', 'std'])
+        print(df_report)
+        print(df_summary)
+        save_file(df_report, f'data/experiment/{today()}/walk_forward_report.csv', index=False)
+        return df_report
+
+
+def main():
+    trainer = WalkForwardTrainer()
+    trainer.run()
+
+
+if __name__ == "__main__":
+    main()
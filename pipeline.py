@@ -0,0 +1,241 @@
+"""
+run the pipeline stages as a DAG, skipping stages whose inputs did not change
+
+usage:
+    python pipeline.py                      # run every stage that is out of date
+    python pipeline.py --from train         # force train and everything downstream
+    python pipeline.py --to clean --force   # rerun every stage up to clean
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from utilities.util import load_config, load_file, save_file, log, project_modules, results_path, PROJECT_DIR
+
+STATE_PATH = 'data/pipeline_state.json'
+
+
+class Stage:
+    """
+    A pipeline stage: a function run in its own process, the files or
+    directories it reads and writes, the config keys it depends on and the
+    stages that must run before it.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), config_keys=(), deps=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config_keys = list(config_keys)
+        self.deps = list(deps)
+
+
+def build_stages(config):
+    fmt = config['storage_format']
+    market_data = (config['market_data_store'] if config['market_data_sync'] == 'incremental'
+                   else f"{config['data_dir']}/{config['start_date']} to {config['end_date']}.{fmt}")
+    selected_tickers = 'data/market_data/selected_tickers.csv'
+    universe = config['universe_path']
+    data_clean = f'data/processed_data/data_clean.{fmt}'
+    predictions = results_path(config, f'data_with_predictions.{fmt}')
+
+    return [
+        Stage('market_data', 'data_preparation.market_data_retrieval:download_main',
+              outputs=[market_data, selected_tickers, universe],
+              config_keys=['start_date', 'end_date', 'market_data_sync', 'storage_format',
+                           'price_panel_dir', 'price_panel_fields', 'universe_rules']),
+        Stage('earnings', 'data_preparation.market_data_retrieval:earnings_main',
+              inputs=[selected_tickers],
+              outputs=[config['eps_data_dir']],
+              config_keys=['end_date', 'eps_data_dir'],
+              deps=['market_data']),
+        Stage('clean', 'data_preparation.data_cleaning:main',
+              inputs=[market_data, universe, config['eps_data_dir']],
+              outputs=[data_clean],
+              config_keys=['start_date', 'end_date', 'target_engine', 'indicators', 'targets',
+                           'earnings_snap_days', 'earnings_asof_fields', 'earnings_asof_direction',
+                           'earnings_asof_tolerance_days',
+                           'target_outlier_threshold', 'float_dtype', 'storage_format'],
+              deps=['market_data', 'earnings']),
+        Stage('train', 'models.train:main',
+              inputs=[path for path in [data_clean, universe, config['hyperparameters_file']] if path],
+              outputs=[predictions],
+              config_keys=['start_date', 'end_date', 'cutoff_date', 'targets', 'drop_features',
+                           'categorical_features', 'features_to_lag', 'features_to_lead',
+                           'features_to_diff', 'n_lag', 'float_dtype', 'storage_format',
+                           'hyperparameters_file', 'catboost_thread_count', 'catboost_used_ram_limit'],
+              deps=['clean']),
+        Stage('evaluate', 'evaluation.evaluation:main',
+              inputs=[predictions],
+              outputs=[results_path(config, 'threshold_sweep.csv')],
+              config_keys=['cutoff_date', 'targets', 'threshold_sweep', 'bootstrap_replicates',
+                           'bootstrap_mode', 'bootstrap_block_days', 'bootstrap_alpha',
+                           'evaluation_mode', 'evaluation_group_by', 'evaluation_period'],
+              deps=['train']),
+        Stage('backtest', 'backtesting.backtest:main',
+              inputs=[path for path in [predictions, market_data, config['price_panel_dir'],
+                                        config['eps_data_dir']] if path],
+              outputs=[results_path(config, 'backtest_metrics.csv')],
+              config_keys=['cutoff_date', 'backtest_target', 'backtest_thresholds',
+                           'backtest_take_profits', 'backtest_stops', 'backtest_max_holding_days',
+                           'backtest_position_size', 'backtest_max_exposure'],
+              deps=['train']),
+    ]
+
+
+def _path_fingerprint(path):
+    """
+    Fingerprint a file or directory from the size and mtime of its files.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    entries = []
+    for root, _, files in os.walk(path):
+        for file_name in sorted(files):
+            stat = os.stat(os.path.join(root, file_name))
+            entries.append([os.path.relpath(os.path.join(root, file_name), path),
+                            stat.st_size, stat.st_mtime_ns])
+    return sorted(entries)
+
+
+def stage_fingerprint(stage, config):
+    code = {}
+    for path in project_modules(stage.func.split(':')[0]):
+        with open(path, 'rb') as f:
+            code[os.path.relpath(path, PROJECT_DIR)] = hashlib.sha256(f.read()).hexdigest()
+    parts = {'func': stage.func,
+             'code': code,
+             'inputs': {path: _path_fingerprint(path) for path in stage.inputs},
+             'config': {key: config.get(key) for key in stage.config_keys}}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _run_stage(func):
+    """
+    Run a stage function in a fresh worker process and report its wall time
+    and peak resident memory: the peak of the stage process plus the largest
+    peak of the worker processes it spawned (the kernel only reports the
+    maximum over children, so concurrent workers are counted once).
+    """
+    module_name, func_name = func.split(':')
+    start = time.perf_counter()
+    getattr(importlib.import_module(module_name), func_name)()
+    wall_time = time.perf_counter() - start
+    peak_memory_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                      + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    return wall_time, peak_memory_mb
+
+
+def _select(stages, from_stage, to_stage):
+    names = [stage.name for stage in stages]
+    for name in (from_stage, to_stage):
+        if name is not None and name not in names:
+            raise ValueError(f'stage {name} not recognized, choose from {names}')
+
+    by_name = {stage.name: stage for stage in stages}
+    downstream = set(names)
+    if from_stage is not None:
+        downstream = {from_stage}
+        for stage in stages:
+            if any(dep in downstream for dep in stage.deps):
+                downstream.add(stage.name)
+    upstream = set(names)
+    if to_stage is not None:
+        upstream, pending = set(), [to_stage]
+        while pending:
+            name = pending.pop()
+            upstream.add(name)
+            pending.extend(by_name[name].deps)
+    return [stage for stage in stages if stage.name in downstream & upstream]
+
+
+def run_pipeline(from_stage=None, to_stage=None, force=False, max_workers=2):
+    """
+    Run the selected stages in dependency order, independent stages
+    concurrently. A stage is skipped when its outputs exist and its
+    fingerprint (code, input files and config keys) matches the last
+    successful run, unless it was forced with force or from_stage.
+
+    Returns:
+        report (dict): Stage name to its status, wall time and peak memory.
+    """
+    config = load_config()
+    stages = _select(build_stages(config), from_stage, to_stage)
+    selected = {stage.name for stage in stages}
+    state = load_file(STATE_PATH) if os.path.exists(STATE_PATH) else {}
+    forced = {stage.name for stage in stages} if force or from_stage is not None else set()
+
+    report = {}
+    done = set()
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                             max_tasks_per_child=1) as executor:
+        while pending or running:
+            ready = [stage for stage in pending.values()
+                     if all(dep in done or dep not in selected for dep in stage.deps)]
+            for stage in ready:
+                del pending[stage.name]
+                fingerprint = stage_fingerprint(stage, config)
+                outputs_exist = all(os.path.exists(path) for path in stage.outputs)
+                if (stage.name not in forced and outputs_exist
+                        and state.get(stage.name, {}).get('fingerprint') == fingerprint):
+                    log(f'Stage {stage.name} is up to date, skipping')
+                    report[stage.name] = {'status': 'skipped'}
+                    done.add(stage.name)
+                    continue
+                log(f'Running stage {stage.name}')
+                running[executor.submit(_run_stage, stage.func)] = stage
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                wall_time, peak_memory_mb = future.result()
+                log(f'Stage {stage.name} finished in {wall_time:.1f}s, '
+                    f'peak memory {peak_memory_mb:.0f} MB')
+                # fingerprint after the run: outputs of upstream stages are final now
+                state[stage.name] = {'fingerprint': stage_fingerprint(stage, config),
+                                     'wall_time': wall_time,
+                                     'peak_memory_mb': peak_memory_mb,
+                                     'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+                save_file(state, STATE_PATH)
+                report[stage.name] = {'status': 'ran', 'wall_time': wall_time,
+                                      'peak_memory_mb': peak_memory_mb}
+                done.add(stage.name)
+                # downstream stages must rerun once an upstream stage ran
+                forced.update(s.name for s in pending.values() if stage.name in s.deps)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the pipeline stages.')
+    parser.add_argument('--from', dest='from_stage', help='force this stage and everything downstream')
+    parser.add_argument('--to', dest='to_stage', help='stop after this stage')
+    parser.add_argument('--force', action='store_true', help='rerun up-to-date stages too')
+    parser.add_argument('--workers', type=int, default=2, help='stages run concurrently')
+    args = parser.parse_args()
+
+    report = run_pipeline(args.from_stage, args.to_stage, args.force, args.workers)
+    for name, stage_report in report.items():
+        if stage_report['status'] == 'ran':
+            print(f"{name:<12} ran      {stage_report['wall_time']:>8.1f}s "
+                  f"{stage_report['peak_memory_mb']:>8.0f} MB")
+        else:
+            print(f'{name:<12} skipped')
+
+
+if __name__ == '__main__':
+    main()
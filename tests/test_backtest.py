@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+from backtesting.backtest import run_backtest, event_paths, simulate_trades
+
+
+def backtest(prices, events, predictions, next_release=None, **kwargs):
+    dates = pd.bdate_range('2024-01-01', periods=prices.shape[1]).to_numpy()
+    tickers = pd.Index([f'T{i}' for i in range(len(prices))])
+    df_predictions = pd.DataFrame({'Ticker': [ticker for ticker, _ in events],
+                                   'Date': [dates[day] for _, day in events],
+                                   'Predictions_target': predictions})
+    if next_release is None:
+        next_release = np.full(len(events), np.datetime64('NaT'), dtype='datetime64[ns]')
+    options = dict(thresholds=np.array([0.0]), take_profits=np.array([10.0]), stops=np.array([50.0]),
+                   max_holding_days=4, position_size=0.5)
+    options.update(kwargs)
+    return run_backtest(df_predictions, prices, tickers, dates, next_release, 'target', **options)
+
+
+def test_entry_at_the_next_close_and_equity_marked_to_market():
+    prices = np.array([[100, 100, 110, 99, 88, 121, 132, 140.0]])
+    # released after the close of day 1: enter at 110 on day 2, time exit on day 6
+    df_metrics, equity = backtest(prices, [('T0', 1)], [5.0])
+
+    # half of the equity is held at every close
+    expected = np.ones(8)
+    expected[3:7] = np.cumprod(1 + 0.5 * (prices[0, 3:7] / prices[0, 2:6] - 1))
+    expected[7:] = expected[6]
+    np.testing.assert_allclose(equity[0], expected)
+    assert df_metrics.loc[0, 'n_trades'] == 1
+    np.testing.assert_allclose(df_metrics.loc[0, 'avg_trade_return'], 132 / 110 - 1)
+    # the open loss on day 4 is in the drawdown
+    np.testing.assert_allclose(df_metrics.loc[0, 'max_drawdown'], expected[4] - 1)
+
+
+def test_take_profit_fill_and_next_release_exit():
+    prices = np.array([[100, 100, 100, 104, 112, 90, 80, 70.0]])
+    next_release = pd.to_datetime([pd.bdate_range('2024-01-01', periods=8)[5]]).to_numpy()
+    # take profit at 2 * 5% = 10% fills at 110 on day 4
+    _, equity = backtest(prices, [('T0', 1)], [5.0], next_release, take_profits=np.array([2.0]))
+    filled = 1.02 * (1 + 0.5 * (110 / 104 - 1))
+    np.testing.assert_allclose(equity[0], [1, 1, 1, 1.02, filled, filled, filled, filled])
+
+    # without it, the trade exits on the day before the next release
+    _, equity = backtest(prices, [('T0', 1)], [5.0], next_release)
+    np.testing.assert_allclose(equity[0, -1], 1.02 * (1 + 0.5 * (112 / 104 - 1)))
+
+
+def reference_equity(prices, events, predictions, threshold, take_profit, stop, max_holding_days,
+                     position_size, max_exposure):
+    """
+    Equity curve of one combination, stepping through the dates and the
+    open trades one by one.
+    """
+    dates = pd.bdate_range('2024-01-01', periods=prices.shape[1]).to_numpy()
+    ticker_idx = np.array([int(ticker[1:]) for ticker, _ in events])
+    entry_idx = np.array([day for _, day in events]) + 1
+    returns, lengths = event_paths(prices, dates, ticker_idx, entry_idx,
+                                   np.full(len(events), len(dates)), max_holding_days)
+    exit_day, trade_return = simulate_trades(returns, lengths, predictions, [take_profit], [stop],
+                                             max_holding_days)
+    equity = [1.0]
+    for date in range(1, prices.shape[1]):
+        open_returns = []
+        for i in np.flatnonzero(predictions > threshold):
+            day = date - entry_idx[i] - 1
+            if 0 <= day <= exit_day[0, i]:
+                value = trade_return[0, i] if day == exit_day[0, i] else returns[i, day]
+                previous = returns[i, day - 1] if day > 0 else 0.0
+                open_returns.append((1 + value) / (1 + previous) - 1)
+        weight = min(position_size, max_exposure / max(len(open_returns), 1))
+        equity.append(equity[-1] * (1 + weight * sum(open_returns)))
+    return np.array(equity)
+
+
+def test_equity_matches_a_trade_by_trade_simulation():
+    rng = np.random.default_rng(0)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, size=(5, 60)), axis=1))
+    events = [(f'T{rng.integers(5)}', int(rng.integers(50))) for _ in range(40)]
+    predictions = rng.uniform(0, 20, size=40)
+    thresholds, take_profits, stops = np.arange(0, 20, 5.0), np.array([0.5, 1.0]), np.array([2.0, 10.0])
+
+    df_metrics, equity = backtest(prices, events, predictions, thresholds=thresholds,
+                                  take_profits=take_profits, stops=stops, max_holding_days=10,
+                                  position_size=0.2, max_exposure=0.6)
+
+    assert len(df_metrics) == len(equity) == 16
+    for i, combination in df_metrics.iterrows():
+        expected = reference_equity(prices, events, predictions, combination['threshold'],
+                                    combination['take_profit'], combination['stop'], 10, 0.2, 0.6)
+        np.testing.assert_allclose(equity[i], expected)
+    assert (df_metrics.groupby(['take_profit', 'stop'])['n_trades'].apply(
+        lambda n: n.is_monotonic_decreasing)).all()
+
+
+def test_equity_stays_positive_when_many_trades_overlap():
+    # 200 trades entered on the same day lose 90% without hitting a stop
+    prices = np.tile(np.array([100, 100, 100, 60, 30, 10, 10.0]), (200, 1))
+    events = [(f'T{i}', 1) for i in range(200)]
+
+    df_metrics, equity = backtest(prices, events, np.full(200, 5.0), stops=np.array([100.0]),
+                                  position_size=0.02, max_exposure=0.5)
+
+    assert (equity > 0).all()
+    # together the trades hold half of the equity
+    np.testing.assert_allclose(equity[0, -1], 0.8 * 0.75 * (1 - 0.5 * 2 / 3))
+    assert df_metrics.loc[0, 'n_trades'] == 200
@@ -0,0 +1,125 @@
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from data_preparation.earnings_fetcher import EarningsFetcher
+
+
+class StubEarningsServer:
+    """
+    Local HTTP server standing in for the Yahoo earnings endpoint. Each
+    ticker gets the responses of its script in turn (status codes; 200
+    returns one earnings row), then 200 forever.
+    """
+
+    def __init__(self, scripts=None):
+        self.scripts = {ticker: list(codes) for ticker, codes in (scripts or {}).items()}
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                ticker = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['ticker']
+                with stub.lock:
+                    stub.requests[ticker] += 1
+                    script = stub.scripts.get(ticker, [])
+                    status = script.pop(0) if script else 200
+                body = json.dumps({'rows': [[ticker, '2024-01-25T21:00:00.000Z', 1.5]]}).encode()
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def build_payload(ticker):
+    return {'ticker': ticker}
+
+
+def parse_response(response):
+    return pd.DataFrame(response.json()['rows'], columns=['Symbol', 'Event Start Date', 'Reported EPS'])
+
+
+def make_fetcher(url, out_dir, **kwargs):
+    options = dict(run_key='2024-03-15', max_workers=4, rate=1000, max_retries=3,
+                   backoff=0.001, batch_size=2)
+    options.update(kwargs)
+    return EarningsFetcher(url, headers={'Content-Type': 'application/json'}, out_dir=str(out_dir),
+                           **options)
+
+
+def test_retries_429_and_5xx_with_backoff(tmp_path):
+    scripts = {'RATE': [429, 429], 'FLAKY': [500, 503]}
+    with StubEarningsServer(scripts) as stub:
+        failed = make_fetcher(stub.url, tmp_path).fetch_all(['RATE', 'FLAKY', 'OK'],
+                                                            build_payload, parse_response)
+
+    assert failed == {}
+    assert stub.requests == {'RATE': 3, 'FLAKY': 3, 'OK': 1}
+    for ticker in ['RATE', 'FLAKY', 'OK']:
+        assert pd.read_csv(tmp_path / f'{ticker}.csv')['Symbol'].tolist() == [ticker]
+
+
+def test_failed_tickers_are_recorded_and_retried_on_resume(tmp_path):
+    scripts = {'DOWN': [503] * 4, 'GONE': [404]}
+    with StubEarningsServer(scripts) as stub:
+        fetcher = make_fetcher(stub.url, tmp_path)
+        failed = fetcher.fetch_all(['DOWN', 'GONE', 'OK'], build_payload, parse_response)
+
+        assert set(failed) == {'DOWN', 'GONE'}
+        assert fetcher.load_failed() == failed
+        assert fetcher.load_completed() == {'OK'}
+        # retries stop after max_retries, other errors are not retried
+        assert stub.requests == {'DOWN': 4, 'GONE': 1, 'OK': 1}
+
+        failed = make_fetcher(stub.url, tmp_path).fetch_all(['DOWN', 'GONE', 'OK'],
+                                                            build_payload, parse_response)
+
+    assert failed == {}
+    assert stub.requests == {'DOWN': 5, 'GONE': 2, 'OK': 1}
+
+
+def test_interrupted_run_resumes_from_the_manifest(tmp_path):
+    tickers = ['A', 'B', 'C', 'D']
+
+    def interrupted_parse(response):
+        if response.json()['rows'][0][0] == 'C':
+            raise KeyboardInterrupt
+        return parse_response(response)
+
+    with StubEarningsServer() as stub:
+        with pytest.raises(KeyboardInterrupt):
+            make_fetcher(stub.url, tmp_path, max_workers=1, batch_size=1)\
+                .fetch_all(tickers, build_payload, interrupted_parse)
+        assert make_fetcher(stub.url, tmp_path).load_completed() == {'A', 'B'}
+        stub.requests.clear()
+
+        make_fetcher(stub.url, tmp_path).fetch_all(tickers, build_payload, parse_response)
+        assert stub.requests == {'C': 1, 'D': 1}
+
+        # a new run key starts over
+        stub.requests.clear()
+        make_fetcher(stub.url, tmp_path, run_key='2024-06-15').fetch_all(tickers, build_payload,
+                                                                         parse_response)
+        assert stub.requests == {ticker: 1 for ticker in tickers}
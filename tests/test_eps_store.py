@@ -0,0 +1,54 @@
+import pandas as pd
+
+from data_preparation.eps_store import read_eps_file, compact_eps_data, EPS_COLUMNS
+from data_preparation.data_cleaning import generate_targets_vectorized
+
+
+def _write_eps_csv(path, symbol, release_times):
+    pd.DataFrame({'Symbol': symbol,
+                  'Event Start Date': release_times,
+                  'EPS Estimate': 1.0,
+                  'Reported EPS': 1.1,
+                  'Surprise (%)': 10.0}).to_csv(path, index=False)
+
+
+def test_read_eps_file_keeps_the_release_day(tmp_path):
+    path = tmp_path / 'AAA.csv'
+    _write_eps_csv(path, 'AAA', ['2024-01-25T21:00:00.000Z', '2024-04-25T12:30:00.000Z'])
+
+    df = read_eps_file(path)
+
+    assert list(df['Event Start Date']) == [pd.Timestamp('2024-01-25'), pd.Timestamp('2024-04-25')]
+
+
+def test_release_times_match_market_dates_exactly(tmp_path):
+    eps_dir, store_dir = tmp_path / 'eps', tmp_path / 'store'
+    eps_dir.mkdir()
+    _write_eps_csv(eps_dir / 'AAA.csv', 'AAA', ['2024-01-04T21:00:00.000Z', '2024-01-10T21:00:00.000Z'])
+    df_eps = pd.read_parquet(compact_eps_data(str(eps_dir), str(store_dir), n_workers=1),
+                             columns=EPS_COLUMNS)
+    dates = pd.bdate_range('2024-01-02', '2024-01-12')
+    df_market = pd.DataFrame({'Date': dates, 'Ticker': 'AAA',
+                              'Adj Close': range(len(dates)), 'Volume': 1.0})
+
+    merged = generate_targets_vectorized(df_market, df_eps)
+
+    assert merged['Surprise (%)'].notna().sum() == 2
+    target = merged.loc[merged['Date'] == '2024-01-04', 'period_max_price'].item()
+    assert target == df_market.loc[df_market['Date'] == '2024-01-09', 'Adj Close'].item()
+
+
+def test_store_of_another_version_is_rebuilt(tmp_path):
+    eps_dir, store_dir = tmp_path / 'eps', tmp_path / 'store'
+    eps_dir.mkdir()
+    _write_eps_csv(eps_dir / 'AAA.csv', 'AAA', ['2024-01-04T21:00:00.000Z'])
+    store_path = compact_eps_data(str(eps_dir), str(store_dir), n_workers=1)
+    # a manifest without a store version (file name -> mtime)
+    pd.Series({'AAA.csv': (eps_dir / 'AAA.csv').stat().st_mtime}).to_json(store_dir / 'manifest.json')
+    pd.DataFrame({'Symbol': ['AAA'], 'Event Start Date': [pd.Timestamp('2024-01-04 21:00')],
+                  'EPS Estimate': [1.0], 'Reported EPS': [1.1],
+                  'Surprise (%)': [10.0]}).to_parquet(store_path, index=False)
+
+    compact_eps_data(str(eps_dir), str(store_dir), n_workers=1)
+
+    assert list(pd.read_parquet(store_path)['Event Start Date']) == [pd.Timestamp('2024-01-04')]
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.metrics import (mean_squared_error, mean_absolute_error, r2_score,
+                             mean_absolute_percentage_error)
+
+from evaluation.evaluation import threshold_sweep
+from evaluation.streaming import MetricAccumulator, evaluate_file, merge_accumulators
+
+
+def test_threshold_sweep_matches_filtering_per_threshold():
+    rng = np.random.default_rng(0)
+    # rounded predictions put rows exactly on the thresholds
+    data = pd.DataFrame({'target': rng.normal(2, 10, 2000),
+                         'Predictions_target': np.round(rng.normal(2, 8, 2000))})
+    data.loc[rng.choice(2000, 50, replace=False), 'Predictions_target'] = np.nan
+    thresholds = np.arange(-10, 30, 0.5)
+
+    df_sweep = threshold_sweep(data, 'target', thresholds)
+
+    for threshold, row in zip(thresholds, df_sweep.to_dict('records')):
+        selected = data[data['Predictions_target'] > threshold]
+        y_true, y_pred = selected['target'], selected['Predictions_target']
+        correct_sign = y_true * y_pred > 0
+        sellable = correct_sign & (y_pred > 0) & (y_true > y_pred)
+        assert row['n_selected'] == len(selected)
+        assert row['n_correct_sign'] == correct_sign.sum()
+        if len(selected):
+            np.testing.assert_allclose(row['Correct sign pct'], correct_sign.mean() * 100)
+            np.testing.assert_allclose(row['same_sign_and_pred_positive_sellable_pct'], sellable.mean() * 100)
+
+
+def make_predictions(n_rows=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.to_datetime('2021-01-01') + pd.to_timedelta(rng.integers(0, 1000, n_rows), 'D')
+    data = pd.DataFrame({'Date': dates,
+                         'Ticker': rng.choice(['AAA', 'BBB', 'CCC'], n_rows)})
+    for target in ['max_pct', 'min_pct']:
+        data[target] = rng.normal(3, 10, n_rows)
+        data[f'Predictions_{target}'] = data[target] * 0.5 + rng.normal(0, 5, n_rows)
+    return data
+
+
+def expected_metrics(data, target):
+    y_true, y_pred = data[target], data[f'Predictions_{target}']
+    return {'n': len(data),
+            'RMSE': np.sqrt(mean_squared_error(y_true, y_pred)),
+            'MAE': mean_absolute_error(y_true, y_pred),
+            'MAPE': mean_absolute_percentage_error(y_true, y_pred),
+            'R2': r2_score(y_true, y_pred),
+            'Correct sign pct': (y_true * y_pred > 0).mean() * 100}
+
+
+@pytest.mark.parametrize('group_by, n_workers', [(['split'], 3), (['split', 'ticker'], 1), (['period'], 2)])
+def test_evaluate_file_matches_sklearn_on_a_chunked_file(tmp_path, group_by, n_workers):
+    data = make_predictions()
+    file_path = str(tmp_path / 'predictions.parquet')
+    data.to_parquet(file_path, index=False, row_group_size=700)
+    thresholds = np.arange(-10, 20, 2.5)
+
+    df_metrics, df_thresholds = evaluate_file(file_path, ['max_pct', 'min_pct'], '2022-06-01',
+                                              group_by=group_by, period='Y', thresholds=thresholds,
+                                              chunk_rows=300, n_workers=n_workers)
+
+    keys = pd.DataFrame({'split': np.where(data['Date'] < '2022-06-01', 'Train', 'Test'),
+                         'ticker': data['Ticker'],
+                         'period': data['Date'].dt.to_period('Y').astype(str)})[group_by]
+    groups = data.groupby([keys[key] for key in group_by])
+    assert len(df_metrics) == 2 * groups.ngroups
+    for row in df_metrics.to_dict('records'):
+        group = groups.get_group(tuple(row[key] for key in group_by))
+        expected = expected_metrics(group, row['Target'])
+        for metric, value in expected.items():
+            np.testing.assert_allclose(row[metric], value, rtol=1e-9)
+
+        expected_sweep = threshold_sweep(group, row['Target'], thresholds)
+        mask = df_thresholds['Target'] == row['Target']
+        for key in group_by:
+            mask &= df_thresholds[key] == row[key]
+        pd.testing.assert_frame_equal(df_thresholds.loc[mask, expected_sweep.columns].reset_index(drop=True),
+                                      expected_sweep, check_dtype=False)
+
+
+def test_merged_accumulators_match_one_pass():
+    data = make_predictions(seed=1)
+    y_true, y_pred = data['max_pct'].to_numpy(), data['Predictions_max_pct'].to_numpy()
+    thresholds = np.arange(-10, 20, 5.0)
+
+    parts = []
+    for rows in np.array_split(np.random.default_rng(0).permutation(len(data)), 7):
+        accumulator = MetricAccumulator(thresholds)
+        accumulator.update(y_true[rows], y_pred[rows])
+        parts.append({'all': accumulator})
+    merged = merge_accumulators(parts[::-1])['all']
+
+    expected = expected_metrics(data, 'max_pct')
+    for metric, value in merged.metrics().items():
+        np.testing.assert_allclose(value, expected[metric], rtol=1e-9)
+    np.testing.assert_array_equal(merged.n_selected, threshold_sweep(data, 'max_pct', thresholds)['n_selected'])
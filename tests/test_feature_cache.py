@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+import utilities.util
+from data_preparation import feature_cache
+from data_preparation.feature_cache import FeatureCache, code_version
+
+
+def _frame(n_rows, seed=0):
+    return pd.DataFrame({'x': np.random.default_rng(seed).normal(size=n_rows)})
+
+
+def _write_dir(n_bytes):
+    def build(dir_path):
+        with open(os.path.join(dir_path, 'train.quantized'), 'wb') as f:
+            f.write(b'\0' * n_bytes)
+    return build
+
+
+def test_code_version_covers_the_imported_project_modules(tmp_path, monkeypatch):
+    monkeypatch.setattr(utilities.util, 'PROJECT_DIR', str(tmp_path))
+    monkeypatch.setattr(feature_cache, 'PROJECT_DIR', str(tmp_path))
+    (tmp_path / 'models').mkdir()
+    (tmp_path / 'data_preparation').mkdir()
+    (tmp_path / 'models' / 'train.py').write_text('from data_preparation.universe import UniverseIndex\n')
+    (tmp_path / 'data_preparation' / 'universe.py').write_text('class UniverseIndex: pass\n')
+    before = code_version('models.train')
+
+    (tmp_path / 'data_preparation' / 'universe.py').write_text('class UniverseIndex:\n    x = 1\n')
+    assert code_version('models.train') != before
+    assert code_version('models.train') == code_version('models.train', 'data_preparation.universe')
+
+
+def test_pinned_entries_are_not_evicted(tmp_path):
+    cache = FeatureCache(str(tmp_path), max_bytes=1500)
+    pool_dir = cache.put_dir('pools', _write_dir(1000))
+    cache.put_dir('other', _write_dir(1000))
+
+    # the pools are pinned by this process, e.g. while tuning workers read them
+    assert os.path.isdir(pool_dir)
+    assert cache.get_dir('pools') == pool_dir
+
+    cache.unpin('pools')
+    cache.unpin('other')
+    cache.put_dir('newest', _write_dir(1000))
+    assert cache.get_dir('pools') is None
+
+
+def test_pins_of_exited_processes_are_ignored(tmp_path):
+    cache = FeatureCache(str(tmp_path), max_bytes=1500)
+    process = multiprocessing.get_context('fork').Process(target=cache.put_dir,
+                                                          args=('pools', _write_dir(1000)))
+    process.start()
+    process.join()
+
+    cache.put_dir('newest', _write_dir(1000))
+    assert cache.get_dir('pools') is None
+
+
+def _put_entries(cache_dir, worker):
+    cache = FeatureCache(cache_dir)
+    for i in range(5):
+        cache.put(f'{worker}-{i}', _frame(100, seed=i))
+        cache.get(f'{worker}-{i}')
+
+
+def test_concurrent_writers_keep_every_entry(tmp_path):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_put_entries, args=(str(tmp_path), worker)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    cache = FeatureCache(str(tmp_path))
+    assert len(cache._load_index()['entries']) == 20
+    pd.testing.assert_frame_equal(cache.get('3-4'), _frame(100, seed=4))
+    assert not [name for name in os.listdir(tmp_path) if '.tmp' in name]
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_preparation.feature_engineer import compute_indicators, build_lags
+from data_preparation.feature_state import StreamingFeatureEngine, _Ring
+
+INDICATORS = [{'type': 'ma', 'window': 5}, {'type': 'ma', 'window': 20},
+              {'type': 'rsi', 'window': 14}, {'type': 'volatility', 'window': 10}]
+LAGS = {'pct_change': 7, 'Volume': [1, 5]}
+DIFFS = {'pct_change': [1, 3]}
+
+
+def _history(n_tickers=6, n_dates=300, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2020-01-01', periods=n_dates)
+    frames = []
+    for i in range(n_tickers):
+        start = rng.integers(0, 50)
+        price = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, n_dates - start)))
+        price[rng.random(len(price)) < 0.02] = np.nan
+        price[rng.integers(0, len(price))] = 0.0
+        frames.append(pd.DataFrame({'Date': dates[start:], 'Ticker': f'T{i}',
+                                    'Adj Close': price,
+                                    'Volume': rng.integers(1000, 10 ** 6, len(price)).astype(float)}))
+    # rows interleaved by date, as bars arrive
+    return pd.concat(frames).sort_values(['Date', 'Ticker'], ignore_index=True)
+
+
+def _batch_features(data):
+    data = data.copy()
+    data['pct_change'] = data.groupby('Ticker')['Adj Close'].pct_change(fill_method=None) * 100
+    data = pd.concat([data, compute_indicators(data, INDICATORS)], axis=1)
+    return build_lags(data, lags=LAGS, diffs=DIFFS)
+
+
+def test_replayed_history_matches_batch_features_exactly():
+    data = _history()
+    expected = _batch_features(data)
+
+    engine = StreamingFeatureEngine(indicators=INDICATORS, lags=LAGS, diffs=DIFFS)
+    features = engine.update_many(data)
+
+    assert len(features.columns) == 1 + len(INDICATORS) + 7 + 2 + 2
+    for col in features.columns:
+        np.testing.assert_array_equal(features[col].to_numpy(), expected[col].to_numpy(dtype='float64'),
+                                      err_msg=col)
+
+
+def test_snapshot_restore_continues_the_replay(tmp_path):
+    data = _history(seed=1)
+    split = data['Date'] >= data['Date'].iloc[len(data) // 2]
+    engine = StreamingFeatureEngine(indicators=INDICATORS, lags=LAGS, diffs=DIFFS)
+    full = engine.update_many(data)
+
+    engine = StreamingFeatureEngine(indicators=INDICATORS, lags=LAGS, diffs=DIFFS)
+    engine.update_many(data[~split])
+    engine.snapshot(str(tmp_path / 'state.pkl'))
+    restored = StreamingFeatureEngine.restore(str(tmp_path / 'state.pkl'))
+
+    pd.testing.assert_frame_equal(restored.update_many(data[split]), full[split])
+
+
+def test_forward_looking_indicators_are_rejected():
+    with pytest.raises(ValueError):
+        StreamingFeatureEngine(indicators=[{'type': 'return', 'window': 5}])
+
+
+def test_ring_returns_the_latest_values_across_the_wrap():
+    ring = _Ring(5)
+    for value in range(12):
+        ring.push(float(value))
+        for k in range(1, min(value + 1, 5) + 1):
+            np.testing.assert_array_equal(ring.last(k), np.arange(value - k + 1, value + 1))
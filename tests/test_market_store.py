@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_preparation.market_store import MarketDataStore
+
+
+class FakeProvider:
+    """
+    Stands in for yfinance: deterministic daily bars of every business day in
+    [start_date, end_date), scaled by the ticker's adjustment factor,
+    recording every call.
+    """
+
+    def __init__(self, listings=None):
+        self.listings = listings or {}
+        self.adjustments = {}
+        self.calls = []
+
+    def __call__(self, tickers, start_date, end_date):
+        self.calls.append((tuple(tickers), start_date, end_date))
+        frames = []
+        for ticker in tickers:
+            dates = pd.bdate_range(max(pd.Timestamp(start_date), self.listings.get(ticker, pd.Timestamp.min)),
+                                   pd.Timestamp(end_date) - pd.Timedelta(days=1))
+            close = 100.0 + 10 * (ord(ticker[0]) - ord('A')) + (dates - pd.Timestamp('2024-01-01')).days
+            frames.append(pd.DataFrame({'Ticker': ticker, 'Date': dates,
+                                        'Adj Close': close * self.adjustments.get(ticker, 1.0),
+                                        'Volume': 1000.0}))
+        return pd.concat(frames, ignore_index=True)
+
+
+def _expected(provider, tickers, start_date, end_date):
+    data = FakeProvider(provider.listings)
+    data.adjustments = provider.adjustments
+    return data(tickers, start_date, end_date).sort_values(['Ticker', 'Date'], ignore_index=True)
+
+
+def test_sync_then_read_windows(tmp_path):
+    store = MarketDataStore(str(tmp_path / 'store'))
+    provider = FakeProvider()
+
+    store.sync(['AAA', 'BBB'], '2024-01-01', '2024-02-01', provider, batch_size=1)
+
+    assert store.last_dates() == {'AAA': pd.Timestamp('2024-01-31'), 'BBB': pd.Timestamp('2024-01-31')}
+    window = store.read(start_date='2024-01-10', end_date='2024-01-19', tickers=['BBB'])
+    expected = _expected(provider, ['AAA', 'BBB'], '2024-01-01', '2024-02-01')
+    expected = expected[(expected['Ticker'] == 'BBB') & expected['Date'].between('2024-01-10', '2024-01-19')]
+    pd.testing.assert_frame_equal(window[expected.columns], expected.reset_index(drop=True),
+                                  check_dtype=False)
+
+
+def test_sync_fetches_only_the_tail_and_new_listings(tmp_path):
+    store = MarketDataStore(str(tmp_path / 'store'))
+    provider = FakeProvider(listings={'CCC': pd.Timestamp('2024-02-05')})
+    store.sync(['AAA'], '2024-01-01', '2024-02-01', provider)
+    provider.calls.clear()
+
+    store.sync(['AAA', 'CCC'], '2024-01-01', '2024-03-01', provider)
+
+    assert provider.calls == [(('CCC',), '2024-01-01', '2024-03-01'),
+                              (('AAA',), '2024-01-31', '2024-03-01')]
+    data = store.read()
+    for ticker in ['AAA', 'CCC']:
+        dates = data.loc[data['Ticker'] == ticker, 'Date']
+        assert dates.is_unique and dates.is_monotonic_increasing
+    assert store.last_dates()['CCC'] == pd.Timestamp('2024-02-29')
+    assert not [f for _, _, files in os.walk(store.store_dir) for f in files if f.endswith('.tmp')]
+
+
+def test_sync_is_a_no_op_when_up_to_date(tmp_path):
+    store = MarketDataStore(str(tmp_path / 'store'))
+    provider = FakeProvider()
+    store.sync(['AAA'], '2024-01-01', '2024-02-01', provider)
+    provider.calls.clear()
+
+    store.sync(['AAA'], '2024-01-01', '2024-02-01', provider)
+
+    assert provider.calls == []
+
+
+def test_restated_history_is_refetched(tmp_path):
+    store = MarketDataStore(str(tmp_path / 'store'))
+    provider = FakeProvider()
+    store.sync(['AAA', 'BBB'], '2024-01-01', '2024-02-01', provider)
+
+    # a dividend restates the whole adjusted history of AAA
+    provider.adjustments['AAA'] = 0.98
+    provider.calls.clear()
+    store.sync(['AAA', 'BBB'], '2024-01-01', '2024-03-01', provider)
+
+    data = store.read().set_index(['Ticker', 'Date'])['Adj Close']
+    expected = _expected(provider, ['AAA', 'BBB'], '2024-01-01', '2024-03-01')\
+        .set_index(['Ticker', 'Date'])['Adj Close']
+    # AAA is entirely on the new basis, BBB was not restated and only appended
+    np.testing.assert_allclose(data.loc['AAA'], expected.loc['AAA'])
+    np.testing.assert_allclose(data.loc['BBB'], expected.loc['BBB'])
+    assert provider.calls == [(('AAA', 'BBB'), '2024-01-31', '2024-03-01'),
+                              (('AAA',), '2024-01-01', '2024-03-01')]
+
+
+def test_earlier_start_date_fetches_the_missing_head(tmp_path):
+    store = MarketDataStore(str(tmp_path / 'store'))
+    provider = FakeProvider(listings={'CCC': pd.Timestamp('2024-02-05')})
+    store.sync(['AAA', 'CCC'], '2024-03-01', '2024-03-30', provider)
+    provider.calls.clear()
+
+    store.sync(['AAA', 'CCC'], '2024-01-01', '2024-03-30', provider)
+
+    # only the head, up to and including the first stored date
+    assert provider.calls == [(('AAA', 'CCC'), '2024-01-01', '2024-03-02')]
+    data = store.read(start_date='2024-01-01')
+    expected = _expected(provider, ['AAA', 'CCC'], '2024-01-01', '2024-03-30')
+    pd.testing.assert_frame_equal(data[expected.columns], expected, check_dtype=False)
+
+    # CCC was listed after the start date: its head is not fetched again
+    provider.calls.clear()
+    store.sync(['AAA', 'CCC'], '2024-01-01', '2024-03-30', provider)
+    assert provider.calls == []
+
+
+def test_restated_history_is_refetched_with_the_head(tmp_path):
+    store = MarketDataStore(str(tmp_path / 'store'))
+    provider = FakeProvider()
+    store.sync(['AAA'], '2024-03-01', '2024-03-30', provider)
+
+    provider.adjustments['AAA'] = 0.98
+    provider.calls.clear()
+    store.sync(['AAA'], '2024-01-01', '2024-03-30', provider)
+
+    assert provider.calls == [(('AAA',), '2024-01-01', '2024-03-02'),
+                              (('AAA',), '2024-01-01', '2024-03-30')]
+    data = store.read()
+    expected = _expected(provider, ['AAA'], '2024-01-01', '2024-03-30')
+    pd.testing.assert_frame_equal(data[expected.columns], expected, check_dtype=False)
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+import pipeline
+from pipeline import Stage, build_stages, run_pipeline
+from utilities.util import load_config, PROJECT_DIR
+
+
+def clean():
+    _run('clean', 'raw.txt', 'clean.txt')
+
+
+def train():
+    _run('train', 'clean.txt', 'results/predictions.txt')
+
+
+def evaluate():
+    _run('evaluate', 'results/predictions.txt', 'results/metrics.txt')
+
+
+def _run(name, input_path, output_path):
+    with open(input_path) as f:
+        text = f.read()
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as f:
+        f.write(text + name)
+    with open('runs.log', 'a') as f:
+        f.write(name + '\n')
+
+
+def fake_stages(config):
+    return [Stage('clean', 'tests.test_pipeline:clean', inputs=['raw.txt'], outputs=['clean.txt'],
+                  config_keys=['n_lag']),
+            Stage('train', 'tests.test_pipeline:train', inputs=['clean.txt'],
+                  outputs=['results/predictions.txt'], deps=['clean']),
+            Stage('evaluate', 'tests.test_pipeline:evaluate', inputs=['results/predictions.txt'],
+                  outputs=['results/metrics.txt'], deps=['train'])]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, 'build_stages', fake_stages)
+    (tmp_path / 'config.yaml').write_text('n_lag: 7\n')
+    (tmp_path / 'raw.txt').write_text('raw')
+    return tmp_path
+
+
+def runs(workdir):
+    path = workdir / 'runs.log'
+    runs = path.read_text().split() if path.exists() else []
+    path.unlink(missing_ok=True)
+    return runs
+
+
+def statuses(report):
+    return {name: stage_report['status'] for name, stage_report in report.items()}
+
+
+def test_up_to_date_stages_are_skipped(workdir):
+    run_pipeline(max_workers=1)
+    assert runs(workdir) == ['clean', 'train', 'evaluate']
+
+    report = run_pipeline(max_workers=1)
+    assert statuses(report) == {'clean': 'skipped', 'train': 'skipped', 'evaluate': 'skipped'}
+    assert runs(workdir) == []
+
+
+def test_changed_inputs_config_and_missing_outputs_rerun_downstream(workdir):
+    run_pipeline(max_workers=1)
+    runs(workdir)
+
+    (workdir / 'results' / 'predictions.txt').unlink()
+    run_pipeline(max_workers=1)
+    assert runs(workdir) == ['train', 'evaluate']
+
+    (workdir / 'config.yaml').write_text('n_lag: 5\n')
+    run_pipeline(max_workers=1)
+    assert runs(workdir) == ['clean', 'train', 'evaluate']
+
+    (workdir / 'raw.txt').write_text('new raw')
+    run_pipeline(to_stage='train', max_workers=1)
+    assert runs(workdir) == ['clean', 'train']
+    assert (workdir / 'results' / 'predictions.txt').read_text() == 'new rawcleantrain'
+
+
+def test_from_stage_forces_the_stage_and_downstream(workdir):
+    run_pipeline(max_workers=1)
+    runs(workdir)
+
+    report = run_pipeline(from_stage='evaluate', max_workers=1)
+    assert statuses(report) == {'evaluate': 'ran'}
+    run_pipeline(from_stage='train', max_workers=1)
+    assert runs(workdir) == ['evaluate', 'train', 'evaluate']
+
+
+def test_evaluation_and_backtest_read_the_predictions_train_writes():
+    config = load_config(os.path.join(PROJECT_DIR, 'config.yaml'))
+    stages = {stage.name: stage for stage in build_stages(config)}
+    predictions = stages['train'].outputs[0]
+
+    # a stable path, so a later '--from evaluate' finds the predictions of the last training run
+    assert predictions == os.path.join(config['results_dir'], f"data_with_predictions.{config['storage_format']}")
+    assert predictions in stages['evaluate'].inputs
+    assert predictions in stages['backtest'].inputs
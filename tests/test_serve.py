@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+from catboost import CatBoostRegressor
+
+from models.serve import ScoringServer, ScoringService, make_handler
+
+CONFIG = {'targets': ['period_max_price_pct'], 'categorical_features': [], 'drop_features': ['Volume'],
+          'serve_max_batch_rows': 1024, 'serve_max_wait_ms': 5, 'serve_reload_interval': 3600}
+
+
+def save_model(path, n_features, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(200, n_features))
+    model = CatBoostRegressor(iterations=20, depth=2, verbose=False, allow_writing_files=False)
+    model.fit(X, 2 * X[:, 0] + X[:, 1:].sum(axis=1))
+    model.set_feature_names(['a', 'b', 'c'][:n_features])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    model.save_model(path)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """
+    Scoring server on a free port serving a small model trained on y = 2a + b.
+    """
+    monkeypatch.chdir(tmp_path)
+    save_model('data/experiment/2024-01-01/model.cbm', 2)
+
+    service = ScoringService(CONFIG)
+    httpd = ScoringServer(('127.0.0.1', 0), make_handler(service))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield service, f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url + '/predict', data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_predict(server):
+    service, url = server
+    status, body = post(url, {'rows': [{'Ticker': 'AAA', 'a': 1.0, 'b': 0.5}, {'Ticker': 'BBB', 'a': None}]})
+
+    assert status == 200
+    assert [p['Ticker'] for p in body['predictions']] == ['AAA', 'BBB']
+    expected = service.model.predict(np.array([[1.0, 0.5], [np.nan, np.nan]], dtype='float32'))
+    np.testing.assert_allclose([p['Predictions_period_max_price_pct'] for p in body['predictions']],
+                               expected, rtol=1e-6)
+    assert service.stats()['rows'] == 2
+
+
+@pytest.mark.parametrize('body', [{'rows': []}, {'rows': {'a': 1}}, {'rows': [1.0]},
+                                  {'rows': [{'a': 'high'}]}, {'rows': [{'a': True}]}, {'data': []},
+                                  {'rows': [{'a': 1.0, 'typo': 1.0}]}, {'rows': [{'Ticker': 1.5}]}])
+def test_invalid_payload_is_rejected(server, body):
+    service, url = server
+    status, response = post(url, body)
+
+    assert status == 400
+    assert 'invalid request' in response['error']
+    # the server keeps serving
+    assert post(url, {'rows': [{'a': 1.0, 'b': 1.0}]})[0] == 200
+
+
+def test_scoring_errors_return_500(server, monkeypatch):
+    service, url = server
+
+    def fail(batch_rows):
+        raise RuntimeError('model crashed')
+    monkeypatch.setattr(service.batcher, 'predict', fail)
+
+    status, response = post(url, {'rows': [{'a': 1.0, 'b': 1.0}]})
+    assert status == 500
+    assert 'model crashed' in response['error']
+
+
+def test_a_batch_builds_its_features_from_the_model_it_predicts_with(server):
+    service, url = server
+    save_model('data/experiment/2024-01-02/model.cbm', 3, seed=1)
+    rows = [{'a': 1.0, 'b': 0.5, 'c': -1.0, 'Volume': 1e6}]
+
+    # the old model rejects the new feature, until the newer model is loaded
+    assert post(url, {'rows': rows})[0] == 400
+    service.reload()
+    status, body = post(url, {'rows': rows})
+
+    assert status == 200
+    expected = service.model.predict(np.array([[1.0, 0.5, -1.0]], dtype='float32'))
+    np.testing.assert_allclose(body['predictions'][0]['Predictions_period_max_price_pct'], expected[0],
+                               rtol=1e-6)
+
+
+def test_an_invalid_request_does_not_fail_its_batch(server):
+    service, _ = server
+    results = service._predict([[{'a': 1.0, 'b': 0.5}], [{'a': 1.0, 'typo': 2.0}], [{'b': 2.0}] * 2])
+
+    assert isinstance(results[1], ValueError)
+    expected = service.model.predict(np.array([[1.0, 0.5], [np.nan, 2.0], [np.nan, 2.0]], dtype='float32'))
+    np.testing.assert_allclose(np.concatenate([results[0], results[2]]).ravel(), expected, rtol=1e-6)
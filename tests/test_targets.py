@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_preparation import data_cleaning
+from data_preparation.data_cleaning import (generate_target, generate_targets_vectorized,
+                                            partition_by_ticker, calculate_targets_for_all_tickers)
+
+
+def make_data(categorical):
+    """
+    Interleaved market data of four tickers with missing prices, and EPS events
+    covering the edge cases: a ticker without events, a ticker with a single
+    (last) release, a release without a surprise, a release on a weekend and
+    two releases on consecutive trading days.
+    """
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range('2024-01-01', '2024-06-28')
+    df_market = pd.DataFrame({'Date': np.tile(dates, 4),
+                              'Ticker': np.repeat(['BBB', 'AAA', 'CCC', 'DDD'], len(dates)),
+                              'Adj Close': rng.uniform(50, 150, 4 * len(dates))})
+    df_market.loc[rng.choice(len(df_market), 40, replace=False), 'Adj Close'] = np.nan
+    df_market = df_market.sample(frac=1, random_state=0).sort_values('Date', kind='stable')
+
+    events = [('AAA', '2024-01-10', 5.0), ('AAA', '2024-02-13', -2.0), ('AAA', '2024-03-12', np.nan),
+              ('AAA', '2024-04-11', 1.0), ('AAA', '2024-04-12', 3.0), ('AAA', '2024-05-15', 0.5),
+              ('BBB', '2024-01-24', 2.0), ('BBB', '2024-03-16', 4.0), ('BBB', '2024-04-24', -1.0),
+              ('BBB', '2024-07-24', 6.0), ('CCC', '2024-02-01', 1.5), ('EEE', '2024-02-01', 1.0)]
+    df_eps = pd.DataFrame(events, columns=['Symbol', 'Event Start Date', 'Surprise (%)'])
+    df_eps['Event Start Date'] = pd.to_datetime(df_eps['Event Start Date'])
+    df_eps['Reported EPS'] = np.arange(len(df_eps), dtype=float)
+    if categorical:
+        df_market['Ticker'] = df_market['Ticker'].astype(pd.CategoricalDtype(['AAA', 'BBB', 'CCC', 'DDD', 'ZZZ']))
+        df_eps['Symbol'] = df_eps['Symbol'].astype('category')
+    return df_market, df_eps
+
+
+def as_float_targets(df):
+    """
+    The per-ticker loop leaves the targets as object columns with pd.NA.
+    """
+    for col in ['period_max_price', 'period_min_price']:
+        df[col] = pd.array(df[col], dtype='Float64').to_numpy(dtype='float64', na_value=np.nan)
+    return df
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_vectorized_targets_match_the_per_ticker_loop(categorical):
+    df_market, df_eps = make_data(categorical)
+
+    expected = pd.concat([generate_target(market_data_ticker, eps_data_ticker)
+                          for market_data_ticker, eps_data_ticker in partition_by_ticker(df_market, df_eps)],
+                         ignore_index=True)
+    result = generate_targets_vectorized(df_market, df_eps)
+
+    as_float_targets(expected)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_categorical=False)
+    # no target for the last release of a ticker, the releases without a surprise, on a weekend
+    # or after the data, and the release followed by another one the next trading day
+    assert result['period_max_price'].notna().sum() == 4
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_target_engines_agree(categorical):
+    df_market, df_eps = make_data(categorical)
+
+    vectorized = calculate_targets_for_all_tickers(df_market, df_eps, engine='vectorized')
+    loop = calculate_targets_for_all_tickers(df_market, df_eps, engine='loop')
+
+    pd.testing.assert_frame_equal(vectorized, as_float_targets(loop))
+    assert vectorized['Ticker'].dtype == df_market['Ticker'].dtype
+
+
+@pytest.mark.parametrize('direction', ['forward', 'nearest'])
+def test_cleaning_rejects_look_ahead_earnings_joins(monkeypatch, direction):
+    monkeypatch.setattr(data_cleaning, 'load_config', lambda: {'earnings_asof_direction': direction})
+    with pytest.raises(ValueError, match='future'):
+        data_cleaning.main()
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from utilities.util import log
+
+TICKER_COLUMNS = ['Ticker', 'Symbol']
+DATE_COLUMNS = ['Date', 'Event Start Date']
+
+
+def _to_datetime64(values):
+    values = pd.to_datetime(values)
+    if getattr(values.dtype, 'tz', None) is not None:
+        values = values.tz_convert(None) if isinstance(values, pd.DatetimeIndex) \
+            else values.dt.tz_convert(None)
+    return values.astype('datetime64[ns]')
+
+
+def apply_schema(df, float_dtype='float32', name='data'):
+    """
+    Convert a market/EPS/feature frame to the compact pipeline schema.
+
+    - 'Ticker'/'Symbol' columns become categorical.
+    - 'Date'/'Event Start Date' columns (or index) become datetime64[ns].
+    - float64 columns become float_dtype (pass 'float64' to keep full precision).
+
+    Parameters:
+    - df: DataFrame to convert.
+    - float_dtype: dtype of the numeric columns.
+    - name: Name of the frame in the memory report.
+
+    Returns:
+    - The converted DataFrame.
+    """
+    memory_before = df.memory_usage(deep=True).sum()
+
+    df = df.copy()
+    for col in TICKER_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = _to_datetime64(df[col])
+    if df.index.name in DATE_COLUMNS:
+        df.index = _to_datetime64(df.index)
+
+    float_columns = [col for col in df.columns if df[col].dtype == np.float64]
+    if float_columns and np.dtype(float_dtype) != np.float64:
+        df[float_columns] = df[float_columns].astype(float_dtype)
+
+    memory_after = df.memory_usage(deep=True).sum()
+    saving = 1 - memory_after / memory_before if memory_before else 0
+    log(f'{name}: {memory_before / 1e6:.1f} MB -> {memory_after / 1e6:.1f} MB '
+        f'({saving:.0%} saved)')
+    return df
@@ -1,4 +1,5 @@
 import os 
+import ast
 import logging
 import yaml
 import datetime
@@ -6,6 +7,8 @@ import json
 import pickle
 import pandas as pd 
 
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 def log(message, level='info'):
     """
     Log a message at the specified level.
@@ -42,10 +45,108 @@ def load_config(config_path='config.yaml'):
         config = yaml.safe_load(file)
     return config
 
-def load_file(file_name):
+_FILTER_OPS = {
+    '==': lambda col, value: col == value,
+    '=': lambda col, value: col == value,
+    '!=': lambda col, value: col != value,
+    '<': lambda col, value: col < value,
+    '<=': lambda col, value: col <= value,
+    '>': lambda col, value: col > value,
+    '>=': lambda col, value: col >= value,
+    'in': lambda col, value: col.isin(value),
+    'not in': lambda col, value: ~col.isin(value),
+}
+
+
+def _filter_columns(filters):
+    return [column for column, _, _ in filters or []]
+
+
+def _apply_filters(data, filters):
+    """
+    Apply (column, op, value) filters to a DataFrame that is already in memory.
+    """
+    if not filters:
+        return data
+    mask = pd.Series(True, index=data.index)
+    for column, op, value in filters:
+        mask &= _FILTER_OPS[op](data[column], value)
+    return data[mask]
+
+
+def _arrow_filter_expression(filters, schema):
+    """
+    Build a pyarrow expression from (column, op, value) filters, parsing string
+    values of timestamp columns so that e.g. ('Date', '>=', '2020-01-01') works.
+    """
+    import pyarrow.types as pa_types
+    from pyarrow.parquet import filters_to_expression
+
+    coerced = []
+    for column, op, value in filters:
+        if pa_types.is_timestamp(schema.field(column).type):
+            if isinstance(value, (list, tuple, set)):
+                value = [pd.Timestamp(v) for v in value]
+            else:
+                value = pd.Timestamp(value)
+        coerced.append((column, op, value))
+    return filters_to_expression(coerced)
+
+
+def _read_arrow_table(file_name, file_type, columns, filters, memory_map):
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+
+    read_columns = columns
+    if columns is not None and filters:
+        read_columns = list(columns) + [c for c in _filter_columns(filters) if c not in columns]
+
+    if file_type == '.parquet':
+        schema = pq.read_schema(file_name)
+        expression = _arrow_filter_expression(filters, schema) if filters else None
+        # row groups whose statistics cannot match the filters are skipped
+        table = pq.read_table(file_name, columns=read_columns, filters=expression,
+                              memory_map=memory_map)
+    else:
+        table = feather.read_table(file_name, columns=read_columns, memory_map=memory_map)
+        if filters:
+            table = table.filter(_arrow_filter_expression(filters, table.schema))
+
+    if read_columns is not columns:
+        table = table.select(list(columns))
+    return table.to_pandas()
+
+
+def load_file(file_name, columns=None, filters=None, memory_map=False):
+    """
+    Load a file based on its extension.
+
+    Parameters:
+    - file_name: Path to a .csv, .parquet, .feather/.arrow, .npy, .json or .pkl file.
+    - columns: Optional list of columns to read (tabular formats only).
+    - filters: Optional list of (column, op, value) tuples, e.g.
+      [('Date', '>=', '2020-01-01'), ('Ticker', 'in', ['AAPL'])]. Parquet
+      files skip the row groups that cannot match; the other tabular formats
+      filter after reading.
+    - memory_map: Memory-map the file instead of reading it into RAM
+      (.parquet, .feather/.arrow and .npy; zero-copy for uncompressed
+      feather files and .npy arrays).
+
+    Returns:
+    - The loaded object.
+    """
     file_type = os.path.splitext(file_name)[-1]
     if file_type == '.csv':
-        return pd.read_csv(file_name)
+        read_columns = columns
+        if columns is not None and filters:
+            read_columns = list(columns) + [c for c in _filter_columns(filters) if c not in columns]
+        data = _apply_filters(pd.read_csv(file_name, usecols=read_columns), filters)
+        return data if read_columns is columns else data[list(columns)]
+    elif file_type in ('.parquet', '.feather', '.arrow'):
+        return _read_arrow_table(file_name, file_type, columns, filters, memory_map)
+    elif file_type == '.npy':
+        import numpy as np
+        return np.load(file_name, mmap_mode='r' if memory_map else None)
     elif file_type == '.json':
         with open(file_name, 'r') as f:
             data = json.load(f)  
@@ -55,15 +156,91 @@ def load_file(file_name):
             return pickle.load(f)
     else:
         raise TypeError(f'file type {file_type} not recognized.')
-    
 
-def save_file(data, file_path, index=True):
+
+def file_columns(file_name):
+    """
+    Column names of a tabular file, read from its header or schema only.
+
+    Parameters:
+    - file_name: Path to a .csv, .parquet or .feather/.arrow file.
+
+    Returns:
+    - List of column names.
+    """
+    file_type = os.path.splitext(file_name)[-1]
+    if file_type == '.csv':
+        return list(pd.read_csv(file_name, nrows=0).columns)
+    elif file_type == '.parquet':
+        import pyarrow.parquet as pq
+        return list(pq.read_schema(file_name).names)
+    elif file_type in ('.feather', '.arrow'):
+        import pyarrow.feather as feather
+        return list(feather.read_table(file_name, memory_map=True).schema.names)
+    else:
+        raise TypeError(f'file type {file_type} has no columns.')
+
+
+def iter_file_chunks(file_name, columns=None, chunk_rows=1_000_000, row_groups=None):
+    """
+    Read a tabular file as a sequence of DataFrames of at most chunk_rows rows,
+    without loading the whole file.
+
+    Parameters:
+    - file_name: Path to a .csv, .parquet or .feather/.arrow file.
+    - columns: Optional list of columns to read.
+    - chunk_rows: Maximum rows per chunk.
+    - row_groups: Optional row group indices to read (.parquet only).
+
+    Yields:
+    - pandas.DataFrame chunks in file order.
+    """
+    file_type = os.path.splitext(file_name)[-1]
+    if file_type == '.csv':
+        yield from pd.read_csv(file_name, usecols=columns, chunksize=chunk_rows)
+    elif file_type == '.parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file_name, memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns,
+                                               row_groups=row_groups):
+            yield batch.to_pandas()
+    elif file_type in ('.feather', '.arrow'):
+        import pyarrow.feather as feather
+        table = feather.read_table(file_name, columns=columns, memory_map=True)
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        raise TypeError(f'file type {file_type} can not be read in chunks.')
+
+
+def save_file(data, file_path, index=True, compression=None):
+    """
+    Save an object to a file based on its extension.
+
+    Parameters:
+    - data: Object to save (a DataFrame for the tabular formats, an array for .npy).
+    - file_path: Path to a .csv, .parquet, .feather/.arrow, .npy, .json or .pkl file.
+    - index: Whether to write the DataFrame index (.csv, .parquet, .feather/.arrow).
+    - compression: Optional codec, e.g. 'gzip' for .csv, 'snappy'/'zstd' for
+      .parquet, 'lz4'/'zstd' for .feather/.arrow. Feather files are written
+      uncompressed by default so that they can be memory-mapped zero-copy.
+    """
     dir_name = os.path.dirname(file_path)
     os.makedirs(dir_name, exist_ok=True)
 
     file_type = os.path.splitext(file_path)[-1]
     if file_type == '.csv':
-        data.to_csv(file_path, index=index)
+        data.to_csv(file_path, index=index, compression=compression)
+    elif file_type == '.parquet':
+        data.to_parquet(file_path, index=index, compression=compression or 'snappy')
+    elif file_type in ('.feather', '.arrow'):
+        if index and not isinstance(data.index, pd.RangeIndex):
+            data = data.reset_index()
+        data.reset_index(drop=True).to_feather(file_path,
+                                               compression=compression or 'uncompressed')
+    elif file_type == '.npy':
+        import numpy as np
+        np.save(file_path, np.asarray(data))
     elif file_type == '.json':
         with open(file_path, 'w') as f:
             json.dump(data, f)
@@ -88,8 +265,49 @@ def drop_columns(data, columns):
     for col in columns:
         if col not in data.columns:
             log(f'Column {col} not found in DataFrame')
-            columns.remove(col)
-    return data.drop(columns=columns)
+    return data.drop(columns=[col for col in columns if col in data.columns])
+
+def date_ordinals(dates):
+    """
+    Convert a column of dates to integer day ordinals (NaT -> min int64).
+    """
+    return pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]')\
+             .astype('datetime64[D]').view('int64')
+
+def _project_module_path(name):
+    path = os.path.join(PROJECT_DIR, *name.split('.')) + '.py'
+    return path if os.path.isfile(path) else None
+
+def project_modules(module_name):
+    """
+    Source files of a project module and of every project module it imports,
+    directly or through other project modules, including imports inside
+    functions. Third-party modules are not followed.
+    """
+    files, pending = set(), [module_name]
+    while pending:
+        path = _project_module_path(pending.pop())
+        if path is None or path in files:
+            continue
+        files.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), filename=path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                # 'from package import module' imports a module, 'from module import name' does not
+                pending.append(node.module)
+                pending.extend(f'{node.module}.{alias.name}' for alias in node.names)
+    return sorted(files)
+
+def results_path(config, file_name):
+    """
+    Path of a file in config['results_dir'], where training writes the
+    predictions that evaluation and the backtest read. It does not change
+    from day to day, so the pipeline can skip up-to-date stages.
+    """
+    return os.path.join(config['results_dir'], file_name)
 
 def now():
     return datetime.datetime.now().strftime('%Y%m%d_%H%M%S')